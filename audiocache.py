@@ -0,0 +1,190 @@
+''' An opt-in on-disk cache of streamed songs, filled while they play for the first time '''
+
+import asyncio
+import http.client
+import io
+import logging
+import os
+import threading
+import urllib.request
+
+from pathlib import Path
+
+from util import env
+from util.diskcache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+audio_cache = DiskCache("cache/audio", env.AUDIO_CACHE_MAX_BYTES)
+
+# Songs currently being written to the cache, so a song playing in several guilds at once is only cached by one of them
+_caching: set[str] = set()
+
+# Commits in progress, kept referenced until they finish
+_commits: set[asyncio.Task] = set()
+
+
+def enabled() -> bool:
+    ''' Whether songs are cached at all '''
+    return env.AUDIO_CACHE_MAX_BYTES > 0
+
+def cache_key(song_id: str, stream_params: dict[str, any]) -> str:
+    ''' The key a song is cached under; songs requested in another format or bitrate are cached separately '''
+    return f"{song_id}:{stream_params.get('format', 'raw')}:{stream_params.get('maxBitRate', 0)}"
+
+async def get_path(key: str) -> tuple[Path, str]:
+    ''' Returns the path of a cached song and the content type it was streamed with, or `(None, None)` if it isn't cached '''
+
+    if not enabled():
+        return None, None
+
+    await audio_cache.load()
+    path = audio_cache.get_path(key)
+    if path is None:
+        return None, None
+    return path, audio_cache.metadata(key).get("content_type")
+
+async def contains(key: str) -> bool:
+    ''' Whether a song is cached, without counting as a use of it '''
+
+    if not enabled():
+        return False
+    await audio_cache.load()
+    return key in audio_cache
+
+def tee(key: str, url: str) -> "TeeReader":
+    ''' Returns a reader that streams a song while writing it to the cache, or `None` if it's already being cached '''
+
+    if not enabled() or key in _caching:
+        return None
+    _caching.add(key)
+    return TeeReader(key, url, asyncio.get_running_loop())
+
+def stats() -> dict[str, int]:
+    ''' Counters describing the cache's usage '''
+    return audio_cache.stats | {"caching": len(_caching)}
+
+
+class TeeReader(io.RawIOBase):
+    ''' A file-like stream of a song that writes everything read from it to a temporary file.
+
+    It is read from ffmpeg's stdin writer thread. Once the whole song has been read, the file is committed to the cache on the event loop;
+    if the stream fails or is closed early, the partial file is discarded. '''
+
+    def __init__(self, key: str, url: str, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__()
+        self.key = key
+        self.url = url
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._response = None
+        self._file = None
+        self._temp_path: Path = None
+        self._content_type: str = None
+        self._content_length: int = None
+        self._received = 0
+        self._finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int=-1) -> bytes:
+        if self.closed:
+            return b""
+
+        try:
+            if self._response is None:
+                self._open()
+            data = self._response.read(size)
+        except (OSError, ValueError, http.client.HTTPException) as err:
+            # Includes the server dropping the connection mid-stream, and the source being closed from another thread mid-read.
+            # Returning nothing ends ffmpeg's input, rather than leaving it waiting on a writer thread that died
+            if not self.closed:
+                logger.warning("Failed to stream %s: %s", self.key, err)
+            with self._lock:
+                self._discard()
+            return b""
+
+        with self._lock:
+            if self._file is not None:
+                try:
+                    if data:
+                        self._file.write(data)
+                        self._received += len(data)
+                    else:
+                        self._complete()
+                except OSError as err:
+                    logger.warning("Failed to cache %s, it will be streamed without caching: %s", self.key, err)
+                    self._discard()
+        return data
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._finished:
+                self._discard()
+        if self._response is not None:
+            self._response.close()
+        super().close()
+
+    def _open(self) -> None:
+        ''' Starts the request, and opens the temporary file if the server responded with audio '''
+
+        self._response = urllib.request.urlopen(self.url, timeout=env.SUBSONIC_STREAM_TIMEOUT)
+        self._content_type = self._response.headers.get_content_type()
+        content_length = self._response.headers.get("Content-Length")
+        self._content_length = int(content_length) if content_length and content_length.isdigit() else None
+
+        with self._lock:
+            # Errors are sent as a regular subsonic response instead of audio
+            if self._content_type in ("text/xml", "application/json"):
+                self._discard()
+                return
+            self._temp_path = audio_cache.temp_path()
+            self._file = open(self._temp_path, "wb")
+
+    def _complete(self) -> None:
+        ''' Makes the finished file durable, then hands it to the event loop to be committed. Called with the lock held '''
+
+        # A connection closed early can look like the end of the stream, which would cache the song cut short for good
+        if self._content_length is not None and self._received != self._content_length:
+            logger.warning("Not caching %s, received %d of %d bytes.", self.key, self._received, self._content_length)
+            self._discard()
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._finished = True
+        self._loop.call_soon_threadsafe(self._commit)
+
+    def _commit(self) -> None:
+        ''' Starts committing the file to the cache. Runs on the event loop, which owns the cache's index '''
+
+        task = self._loop.create_task(audio_cache.commit(self.key, self._temp_path, content_type=self._content_type))
+        _commits.add(task)
+        task.add_done_callback(self._commit_done)
+
+    def _commit_done(self, task: asyncio.Task) -> None:
+        _commits.discard(task)
+        _caching.discard(self.key)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to cache %s: %s", self.key, task.exception())
+            if self._temp_path is not None:
+                self._temp_path.unlink(missing_ok=True)
+        else:
+            logger.debug("Cached %s.", self.key)
+
+    def _discard(self) -> None:
+        ''' Stops caching and deletes the partial file. Called with the lock held '''
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._temp_path is not None:
+            self._temp_path.unlink(missing_ok=True)
+            self._temp_path = None
+        if not self._finished:
+            self._finished = True
+            if not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(_caching.discard, self.key)
@@ -0,0 +1,151 @@
+''' Autocompletion of search options, answered from a cache of suggestions keyed by what has been typed so far '''
+
+import asyncio
+import logging
+import re
+
+from typing import TYPE_CHECKING
+
+from discord import app_commands
+
+import subsonic
+
+from util.cache import SingleFlight, TTLCache
+
+if TYPE_CHECKING:
+    from library import LibraryIndex
+
+logger = logging.getLogger(__name__)
+
+# Discord shows at most 25 choices, each at most 100 characters long
+SUGGESTION_LIMIT = 25
+CHOICE_MAX_LENGTH = 100
+
+# Shorter queries match too much of the library to be worth suggesting from
+MIN_QUERY_LENGTH = 2
+
+# Keystrokes closer together than this are treated as one, and only the last is searched
+DEBOUNCE_SECONDS = 0.3
+
+# Discord discards autocomplete responses after 3 seconds
+DEADLINE_SECONDS = 2.5
+
+# Suggestions as (name, value) pairs, keyed by (kind, query)
+suggestion_cache = TTLCache(max_entries=4096, max_bytes=4 * 1024 * 1024)
+SUGGESTION_TTL = 300
+
+# Identical queries typed at the same time (such as by several users) share one search
+_inflight = SingleFlight()
+
+# The latest query typed by each user for each kind of option
+_latest: dict[tuple[int, str], str] = {}
+
+
+def normalize(text: str) -> str:
+    ''' Lowercases a query and collapses its whitespace, so equivalent queries share a cache entry '''
+    return " ".join(text.casefold().split())
+
+def _clip(text: str) -> str:
+    return text if len(text) <= CHOICE_MAX_LENGTH else text[:CHOICE_MAX_LENGTH - 3] + "..."
+
+def _matches(words: list[str], name: str) -> bool:
+    ''' Whether every word of a query is in a suggestion's name, the last of them possibly incomplete '''
+
+    name_words = re.findall(r"\w+", name.casefold())
+    *complete, last = words
+    return all(word in name_words for word in complete) and any(word.startswith(last) for word in name_words)
+
+def _from_shorter_query(kind: str, query: str) -> list[tuple[str, str]]:
+    ''' Narrows down the suggestions cached for an earlier keystroke, when they held every match there was.
+    Returns `None` if there are none to narrow down '''
+
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+
+    for end in range(len(query) - 1, MIN_QUERY_LENGTH - 1, -1):
+        cached = suggestion_cache.get((kind, normalize(query[:end])))
+        if cached is None:
+            continue
+        # A full page of suggestions may have left out matches for the longer query
+        if len(cached) >= SUGGESTION_LIMIT:
+            return None
+        return [suggestion for suggestion in cached if _matches(words, suggestion[0])]
+    return None
+
+def _local_suggestions(index: "LibraryIndex", kind: str, query: str) -> list[tuple[str, str]]:
+    ''' Suggestions found in the local library index '''
+
+    if kind == "artist":
+        return [(name, name) for _, name in index.search_artists(query, SUGGESTION_LIMIT, incomplete=True)]
+    if kind == "album":
+        return [(f"{name} - {artist}", name) for _, name, artist in index.search_albums(query, SUGGESTION_LIMIT, incomplete=True)]
+    return [(f"{song.title} - {song.artist}", f"{song.title} {song.artist}") for song in index.search_songs(query, SUGGESTION_LIMIT, incomplete=True)]
+
+async def _server_suggestions(kind: str, query: str) -> list[tuple[str, str]]:
+    ''' Suggestions found by the subsonic server '''
+
+    if kind == "artist":
+        results = await subsonic.search_suggestions(query, artist_count=SUGGESTION_LIMIT)
+        return [(artist["name"], artist["name"]) for artist in results.get("artist", [])]
+    if kind == "album":
+        results = await subsonic.search_suggestions(query, album_count=SUGGESTION_LIMIT)
+        return [(f"{album.get('name', '')} - {album.get('artist', '')}", album.get("name", "")) for album in results.get("album", [])]
+    results = await subsonic.search_suggestions(query, song_count=SUGGESTION_LIMIT)
+    return [(f"{song.get('title', '')} - {song.get('artist', '')}", f"{song.get('title', '')} {song.get('artist', '')}") for song in results.get("song", [])]
+
+async def _fetch(kind: str, query: str) -> list[tuple[str, str]]:
+    ''' Searches for suggestions, locally if the library is indexed, and caches them '''
+
+    index = subsonic.local_index
+    if index is not None and index.ready:
+        suggestions = _local_suggestions(index, kind, query)
+    else:
+        suggestions = await _server_suggestions(kind, query)
+    # Songs of the same name by the same artist (such as on a compilation) would otherwise be suggested more than once
+    suggestions = list(dict.fromkeys(suggestions))
+
+    suggestion_cache.set((kind, query), suggestions, ttl=SUGGESTION_TTL, size=sum(len(name) + len(value) for name, value in suggestions) + 1)
+    return suggestions
+
+async def suggest(kind: str, text: str, user_id: int) -> list[app_commands.Choice[str]]:
+    ''' Suggests choices for an option of the given kind (`"track"`, `"album"` or `"artist"`) from what a user has typed.
+
+    Suggestions are served from the cache when the same query, or a shorter one that matched little enough, was seen recently.
+    Otherwise, when the server has to be asked, the search waits for the user to stop typing, and is given up on before
+    Discord's deadline; a late result is still cached for the next keystroke. '''
+
+    query = normalize(text)
+    if len(query) < MIN_QUERY_LENGTH:
+        return []
+
+    suggestions = suggestion_cache.get((kind, query))
+    if suggestions is None:
+        suggestions = _from_shorter_query(kind, query)
+    if suggestions is None:
+        suggestions = await _search(kind, query, user_id)
+
+    return [app_commands.Choice(name=_clip(name), value=_clip(value)) for name, value in suggestions if name and value]
+
+async def _search(kind: str, query: str, user_id: int) -> list[tuple[str, str]]:
+    ''' Searches for suggestions once the user has stopped typing, returning none if they typed something else in the meantime '''
+
+    index = subsonic.local_index
+    deadline = DEADLINE_SECONDS
+    if index is None or not index.ready:
+        latest_key = (user_id, kind)
+        _latest[latest_key] = query
+        await asyncio.sleep(DEBOUNCE_SECONDS)
+        if _latest.get(latest_key) != query:
+            # Discord only shows the response to the latest keystroke, which is handled by its own call
+            return []
+        del _latest[latest_key]
+        deadline -= DEBOUNCE_SECONDS
+
+    try:
+        return await asyncio.wait_for(_inflight.do((kind, query), lambda: _fetch(kind, query)), deadline)
+    except asyncio.TimeoutError:
+        logger.debug("Suggestions for '%s' took too long, leaving them to the next keystroke.", query)
+    except Exception as err:
+        logger.warning("Failed to search for suggestions for '%s': %s", query, err)
+    return []
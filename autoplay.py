@@ -0,0 +1,155 @@
+''' A per-guild buffer of songs to autoplay, fetched ahead of time '''
+
+import asyncio
+import aiohttp
+import logging
+
+from collections import deque
+from typing import Iterator
+
+import data
+
+from subsonic import Song, APIError, get_random_songs, get_similar_songs
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+class AutoplayBuffer():
+    ''' Holds a batch of songs for autoplay, refilling it in the background whenever it runs low '''
+
+    def __init__(self, batch_size: int=None, low_water_mark: int=None) -> None:
+        self.batch_size = batch_size if batch_size is not None else env.AUTOPLAY_BATCH_SIZE
+        self.low_water_mark = low_water_mark if low_water_mark is not None else env.AUTOPLAY_LOW_WATER_MARK
+
+        self._songs: deque[Song] = deque()
+        self._mode: data.AutoplayMode = data.AutoplayMode.NONE
+        self._seed_id: str = None
+        self._last_taken_id: str = None
+        self._refill_task: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def __iter__(self) -> Iterator[Song]:
+        return iter(self._songs)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self._songs.__sizeof__()
+
+    @property
+    def mode(self) -> "data.AutoplayMode":
+        ''' The autoplay mode the buffered songs were fetched for '''
+        return self._mode
+
+    def peek(self) -> Song:
+        ''' The song that will most likely be autoplayed next, without removing it from the buffer '''
+        return self._songs[0] if self._songs else None
+
+    def clear(self) -> None:
+        ''' Empties the buffer and cancels any refill in progress '''
+
+        self._songs.clear()
+        self._seed_id = None
+        self._last_taken_id = None
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+
+    def prefill(self, mode: "data.AutoplayMode", seed_id: str=None) -> None:
+        ''' Starts filling the buffer in the background for the given mode, so the first autoplayed song is ready when needed '''
+
+        if mode is data.AutoplayMode.NONE:
+            self.clear()
+            self._mode = mode
+            return
+
+        self._prepare(mode, seed_id)
+        if len(self._songs) < self.low_water_mark:
+            self._schedule_refill()
+
+    async def take(self, mode: "data.AutoplayMode", prev_song_id: str=None) -> Song:
+        ''' Returns the next song to autoplay, only waiting on the Subsonic server if the buffer is empty '''
+
+        self._prepare(mode, prev_song_id)
+
+        if len(self._songs) == 0:
+            self._schedule_refill()
+            try:
+                await asyncio.shield(self._refill_task)
+            except asyncio.CancelledError:
+                # The refill was cancelled by the buffer being cleared, rather than this task being cancelled
+                if asyncio.current_task().cancelling():
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                logger.error("Failed to fill the autoplay buffer: %s", err)
+
+        # Never autoplay the song that just finished
+        while self._songs and self._songs[0].song_id == prev_song_id:
+            self._songs.popleft()
+
+        if len(self._songs) == 0:
+            return None
+
+        song = self._songs.popleft()
+        self._last_taken_id = song.song_id
+
+        if len(self._songs) < self.low_water_mark:
+            self._schedule_refill()
+
+        return song
+
+    def _prepare(self, mode: "data.AutoplayMode", seed_id: str) -> None:
+        ''' Discards the buffered songs if they no longer match what should be autoplayed '''
+
+        # Similar songs only stay relevant while the buffer's own songs are being played
+        reseeded = mode is data.AutoplayMode.SIMILAR and seed_id is not None and seed_id not in (self._seed_id, self._last_taken_id)
+
+        if mode is not self._mode or reseeded:
+            self.clear()
+            self._mode = mode
+            self._seed_id = seed_id
+
+    def _schedule_refill(self) -> None:
+        ''' Starts a background refill, unless one is already running '''
+
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill(self._mode, self._last_taken_id or self._seed_id))
+            self._refill_task.add_done_callback(self._refill_done)
+
+    @staticmethod
+    def _refill_done(task: asyncio.Task) -> None:
+        ''' Logs errors from background refills that nothing is waiting on '''
+
+        if task.cancelled() or task.exception() is None:
+            return
+        err = task.exception()
+        if isinstance(err, APIError):
+            logger.error("API Error refilling autoplay buffer, Code %s: %s", err.errorcode, err.message)
+        else:
+            logger.error("Failed to refill the autoplay buffer: %s", err)
+
+    async def _refill(self, mode: "data.AutoplayMode", seed_id: str) -> None:
+        ''' Fetches a batch of songs and appends those not already buffered '''
+
+        logger.debug("Refilling autoplay buffer (mode: %s, buffered: %d)...", mode, len(self._songs))
+
+        match mode:
+            case data.AutoplayMode.RANDOM:
+                songs = await get_random_songs(size=self.batch_size)
+            case data.AutoplayMode.SIMILAR if seed_id is not None:
+                songs = await get_similar_songs(song_id=seed_id, count=self.batch_size)
+            case _:
+                return
+
+        # The mode may have changed while the request was in flight
+        if mode is not self._mode:
+            return
+
+        buffered = {song.song_id for song in self._songs}
+        for song in songs:
+            if song.song_id not in buffered:
+                self._songs.append(song)
+                buffered.add(song.song_id)
+
+        logger.debug("Autoplay buffer refilled with %d songs.", len(self._songs))
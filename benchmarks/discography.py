@@ -0,0 +1,45 @@
+''' Benchmarks `subsonic.get_artist_discography` against a local stub server as album count grows, along with how long
+`subsonic.stream_albums` takes to hand over the first album, which is when `/disco` starts playing.
+
+Run from the repository root with `python -m benchmarks.discography`
+'''
+
+import asyncio
+import time
+
+from contextlib import aclosing
+
+from benchmarks.stub_server import StubServer
+
+import subsonic
+from util import env
+
+
+async def main() -> None:
+    print(f"{'albums':>8} {'sequential (s)':>16} {'concurrent (s)':>16} {'first album (s)':>16}")
+    for album_count in (1, 10, 40, 100):
+        server = StubServer(album_count=album_count, latency=0.05)
+        env.SUBSONIC_SERVER = await server.start()
+
+        timings = []
+        for concurrency in (1, env.SUBSONIC_MAX_CONCURRENCY):
+            subsonic.metadata_cache.clear()
+            start = time.perf_counter()
+            albums = await subsonic.get_artist_discography("Stub Artist", max_concurrency=concurrency)
+            timings.append(time.perf_counter() - start)
+            assert [album.album_id for album in albums] == [str(i) for i in range(album_count)]
+
+        subsonic.metadata_cache.clear()
+        start = time.perf_counter()
+        async with aclosing(subsonic.stream_albums(await subsonic.get_artist_albums("Stub Artist"))) as streamed:
+            async for album in streamed:
+                first_album = time.perf_counter() - start
+                break
+
+        print(f"{album_count:>8} {timings[0]:>16.3f} {timings[1]:>16.3f} {first_album:>16.3f}")
+        await server.stop()
+
+    await subsonic.close_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())
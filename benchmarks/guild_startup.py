@@ -0,0 +1,107 @@
+''' Benchmark of loading saved guild data at startup, for 10k guilds with a queue each.
+
+Compares unpickling every guild's properties at once (the original `guild_properties.pickle`), reading every guild from the
+guild store up front, and the lazy startup that only reads the ids of stored guilds. The cost of then loading a guild the
+first time it's used is measured separately.
+
+Run from the repository root with `python -m benchmarks.guild_startup`
+'''
+
+import gc
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.stub_server import make_song
+
+import data
+import subsonic
+
+from songqueue import SongQueue
+from util.storage import GuildRecord, GuildStore
+
+GUILD_COUNT = 10_000
+QUEUE_LENGTH = 25
+FIRST_USES = 1_000
+
+
+def measure(call) -> tuple[float, float]:
+    ''' Runs a call once, returning how long it took in milliseconds and the memory it left allocated in MiB '''
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = call()
+    elapsed = (time.perf_counter() - start) * 1000
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    del result
+    return elapsed, used
+
+def reset() -> None:
+    ''' Forgets every loaded guild '''
+    data._guild_property_instances.clear()
+    data._guild_data_instances.clear()
+    data._stored_guilds.clear()
+    data._saved_queues.clear()
+
+def main() -> None:
+    directory = tempfile.mkdtemp()
+    pickle_path = os.path.join(directory, "guild_properties.pickle")
+    store_path = os.path.join(directory, "guild_data.sqlite3")
+
+    print(f"Writing {GUILD_COUNT} guilds with {QUEUE_LENGTH} songs each...")
+    properties = {}
+    for guild_id in range(GUILD_COUNT):
+        guild = data.GuildProperties()
+        guild.queue = SongQueue(subsonic.Song(make_song(f"{guild_id}-{i}", str(i // 12), i % 12)) for i in range(QUEUE_LENGTH))
+        properties[guild_id] = guild
+
+    with open(pickle_path, "wb") as file:
+        pickle.dump(properties, file)
+
+    store = GuildStore(store_path)
+    store.open()
+    store.write(GuildRecord(guild_id, guild.autoplay_mode.value, guild.replaygain_mode.value, data._serialize_queue(guild.queue.song_ids()))
+                for guild_id, guild in properties.items())
+    store.close()
+    del properties
+
+    def load_pickle() -> dict:
+        with open(pickle_path, "rb") as file:
+            return pickle.load(file)
+
+    def load_eagerly() -> list:
+        store = GuildStore(store_path)
+        store.open()
+        queues = [data._deserialize_queue(record.queue) for record in store.load_all()]
+        store.close()
+        return queues
+
+    def open_lazily() -> None:
+        reset()
+        data.store = GuildStore(store_path)
+        data.open_storage()
+
+    def first_uses() -> None:
+        for guild_id in range(0, GUILD_COUNT, GUILD_COUNT // FIRST_USES):
+            data.guild_properties(guild_id)
+
+    legacy = measure(load_pickle)
+    eager = measure(load_eagerly)
+    lazy = measure(open_lazily)
+    first_use = measure(first_uses)
+    data.store.close()
+
+    print(f"{'startup':<22} {'time (ms)':>10} {'memory (MiB)':>13}")
+    print(f"{'pickle, all guilds':<22} {legacy[0]:>10.1f} {legacy[1]:>13.1f}")
+    print(f"{'sqlite, all guilds':<22} {eager[0]:>10.1f} {eager[1]:>13.1f}")
+    print(f"{'sqlite, lazy':<22} {lazy[0]:>10.1f} {lazy[1]:>13.1f}")
+    print(f"First use of a guild: {first_use[0] * 1000 / FIRST_USES:.1f}us ({FIRST_USES} guilds)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+''' Micro-benchmark of decoding recorded Subsonic payloads into `Song`/`Album` objects.
+
+Compares the stdlib decoder against the decoder used by `subsonic.py`, both building the current song model.
+The original combination (stdlib decoder and `__dict__` based songs) is shown for reference.
+
+Run from the repository root with `python -m benchmarks.json_decode`
+'''
+
+import json
+import timeit
+
+from benchmarks.song_memory import LegacySong
+from benchmarks.stub_server import make_album, make_song
+
+import subsonic
+
+
+def recorded_payloads() -> dict[str, bytes]:
+    ''' Builds payloads shaped like real getAlbum, getArtist and getRandomSongs responses '''
+
+    def response(payload: dict) -> bytes:
+        return json.dumps({"subsonic-response": {"status": "ok", "version": "1.16.1"} | payload}).encode()
+
+    artist_albums = [{key: value for key, value in make_album(str(i), 0).items() if key != "song"} for i in range(60)]
+    return {
+        "getAlbum (20 songs)": response({"album": make_album("1", 20)}),
+        "getArtist (60 albums)": response({"artist": {"id": "ar-1", "name": "Stub Artist", "album": artist_albums}}),
+        "getRandomSongs (500 songs)": response({"randomSongs": {"song": [make_song(str(i), str(i % 40), i) for i in range(500)]}}),
+    }
+
+def parse(decoder, song_factory, body: bytes) -> list:
+    ''' Decodes a payload and builds its songs, as the subsonic module does '''
+
+    data = decoder(body)["subsonic-response"]
+    if "album" in data:
+        return [song_factory(song) for song in data["album"]["song"]]
+    if "artist" in data:
+        return [album["id"] for album in data["artist"]["album"]]
+    return [song_factory(song) for song in data["randomSongs"]["song"]]
+
+
+def main() -> None:
+    print(f"decoder: {subsonic.decode_json.__module__}")
+    print(f"{'payload':<28} {'size (KiB)':>10} {'original (us)':>14} {'stdlib (us)':>12} {'fast (us)':>10} {'speedup':>8}")
+    for name, body in recorded_payloads().items():
+        runs = 200
+        original = timeit.timeit(lambda: parse(json.loads, LegacySong, body), number=runs) / runs
+        baseline = timeit.timeit(lambda: parse(json.loads, subsonic.Song.from_json, body), number=runs) / runs
+        fast = timeit.timeit(lambda: parse(subsonic.decode_json, subsonic.Song.from_json, body), number=runs) / runs
+        print(f"{name:<28} {len(body) / 1024:>10.1f} {original * 1e6:>14.1f} {baseline * 1e6:>12.1f} {fast * 1e6:>10.1f} {baseline / fast:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
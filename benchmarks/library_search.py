@@ -0,0 +1,116 @@
+''' Benchmark of the local library index: crawling a stub server, then searching a library of 300k songs.
+
+Search latency is compared with a `search3` request to a local stub server answering in 20ms, which is optimistic for a real
+server searching a library this size.
+
+Run from the repository root with `python -m benchmarks.library_search`
+'''
+
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from benchmarks.stub_server import StubServer
+
+import library
+import subsonic
+
+from util import env
+
+ALBUM_COUNT = 25_000
+SONGS_PER_ALBUM = 12
+ARTIST_COUNT = 2_000
+QUERIES = 2_000
+
+# A few very common words, and a long tail of rarer ones
+COMMON_WORDS = ("love", "night", "heart", "fire", "dream", "the", "of", "you", "blue", "home")
+VOCABULARY_SIZE = 5_000
+
+
+def make_library(rng: random.Random) -> list[dict]:
+    ''' Creates albums with songs named from a vocabulary of made up words, a few of which are in a lot of names '''
+
+    syllables = ("ka", "lo", "mi", "ren", "tha", "vo", "sel", "dor", "ia", "quen", "bra", "ul", "ny", "es", "gar", "fi")
+    vocabulary = list({"".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(VOCABULARY_SIZE)})
+
+    def name(words: int) -> str:
+        chosen = [rng.choice(COMMON_WORDS) if rng.random() < 0.3 else rng.choice(vocabulary) for _ in range(words)]
+        return " ".join(chosen).title()
+
+    artists = [name(2) for _ in range(ARTIST_COUNT)]
+    albums = []
+    for album_id in range(ALBUM_COUNT):
+        artist_id = rng.randrange(ARTIST_COUNT)
+        album_name = name(3)
+        albums.append({
+            "id": f"al-{album_id}", "name": album_name, "artist": artists[artist_id], "artistId": f"ar-{artist_id}", "coverArt": f"al-{album_id}",
+            "songCount": SONGS_PER_ALBUM, "duration": SONGS_PER_ALBUM * 200, "year": 1970 + album_id % 50,
+            "song": [{"id": f"{album_id}-{track}", "title": name(3), "album": album_name, "artist": artists[artist_id],
+                      "coverArt": f"al-{album_id}", "duration": 200, "suffix": "flac"} for track in range(SONGS_PER_ALBUM)],
+        })
+    return albums
+
+def percentiles(timings: list[float]) -> str:
+    timings = sorted(timings)
+    return f"p50 {statistics.median(timings) * 1000:7.1f}us, p99 {timings[int(len(timings) * 0.99)] * 1000:7.1f}us"
+
+async def main() -> None:
+    directory = tempfile.mkdtemp()
+    rng = random.Random(0)
+
+    # Crawl a stub server, as the bot does when the index is first enabled
+    server = StubServer(album_count=1_000, songs_per_album=12, latency=0.01)
+    env.SUBSONIC_SERVER = await server.start()
+    library.index = library.LibraryIndex(os.path.join(directory, "crawl.sqlite3"))
+    library.open_index()
+    start = time.perf_counter()
+    await library.refresh()
+    print(f"Crawled 1000 albums in {time.perf_counter() - start:.2f}s ({server.requests} requests): {library.index.stats}")
+    requests = server.requests
+    start = time.perf_counter()
+    await library.refresh()
+    print(f"Refreshed in {(time.perf_counter() - start) * 1000:.1f}ms ({server.requests - requests} requests)")
+    library.close_index()
+    await server.stop()
+
+    # Search a large library
+    index = library.LibraryIndex(os.path.join(directory, "library.sqlite3"))
+    index.open()
+    albums = make_library(rng)
+    start = time.perf_counter()
+    for batch in range(0, len(albums), 500):
+        index.write_albums(albums[batch:batch + 500])
+    print(f"Indexed {ALBUM_COUNT * SONGS_PER_ALBUM} songs in {time.perf_counter() - start:.1f}s")
+
+    queries = {
+        "song": [album["song"][rng.randrange(SONGS_PER_ALBUM)]["title"] for album in rng.sample(albums, QUERIES)],
+        "song prefix": [album["song"][0]["title"][:-2] for album in rng.sample(albums, QUERIES)],
+        "album": [album["name"] for album in rng.sample(albums, QUERIES)],
+        "artist": [album["artist"] for album in rng.sample(albums, QUERIES)],
+    }
+    searches = {"song": index.search_songs, "song prefix": index.search_songs, "album": index.search_album, "artist": index.search_artists}
+    for kind, kind_queries in queries.items():
+        timings = []
+        for query in kind_queries:
+            start = time.perf_counter()
+            searches[kind](query)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{kind:>12}: {percentiles(timings)}")
+    index.close()
+
+    server = StubServer(latency=0.02)
+    env.SUBSONIC_SERVER = await server.start()
+    timings = []
+    for query in queries["song"][:100]:
+        start = time.perf_counter()
+        await subsonic.search(query)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f"{'server':>12}: {percentiles(timings)}")
+    await server.stop()
+    await subsonic.close_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+''' Benchmark of saving and loading a 10k song queue, pickled as `Song` objects and packed as song ids.
+
+Loading a packed queue only restores the ids; the time to then load the first songs to be played from a local stub server
+(with 10ms of latency per request) is measured separately.
+
+Run from the repository root with `python -m benchmarks.queue_serialization`
+'''
+
+import asyncio
+import pickle
+import time
+
+from benchmarks.stub_server import StubServer, make_song
+
+import subsonic
+
+from songqueue import SongQueue, pack_song_ids, unpack_song_ids
+from util import env
+
+QUEUE_LENGTH = 10_000
+ROUNDS = 20
+HYDRATE_AHEAD = 10
+
+
+def timed(call, rounds: int=ROUNDS) -> float:
+    ''' Runs a call repeatedly, returning the average time it took in milliseconds '''
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        call()
+    return (time.perf_counter() - start) * 1000 / rounds
+
+async def main() -> None:
+    # Navidrome style ids, 22 characters long
+    queue = SongQueue(subsonic.Song(make_song(f"{i // 12:011d}-{i % 12:010d}", str(i // 12), i % 12)) for i in range(QUEUE_LENGTH))
+
+    pickled = pickle.dumps(list(queue), protocol=pickle.HIGHEST_PROTOCOL)
+    packed = pack_song_ids(queue.song_ids())
+
+    pickle_save = timed(lambda: pickle.dumps(list(queue), protocol=pickle.HIGHEST_PROTOCOL))
+    pickle_load = timed(lambda: SongQueue(pickle.loads(pickled)))
+    packed_save = timed(lambda: pack_song_ids(queue.song_ids()))
+    packed_load = timed(lambda: SongQueue.from_song_ids(unpack_song_ids(packed)))
+
+    print(f"{QUEUE_LENGTH} songs  {'size (KiB)':>11} {'save (ms)':>10} {'load (ms)':>10}")
+    print(f"{'pickle':<12} {len(pickled) / 1024:>11.1f} {pickle_save:>10.2f} {pickle_load:>10.2f}")
+    print(f"{'song ids':<12} {len(packed) / 1024:>11.1f} {packed_save:>10.2f} {packed_load:>10.2f}")
+
+    # Drop every loaded song, so the restored queue has to request them
+    del queue
+    server = StubServer(latency=0.01)
+    env.SUBSONIC_SERVER = await server.start()
+
+    restored = SongQueue.from_song_ids(unpack_song_ids(packed))
+    start = time.perf_counter()
+    await restored.hydrate(0, HYDRATE_AHEAD)
+    hydrate = (time.perf_counter() - start) * 1000
+    print(f"Loading the first {HYDRATE_AHEAD} songs: {hydrate:.1f}ms ({server.requests} requests, {restored.pending} songs left as ids)")
+
+    await server.stop()
+    await subsonic.close_session()
+
+if __name__ == "__main__":
+    asyncio.run(main())
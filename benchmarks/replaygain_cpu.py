@@ -0,0 +1,76 @@
+''' Benchmark of the CPU time ffmpeg spends normalizing volume across many concurrent guilds.
+
+Each guild plays one song whose ReplayGain metadata is drawn from a realistic mix: some songs have no gain or a gain of 0dB,
+the rest need adjusting by a few dB. The per-sample `volume=replaygain=track` filter every stream used to go through is compared
+with the precomputed gain chosen by `player.py`, which leaves untouched songs to be copied through.
+
+Requires ffmpeg on the PATH. Run from the repository root with `python -m benchmarks.replaygain_cpu`
+'''
+
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from benchmarks.stub_server import make_song
+from benchmarks.transcode_cpu import BITRATE, SECONDS, children_cpu_time, make_sample, play
+
+import data
+import player
+
+from subsonic import Song
+
+GUILDS = 32
+UNTOUCHED_SHARE = 0.3
+
+
+def make_songs() -> list[Song]:
+    ''' Creates one song per guild with a mix of ReplayGain metadata '''
+
+    rng = random.Random(0)
+    songs = []
+    for i in range(GUILDS):
+        song = make_song(str(i), "1", i)
+        if rng.random() >= UNTOUCHED_SHARE:
+            song["replayGain"] = {"trackGain": round(rng.uniform(-12, 3), 2), "trackPeak": round(rng.uniform(0.5, 1), 3)}
+        elif rng.random() < 0.5:
+            song["replayGain"] = {"trackGain": 0.0, "trackPeak": 1.0}
+        songs.append(Song(song))
+    return songs
+
+def run(path: Path, sources: list[tuple[str, str]]) -> tuple[float, float]:
+    ''' Plays one source per guild concurrently, returning the wall time and ffmpeg CPU time '''
+
+    cpu_before = children_cpu_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        list(executor.map(lambda options: play(path, *options), sources))
+    return time.perf_counter() - start, children_cpu_time() - cpu_before
+
+def main() -> None:
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg was not found on the PATH.")
+
+    songs = make_songs()
+    # The server streams Opus, so songs that don't need adjusting are copied through
+    precomputed = [player.source_options(player.replaygain_scalar(song, data.ReplayGainMode.TRACK), True) for song in songs]
+    filtered = [(None, "-filter:a volume=replaygain=track")] * GUILDS
+    untouched = sum(codec == "copy" for codec, _ in precomputed)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_sample(Path(directory))
+        print(f"{GUILDS} concurrent guilds playing {SECONDS}s at {BITRATE}kbps, {untouched} of them needing no adjustment:")
+
+        results = {"per-sample replaygain filter": run(path, filtered), "precomputed gain": run(path, precomputed)}
+        baseline = results["per-sample replaygain filter"][1]
+        for name, (wall, cpu) in results.items():
+            print(f"  {name:<30} {cpu:8.2f}s CPU in total, {cpu / GUILDS:6.3f}s per guild, "
+                  f"{baseline / max(cpu, 1e-9):5.1f}x less CPU than the filter, {wall:.2f}s wall")
+
+
+if __name__ == "__main__":
+    main()
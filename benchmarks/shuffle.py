@@ -0,0 +1,59 @@
+''' Benchmark of `/shuffle` on queues of 10k to 100k songs.
+
+Compares the original shuffle (a deep copy of the queue, then repeated `list.pop` at random indices) with the in-place
+shuffle of `SongQueue`, both eager and lazy. For the lazy shuffle, the time to then show the first page of the queue is included.
+
+Run from the repository root with `python -m benchmarks.shuffle`
+'''
+
+import copy
+import time
+
+from random import randint
+
+from benchmarks.stub_server import make_song
+
+import subsonic
+
+from songqueue import SongQueue
+
+SIZES = (10_000, 50_000, 100_000)
+PAGE_SIZE = 10
+
+
+def legacy_shuffle(queue: list) -> list:
+    ''' The original implementation of `/shuffle` '''
+
+    temporaryqueue = copy.deepcopy(queue)
+    shuffledqueue = []
+    while len(temporaryqueue) > 0:
+        randomindex = randint(0, len(temporaryqueue) - 1)
+        shuffledqueue.append(temporaryqueue.pop(randomindex))
+    return shuffledqueue
+
+def timed(call) -> float:
+    ''' Runs a call once, returning how long it took in milliseconds '''
+
+    start = time.perf_counter()
+    call()
+    return (time.perf_counter() - start) * 1000
+
+def main() -> None:
+    for size in SIZES:
+        songs = [subsonic.Song(make_song(str(i), str(i // 12), i % 12)) for i in range(size)]
+
+        legacy = timed(lambda: legacy_shuffle(songs))
+
+        queue = SongQueue(songs)
+        eager = timed(lambda: queue.shuffle())
+
+        queue = SongQueue(songs)
+        lazy = timed(lambda: queue.shuffle(lazy=True))
+        first_page = timed(lambda: queue[:PAGE_SIZE])
+
+        print(f"{size:>7} songs: legacy {legacy:9.1f}ms | eager {eager:7.2f}ms ({legacy / eager:6.0f}x) | "
+              f"lazy {lazy * 1000:5.1f}us, first page {first_page * 1000:6.1f}us")
+
+
+if __name__ == "__main__":
+    main()
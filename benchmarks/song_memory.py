@@ -0,0 +1,59 @@
+''' Measures the memory used per queued song, before and after the compact `Song` model.
+
+Each guild parses its own copy of the same discography response, as it would when queueing it from Subsonic.
+
+Run from the repository root with `python -m benchmarks.song_memory`
+'''
+
+import gc
+import json
+import tracemalloc
+
+from benchmarks.stub_server import make_album
+
+import subsonic
+
+
+class LegacySong():
+    ''' The original, `__dict__` based song model '''
+    def __init__(self, json_object: dict) -> None:
+        self._id: str = json_object["id"] if "id" in json_object else ""
+        self._title: str = json_object["title"] if "title" in json_object else "Unknown Track"
+        self._album: str = json_object["album"] if "album" in json_object else "Unknown Album"
+        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
+        self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
+        self._duration: int = json_object["duration"] if "duration" in json_object else 0
+
+
+def measure(factory, payload: str, guild_count: int) -> float:
+    ''' Returns the bytes retained per queued song after every guild queues the whole payload '''
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    queues = []
+    for _ in range(guild_count):
+        albums = json.loads(payload)
+        queues.append([factory(song) for album in albums for song in album["song"]])
+        del albums
+
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    queued = sum(len(queue) for queue in queues)
+    return used / queued
+
+
+def main() -> None:
+    payload = json.dumps([make_album(str(i), 12) for i in range(50)])
+
+    print(f"{'guilds':>8} {'legacy (B/song)':>16} {'compact (B/song)':>17}")
+    for guild_count in (1, 10, 50):
+        legacy = measure(LegacySong, payload, guild_count)
+        compact = measure(subsonic.Song.from_json, payload, guild_count)
+        print(f"{guild_count:>8} {legacy:>16.1f} {compact:>17.1f}")
+
+if __name__ == "__main__":
+    main()
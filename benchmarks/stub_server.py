@@ -0,0 +1,104 @@
+''' A minimal local Subsonic stub server used by the benchmarks '''
+
+import asyncio
+import os
+
+from aiohttp import web
+
+# util.env requires these to be set before it is imported
+os.environ.setdefault("DISCORD_OWNER_ID", "0")
+os.environ.setdefault("SUBSONIC_SERVER", "http://127.0.0.1")
+os.environ.setdefault("SUBSONIC_USER", "benchmark")
+os.environ.setdefault("SUBSONIC_PASSWORD", "benchmark")
+
+
+def ok(payload: dict) -> web.Response:
+    ''' Wraps a payload in a successful subsonic response '''
+    return web.json_response({"subsonic-response": {"status": "ok", "version": "1.16.1"} | payload})
+
+def make_song(song_id: str, album_id: str, track: int) -> dict:
+    ''' Creates a fake song entry '''
+    return {
+        "id": song_id,
+        "title": f"Track {track}",
+        "album": f"Album {album_id}",
+        "artist": "Stub Artist",
+        "coverArt": f"al-{album_id}",
+        "duration": 180 + track,
+        "suffix": "mp3",
+    }
+
+def make_album(album_id: str, song_count: int) -> dict:
+    ''' Creates a fake album entry with its songs '''
+    return {
+        "id": album_id,
+        "name": f"Album {album_id}",
+        "artist": "Stub Artist",
+        "artistId": "ar-1",
+        "coverArt": f"al-{album_id}",
+        "songCount": song_count,
+        "duration": song_count * 180,
+        "year": 2000,
+        "song": [make_song(f"{album_id}-{i}", album_id, i) for i in range(song_count)],
+    }
+
+
+class StubServer():
+    ''' A Subsonic server stub with a configurable album count and per-request latency '''
+    def __init__(self, album_count: int=10, songs_per_album: int=10, latency: float=0.05) -> None:
+        self.album_count = album_count
+        self.songs_per_album = songs_per_album
+        self.latency = latency
+        self.requests = 0
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        endpoint = request.path.rsplit("/", 1)[-1].removesuffix(".view")
+        match endpoint:
+            case "ping":
+                return ok({})
+            case "search3":
+                return ok({"searchResult3": {"artist": [{"id": "ar-1", "name": "Stub Artist"}]}})
+            case "getArtist":
+                albums = [{"id": str(i), "name": f"Album {i}"} for i in range(self.album_count)]
+                return ok({"artist": {"id": "ar-1", "name": "Stub Artist", "album": albums}})
+            case "getAlbumList2":
+                size, offset = int(request.query.get("size", 10)), int(request.query.get("offset", 0))
+                albums = [{"id": str(i), "name": f"Album {i}"} for i in range(offset, min(offset + size, self.album_count))]
+                return ok({"albumList2": {"album": albums}})
+            case "getAlbum":
+                return ok({"album": make_album(request.query["id"], self.songs_per_album)})
+            case "getSong":
+                album_id, _, track = request.query["id"].rpartition("-")
+                return ok({"song": make_song(request.query["id"], album_id, int(track or 0))})
+            case "stream":
+                if request.query["id"] == "missing":
+                    return web.Response(text='<subsonic-response status="failed"><error code="70"/></subsonic-response>', content_type="text/xml")
+                # Transcodes to Opus when asked to, like a server with an Opus transcoding profile
+                content_type = "audio/ogg" if request.query.get("format") == "opus" else "audio/mpeg"
+                return web.Response(body=b"\x00" * 4096, content_type=content_type)
+            case "getCoverArt":
+                etag = f'"{request.query["id"]}"'
+                if request.headers.get("If-None-Match") == etag:
+                    return web.Response(status=304)
+                return web.Response(body=b"\xff\xd8" + request.query["id"].encode() * 512, content_type="image/jpeg", headers={"ETag": etag})
+        return ok({})
+
+    async def start(self) -> str:
+        ''' Starts the server on a free local port and returns its base url '''
+        app = web.Application()
+        app.router.add_get("/rest/{endpoint}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        ''' Stops the server '''
+        await self._runner.cleanup()
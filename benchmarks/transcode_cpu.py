@@ -0,0 +1,85 @@
+''' Benchmark of the CPU time ffmpeg spends per stream, re-encoding versus passing Opus packets through.
+
+A test tone is encoded to Ogg/Opus once, standing in for a stream the server has already transcoded.
+It is then played through `discord.FFmpegOpusAudio` by several concurrent "guilds" in each mode, as fast as ffmpeg can go,
+and the CPU time of the finished ffmpeg processes is read from `getrusage`.
+
+Requires ffmpeg on the PATH. Run from the repository root with `python -m benchmarks.transcode_cpu`
+'''
+
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import discord
+
+STREAMS = 8
+SECONDS = 120
+BITRATE = 64
+
+MODES = {
+    "transcode + replaygain filter": {"codec": None, "options": "-filter:a volume=replaygain=track"},
+    "transcode": {"codec": None, "options": None},
+    "passthrough": {"codec": "copy", "options": None},
+}
+
+
+def make_sample(directory: Path) -> Path:
+    ''' Encodes a stereo test tone to Ogg/Opus '''
+
+    path = directory / "sample.opus"
+    subprocess.run(["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={SECONDS}",
+                    "-ac", "2", "-c:a", "libopus", "-b:a", f"{BITRATE}k", str(path)], check=True)
+    return path
+
+def play(path: Path, codec: str, options: str) -> int:
+    ''' Reads every packet of a source, as the voice client would, and returns how many there were '''
+
+    source = discord.FFmpegOpusAudio(str(path), bitrate=BITRATE, codec=codec, options=options)
+    packets = 0
+    try:
+        while source.read():
+            packets += 1
+    finally:
+        source.cleanup()
+    return packets
+
+def children_cpu_time() -> float:
+    ''' User and system CPU time of every finished child process so far, in seconds '''
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run(path: Path, codec: str, options: str) -> tuple[float, float, int]:
+    ''' Plays the sample in `STREAMS` concurrent sources, returning the wall time, ffmpeg CPU time and packets read '''
+
+    cpu_before = children_cpu_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=STREAMS) as executor:
+        packets = sum(executor.map(lambda _: play(path, codec, options), range(STREAMS)))
+    return time.perf_counter() - start, children_cpu_time() - cpu_before, packets
+
+def main() -> None:
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg was not found on the PATH.")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_sample(Path(directory))
+        print(f"{STREAMS} concurrent streams of {SECONDS}s at {BITRATE}kbps:")
+
+        baseline = None
+        for name, mode in MODES.items():
+            wall, cpu, packets = run(path, **mode)
+            baseline = baseline or cpu
+            print(f"  {name:<30} {cpu / STREAMS:7.3f}s CPU per stream ({cpu / (STREAMS * SECONDS) * 100:5.2f}% of a core in real time), "
+                  f"{baseline / max(cpu, 1e-9):5.1f}x less CPU than the first mode, {packets} packets in {wall:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,61 +1,136 @@
 ''' Data used throughout the application '''
 
-''' 
-    TODO: Save one properties pickle file per-guild, instead of saving all in one file at once
-'''
-
+import asyncio
 import logging
 import os
 import pickle
+import sys
+import time
 
 from enum import Enum
-from typing import Final
+from functools import partial
+from typing import Container, Final
 
 from subsonic import Song
 from player import Player
+from songqueue import SongQueue, is_packed, pack_song_ids, unpack_queue
+from util import env
+from util.storage import GuildRecord, GuildStore
 
 logger = logging.getLogger(__name__)
 
 # Guild data
-_default_data: dict[str, any] = {
-    "player": None,
-}
-
 class GuildData():
     ''' Class that holds all Discodrome data specific to a guild (not saved to disk) '''
-    def __init__(self) -> None:
-        self._data = _default_data
-        self.player = Player()
-        if self.player.queue is None:
-            self.player.queue = []
+
+    __slots__ = ("_player", "_last_active")
+
+    def __init__(self, guild_id: int=None) -> None:
+        self._player = Player(on_queue_change=partial(mark_dirty, guild_id) if guild_id is not None else None)
+        self._last_active = time.monotonic()
 
     @property
     def player(self) -> Player:
         '''The guild's player.'''
-        return self._data["player"]
-    
-    @player.setter
-    def player(self, value: Player) -> None:
-        self._data["player"] = value
+        return self._player
+
+    @property
+    def last_active(self) -> float:
+        ''' When the guild's data was last used, as a `time.monotonic()` timestamp '''
+        return self._last_active
+
+    def touch(self) -> None:
+        ''' Marks the guild's data as used just now '''
+        self._last_active = time.monotonic()
+
+    def is_idle(self, idle_for: float) -> bool:
+        ''' Whether nothing is playing and the data hasn't been used for the given number of seconds '''
+        return self._player.current_song is None and time.monotonic() - self._last_active >= idle_for
 
 _guild_data_instances: dict[int, GuildData] = {} # Dictionary to store temporary data for each guild instance
 
 def guild_data(guild_id: int) -> GuildData:
-    ''' Returns the temporary data for the chosen guild '''
+    ''' Returns the temporary data for the chosen guild, creating it on first use '''
 
     # Return property if guild exists
-    if guild_id in _guild_data_instances:
-        return _guild_data_instances[guild_id]
+    data = _guild_data_instances.get(guild_id)
+    if data is not None:
+        data.touch()
+        return data
 
     # Create & store new data object if guild does not already exist
-    data = GuildData()
+    data = GuildData(guild_id)
 
     # Load queue from disk if it exists
     if guild_properties(guild_id).queue is not None:
         data.player.queue = guild_properties(guild_id).queue
 
     _guild_data_instances[guild_id] = data
-    return _guild_data_instances[guild_id]
+    return data
+
+async def evict_idle_guilds(idle_for: float, busy: Container[int]=()) -> int:
+    ''' Frees the data of guilds that haven't played anything for `idle_for` seconds. Guilds in `busy` are always kept.
+
+    With the guild store open, evicted guilds are written to it and their properties and queue dropped as well, to be read back the
+    next time they're used. Otherwise their queue is kept in their properties. Returns the number of guilds evicted '''
+
+    global _flush_task
+
+    evicted = [guild_id for guild_id, data in _guild_data_instances.items() if guild_id not in busy and data.is_idle(idle_for)]
+    for guild_id in evicted:
+        player = _guild_data_instances.pop(guild_id).player
+        # A discography still loading would otherwise keep filling a queue nothing plays
+        player.cancel_loading()
+        player.cancel_prefetch()
+        player.autoplay_buffer.clear()
+        guild_properties(guild_id).queue = player.queue if player.queue else None
+
+    if evicted and store.is_open:
+        # Written as the flush task, after any write already running, so a background write can't land an older snapshot last
+        if _flush_task is not None and not _flush_task.done():
+            await asyncio.wait([_flush_task])
+        _dirty.update(evicted)
+        _flush_task = asyncio.create_task(flush())
+        _flush_task.add_done_callback(_flush_done)
+        await asyncio.wait([_flush_task])
+
+        for guild_id in evicted:
+            # Guilds used or changed again while being written are kept, as are any that failed to be written
+            if guild_id in _guild_data_instances or guild_id in _dirty:
+                continue
+            _guild_property_instances.pop(guild_id, None)
+            _saved_queues.pop(guild_id, None)
+            _stored_guilds.add(guild_id)
+
+    if evicted:
+        logger.debug("Evicted %d idle guilds, %d remain loaded.", len(evicted), len(_guild_data_instances))
+    return len(evicted)
+
+def _song_size(song: Song | str) -> int:
+    ''' The approximate memory used by a song, or by the id of a song not loaded yet.
+    Album, artist and cover art strings are shared between songs and not counted '''
+
+    if isinstance(song, str):
+        return sys.getsizeof(song)
+    return sys.getsizeof(song) + sys.getsizeof(song.title)
+
+def guild_memory_stats() -> dict[int, dict[str, int]]:
+    ''' The approximate memory used by each loaded guild, with the number of songs it holds.
+
+    Songs queued in several guilds are the same objects, so they are counted once per guild that holds them. '''
+
+    stats = {}
+    for guild_id, data in _guild_data_instances.items():
+        player = data.player
+        queue_bytes = sys.getsizeof(player.queue) + sum(_song_size(song) for song in player.queue.unordered())
+        autoplay_bytes = sys.getsizeof(player.autoplay_buffer) + sum(_song_size(song) for song in player.autoplay_buffer)
+        stats[guild_id] = {
+            "queue_length": len(player.queue),
+            "autoplay_buffered": len(player.autoplay_buffer),
+            "bytes": sys.getsizeof(data) + sys.getsizeof(player) + queue_bytes + autoplay_bytes,
+            "idle_seconds": int(time.monotonic() - data.last_active),
+        }
+    return stats
 
 
 # Guild properties
@@ -65,33 +140,68 @@ class AutoplayMode(Enum):
     RANDOM : Final[int] = 1
     SIMILAR : Final[int] = 2
 
-_default_properties: dict[str, any] = {
-    "queue": None,
-    "autoplay-mode": AutoplayMode.NONE,
-}
+class ReplayGainMode(Enum):
+    ''' Enum representing which ReplayGain values are used to normalize volume '''
+    NONE : Final[int] = 0
+    TRACK : Final[int] = 1
+    ALBUM : Final[int] = 2
+
+def _default_replaygain_mode() -> ReplayGainMode:
+    ''' The ReplayGain mode of guilds that haven't chosen one '''
+    return ReplayGainMode.TRACK if env.REPLAYGAIN else ReplayGainMode.NONE
 
 
 class GuildProperties():
     ''' Class that holds all Discodrome properties specific to a guild (saved to disk) '''
-    def __init__(self) -> None:
-        self._properties = _default_properties
+
+    __slots__ = ("_guild_id", "_queue", "_autoplay_mode", "_replaygain_mode")
+
+    def __init__(self, guild_id: int=None) -> None:
+        self._guild_id = guild_id
+        self._queue: SongQueue = None
+        self._autoplay_mode = AutoplayMode.NONE
+        self._replaygain_mode = _default_replaygain_mode()
+
+    def __getstate__(self) -> dict[str, any]:
+        return {"queue": self._queue, "autoplay-mode": self._autoplay_mode, "replaygain-mode": self._replaygain_mode}
+
+    def __setstate__(self, state: dict[str, any]) -> None:
+        # Properties saved before __slots__ was introduced keep everything under "_properties"
+        state = state.get("_properties", state)
+        self._guild_id = None
+        self._queue = state.get("queue")
+        self._autoplay_mode = state.get("autoplay-mode", AutoplayMode.NONE)
+        self._replaygain_mode = state.get("replaygain-mode", _default_replaygain_mode())
 
     @property
     def autoplay_mode(self) -> AutoplayMode:
         '''The autoplay mode in use by this guild'''
-        return self._properties["autoplay-mode"]
+        return self._autoplay_mode
 
     @autoplay_mode.setter
     def autoplay_mode(self, value: AutoplayMode) -> None:
-        self._properties["autoplay-mode"] = value
+        self._autoplay_mode = value
+        if self._guild_id is not None:
+            mark_dirty(self._guild_id)
 
     @property
-    def queue(self) -> list[Song]:
-        return self._properties["queue"]
+    def replaygain_mode(self) -> ReplayGainMode:
+        '''The ReplayGain values used to normalize volume in this guild'''
+        return self._replaygain_mode
+
+    @replaygain_mode.setter
+    def replaygain_mode(self, value: ReplayGainMode) -> None:
+        self._replaygain_mode = value
+        if self._guild_id is not None:
+            mark_dirty(self._guild_id)
+
+    @property
+    def queue(self) -> SongQueue:
+        return self._queue
 
     @queue.setter
-    def queue(self, value: list[Song]) -> None:
-        self._properties["queue"] = value
+    def queue(self, value: SongQueue) -> None:
+        self._queue = value
 
 
 _guild_property_instances: dict[int, GuildProperties] = {} # Dictionary to store properties for each guild instance
@@ -103,35 +213,187 @@ def guild_properties(guild_id: int) -> GuildProperties:
     if guild_id in _guild_property_instances:
         return _guild_property_instances[guild_id]
 
-    # Create & store new properties object if guild does not already exist
-    properties = GuildProperties()
+    # Create & store new properties object if guild does not already exist, reading it from disk the first time it's used
+    properties = GuildProperties(guild_id)
+    if guild_id in _stored_guilds:
+        _stored_guilds.discard(guild_id)
+        record = store.load(guild_id)
+        if record is not None:
+            _load_record(properties, record)
     _guild_property_instances[guild_id] = properties
     return _guild_property_instances[guild_id]
 
-def save_guild_properties_to_disk() -> None:
-    ''' Saves guild properties to disk. '''
 
-    # Copy the queues from each guild data into each guild property
-    for guild_id, properties in _guild_property_instances.items():
-        properties.queue = guild_data(guild_id).player.queue
 
-    with open("guild_properties.pickle", "wb") as file:
-        try:
-            pickle.dump(_guild_property_instances, file, protocol=pickle.HIGHEST_PROTOCOL)
-            logger.info("Guild properties saved successfully.")
-        except pickle.PicklingError as err:
-            logger.error("Failed to save guild properties to disk.", exc_info=err)
+# Persistence
+store = GuildStore(env.STORAGE_PATH)
+
+# Guilds with changes that haven't been written to disk yet
+_dirty: set[int] = set()
+_flush_handle: asyncio.TimerHandle = None
+_flush_task: asyncio.Task = None
+
+# Guilds saved on disk that haven't been loaded yet
+_stored_guilds: set[int] = set()
+
+# The queue and its version last written for each guild, so unchanged queues aren't written again
+_saved_queues: dict[int, tuple[SongQueue, int]] = {}
+
+def mark_dirty(guild_id: int) -> None:
+    ''' Schedules a guild's properties and queue to be written to disk shortly, batching any other changes made in the meantime '''
+
+    global _flush_handle
+
+    _dirty.add(guild_id)
+    if _flush_handle is None and store.is_open:
+        _flush_handle = asyncio.get_running_loop().call_later(env.STORAGE_WRITE_DELAY, _start_flush)
+
+def _start_flush() -> None:
+    ''' Starts writing dirty guilds in the background, unless a write is already running '''
+
+    global _flush_handle, _flush_task
+
+    _flush_handle = None
+    if _flush_task is not None and not _flush_task.done():
+        # Try again once the running write has had time to finish
+        _flush_handle = asyncio.get_running_loop().call_later(env.STORAGE_WRITE_DELAY, _start_flush)
+        return
+    _flush_task = asyncio.create_task(flush())
+    _flush_task.add_done_callback(_flush_done)
+
+def _flush_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to write guild data to disk.", exc_info=task.exception())
+
+def _serialize_queue(song_ids: list[str], shuffled: tuple[int, int]=(0, 0)) -> bytes:
+    ''' Serializes a queue for storage, as the ids of its songs and the range of them still to be lazily shuffled '''
+    return pack_song_ids(song_ids, shuffled) if song_ids else b""
+
+def _deserialize_queue(blob: bytes) -> SongQueue:
+    ''' Restores a stored queue, or returns `None` if it was empty. Its songs are only loaded once they're about to be played or shown '''
+
+    if not blob:
+        return None
+    if is_packed(blob):
+        return SongQueue.from_song_ids(*unpack_queue(blob))
+    # Queues written before they were stored as ids are pickled lists of songs
+    return SongQueue(pickle.loads(blob))
+
+def _snapshot(guild_id: int) -> tuple[int, int, int, tuple[list[str], tuple[int, int]]]:
+    ''' Captures a guild's current properties and, if it changed since it was last written, its queue '''
+
+    properties = guild_properties(guild_id)
+    data = _guild_data_instances.get(guild_id)
+    queue = data.player.queue if data is not None else properties.queue
+
+    queue_snapshot = None
+    saved_queue, saved_version = _saved_queues.get(guild_id, (None, -1))
+    version = queue.version if queue is not None else 0
+    if saved_queue is not queue or saved_version != version:
+        # A copy, so the queue can keep changing while the snapshot is written. A lazy shuffle is saved as still pending,
+        # rather than being carried out on the event loop just to be written down
+        queue_snapshot = queue.snapshot() if queue is not None else ([], (0, 0))
+        _saved_queues[guild_id] = (queue, version)
+
+    return guild_id, properties.autoplay_mode.value, properties.replaygain_mode.value, queue_snapshot
+
+def _write_snapshots(snapshots: list[tuple[int, int, int, tuple[list[str], tuple[int, int]]]]) -> int:
+    ''' Serializes and writes snapshots of guilds. Runs in a worker thread '''
+    return store.write(GuildRecord(guild_id, autoplay_mode, replaygain_mode, None if queue is None else _serialize_queue(*queue))
+                       for guild_id, autoplay_mode, replaygain_mode, queue in snapshots)
+
+async def flush() -> int:
+    ''' Writes every guild with unsaved changes to disk, returning how many were written '''
+
+    if not _dirty or not store.is_open:
+        return 0
+
+    guild_ids = list(_dirty)
+    _dirty.clear()
+    snapshots = [_snapshot(guild_id) for guild_id in guild_ids]
+
+    try:
+        written = await asyncio.to_thread(_write_snapshots, snapshots)
+    except BaseException:
+        # Write these guilds again next time, queues included
+        _dirty.update(guild_ids)
+        for guild_id in guild_ids:
+            _saved_queues.pop(guild_id, None)
+        raise
+
+    logger.debug("Wrote %d guilds to disk.", written)
+    return written
 
-def load_guild_properties_from_disk() -> None:
-    ''' Loads guild properties that have been saved to disk. '''
+def open_storage() -> None:
+    ''' Opens the guild store, migrating properties saved by older versions first.
 
-    if not os.path.exists("guild_properties.pickle"):
-        logger.info("Unable to load guild properties from disk. File was not found.")
+    Only the ids of stored guilds are read here; each guild's properties and queue are read the first time it's used '''
+
+    store.open()
+    _migrate_pickle("guild_properties.pickle")
+
+    _stored_guilds.update(store.guild_ids())
+    logger.info("Found %d guilds in '%s'.", len(_stored_guilds), store.path)
+
+def _load_record(properties: GuildProperties, record: GuildRecord) -> None:
+    ''' Fills in a guild's properties from its stored record '''
+
+    properties._autoplay_mode = AutoplayMode(record.autoplay_mode)
+    properties._replaygain_mode = ReplayGainMode(record.replaygain_mode)
+    properties._queue = _deserialize_queue(record.queue)
+    _saved_queues[record.guild_id] = (properties.queue, 0)
+
+def _migrate_pickle(path: str) -> None:
+    ''' Moves guild properties from the pickle file used by older versions into the guild store '''
+
+    if not os.path.exists(path):
         return
 
-    with open("guild_properties.pickle", "rb") as file:
-        try:
-            _guild_property_instances.update(pickle.load(file))
-            logger.info("Guild properties loaded successfully.")
-        except pickle.UnpicklingError as err:
-            logger.error("Failed to load guild properties from disk.", exc_info=err)
+    try:
+        with open(path, "rb") as file:
+            properties: dict[int, GuildProperties] = pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError) as err:
+        logger.error("Failed to migrate guild properties from '%s'.", path, exc_info=err)
+        return
+
+    store.write(GuildRecord(guild_id, props.autoplay_mode.value, props.replaygain_mode.value, _serialize_queue([song.song_id for song in props.queue or []]))
+                for guild_id, props in properties.items())
+    os.replace(path, path + ".migrated")
+    logger.info("Migrated %d guilds from '%s' to '%s'.", len(properties), path, store.path)
+
+async def close_storage() -> None:
+    ''' Writes any unsaved changes and closes the guild store, giving up after `STORAGE_SHUTDOWN_TIMEOUT` seconds '''
+
+    global _flush_handle
+
+    if not store.is_open:
+        return
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+
+    async def final_flush() -> None:
+        if _flush_task is not None and not _flush_task.done():
+            await asyncio.wait([_flush_task])
+        await flush()
+
+    # Only guilds changed in the last few seconds are left to write, so this is normally quick however many guilds there are
+    try:
+        await asyncio.wait_for(final_flush(), env.STORAGE_SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.error("Timed out writing guild data to disk; the latest changes of %d guilds were lost.", len(_dirty))
+    except Exception as err:
+        logger.error("Failed to write guild data to disk.", exc_info=err)
+    else:
+        logger.info("Guild data saved successfully.")
+    finally:
+        # Closing checkpoints the write-ahead log, whatever became of the last changes
+        await asyncio.to_thread(store.close)
+
+async def compact_storage() -> None:
+    ''' Removes stored guilds that hold nothing but defaults and reclaims unused space in the guild store '''
+
+    if not store.is_open:
+        return
+    deleted = await asyncio.to_thread(store.compact, default_autoplay_mode=AutoplayMode.NONE.value, default_replaygain_mode=_default_replaygain_mode().value)
+    logger.debug("Compacted guild store, removing %d guilds.", deleted)
@@ -1,4 +1,4 @@
-from asyncio import run
+import asyncio
 import signal
 import discord
 import logging
@@ -6,13 +6,15 @@ import os
 
 logger = logging.getLogger(__name__)
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 
 import data
+import library
+import player
 
 from util import env
 from util import logs
-from subsonic import close_session, ping_api
+from subsonic import cache_stats, close_session, inflight_stats, ping_api, pool_stats
 
 class DiscodromeClient(commands.Bot):
     ''' An instance of the Discodrome client '''
@@ -22,6 +24,9 @@ class DiscodromeClient(commands.Bot):
     def __init__(self, test_guild: int=None) -> None:
         self.test_guild = test_guild
 
+        # Set once close() has started saving and closing everything, which is only done once even if it's called again
+        self._tearing_down = False
+
         super().__init__(command_prefix=commands.when_mentioned, intents=discord.Intents.default())
 
     async def load_extensions(self) -> None:
@@ -63,6 +68,19 @@ class DiscodromeClient(commands.Bot):
         if self.test_guild:
             await self.sync_command_tree()
 
+        if env.GUILD_IDLE_TIMEOUT > 0:
+            self.evict_idle_guilds.start()
+        if env.STORAGE_COMPACT_INTERVAL > 0:
+            self.compact_storage.change_interval(seconds=env.STORAGE_COMPACT_INTERVAL)
+            self.compact_storage.start()
+        if library.enabled():
+            library.open_index()
+            self.refresh_library.change_interval(seconds=env.LIBRARY_REFRESH_INTERVAL)
+            self.refresh_library.start()
+        if env.STATS_LOG_INTERVAL > 0:
+            self.log_stats.change_interval(seconds=env.STATS_LOG_INTERVAL)
+            self.log_stats.start()
+
     async def on_ready(self) -> None:
         ''' Event called when the client is done preparing. '''
 
@@ -71,20 +89,86 @@ class DiscodromeClient(commands.Bot):
 
         logger.info("Logged as: %s | Connected Guilds: %s | Loaded Extensions: %s", self.user, len(self.guilds), list(self.extensions))
 
+    @tasks.loop(minutes=1)
+    async def evict_idle_guilds(self) -> None:
+        ''' Unloads the data of guilds that have been idle for too long, so it doesn't pile up across thousands of guilds. '''
+
+        playing = {voice_client.guild.id for voice_client in self.voice_clients if voice_client.is_playing()}
+        evicted = await data.evict_idle_guilds(env.GUILD_IDLE_TIMEOUT, busy=playing)
+        if evicted:
+            logger.info("Unloaded %d idle guilds.", evicted)
+
+    @tasks.loop(hours=1)
+    async def compact_storage(self) -> None:
+        ''' Removes guilds left with nothing but defaults from the guild store, and reclaims the space they used. '''
+
+        # The first iteration runs straight away, while the store was only just opened
+        if self.compact_storage.current_loop == 0:
+            return
+        await data.compact_storage()
+
+    @tasks.loop(hours=1)
+    async def refresh_library(self) -> None:
+        ''' Brings the local library index up to date, crawling the whole library on the first run. '''
+
+        try:
+            await library.refresh()
+        except Exception as err:
+            logger.error("Failed to refresh the library index.", exc_info=err)
+
+    @tasks.loop(minutes=5)
+    async def log_stats(self) -> None:
+        ''' Logs the counters kept by the caches and connection pool, the gaps between tracks and the memory used by loaded guilds, when debug logging is enabled. '''
+
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+        logger.debug("Metadata cache: %s | Coalesced requests: %s | Connection pool: %s", cache_stats(), inflight_stats(), pool_stats())
+        logger.debug("Gaps between tracks: %s", player.inter_track_gap_stats())
+
+        guilds = data.guild_memory_stats()
+        if guilds:
+            largest = max(guilds, key=lambda guild_id: guilds[guild_id]["bytes"])
+            logger.debug("Loaded guilds: %d | Approximate memory: %d bytes | Largest: %s %s",
+                         len(guilds), sum(guild["bytes"] for guild in guilds.values()), largest, guilds[largest])
+
+    async def close(self) -> None:
+        ''' Saves guild data and closes the library index and the Subsonic connection pool, then closes the connection to Discord.
+
+        The teardown comes first, since the runner only waits for discord.py's own close to finish; anything after it would be cancelled on exit. '''
+
+        if not self._tearing_down:
+            self._tearing_down = True
+            self.evict_idle_guilds.cancel()
+            self.compact_storage.cancel()
+            self.refresh_library.cancel()
+            self.log_stats.cancel()
+            await data.close_storage()
+            library.close_index()
+            await close_session()
+            logger.debug("Subsonic connection pool closed. Pool stats: %s", pool_stats())
+        await super().close()
+
+
+def exit_handler(client: DiscodromeClient) -> None:
+    ''' Function ran on application exit. '''
+    logger.debug("Beginning graceful shutdown...")
+
+    # The client's loop only exists once it has started; before that, discord.py puts a placeholder in its place and there is nothing to close
+    loop = client.loop
+    if not isinstance(loop, asyncio.AbstractEventLoop) or loop.is_closed():
+        raise SystemExit(0)
+
+    # Signal handlers run on the event loop's thread, so the client is closed by scheduling it on the loop
+    asyncio.run_coroutine_threadsafe(client.close(), loop)
+
 if __name__ == "__main__":
     log_level = logging._nameToLevel.get(env.LOG_LEVEL.upper(), logging.INFO) if env.LOG_LEVEL else logging.INFO
     logs.setup_logging(main_log_level=log_level, file_log_level=log_level, stream_log_level=log_level)
-    data.load_guild_properties_from_disk()
+    data.open_storage()
     client = DiscodromeClient(test_guild=env.DISCORD_TEST_GUILD)
-    client.run(env.DISCORD_BOT_TOKEN, log_handler=None)
 
+    # Register the exit handler
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit_handler(client))
 
-def exit_handler(signum, frame):
-    ''' Function ran on application exit. '''
-    logger.debug("Beginning graceful shutdown...")
-    data.save_guild_properties_to_disk()
-    run(close_session())
+    client.run(env.DISCORD_BOT_TOKEN, log_handler=None)
     logger.info("Discodrome shutdown complete.")
-
-# Register the exit handler
-signal.signal(signal.SIGTERM, exit_handler)
\ No newline at end of file
@@ -1,16 +1,18 @@
+import asyncio
 import discord
 import logging
 from discord import app_commands
 from discord.ext import commands
 
-from random import randint 
+import autocomplete
 import data
-import copy
 import subsonic
 import ui
 from asyncio import sleep
+from contextlib import aclosing
 
 from discodrome import DiscodromeClient
+from util import env
 
 logger = logging.getLogger(__name__)
 
@@ -64,7 +66,7 @@ class MusicCog(commands.Cog):
         if query is None:
 
             # Display error if queue is empty & autoplay is disabled
-            if player.queue == [] and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE:
+            if not player.queue and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE:
                 return await ui.ErrMsg.queue_is_empty(interaction)
 
             # Begin playback of queue
@@ -111,6 +113,12 @@ class MusicCog(commands.Cog):
 
         await player.play_audio_queue(interaction, voice_client)
 
+    @play.autocomplete("query")
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest tracks or albums, depending on the chosen query type, as the query is typed '''
+        kind = "album" if interaction.namespace.querytype == "album" else "track"
+        return await autocomplete.suggest(kind, current, interaction.user.id)
+
     @play.error
     async def play_error(self, ctx, error):
         if isinstance(error, subsonic.APIError):
@@ -138,11 +146,14 @@ class MusicCog(commands.Cog):
             await ui.ErrMsg.bot_not_in_voice_channel(interaction)
             return
 
-        # Stop playback
+        # Stop playback, discarding the track prepared to play next and any songs still being added
+        player.cancel_loading()
+        player.cancel_prefetch()
         voice_client.stop()
 
         # Add current song back to the queue if exists
-        player.queue.insert(0, player.current_song)
+        if player.current_song is not None:
+            player.queue.appendleft(player.current_song)
         player.current_song = None
 
         # Display disconnect confirmation
@@ -155,35 +166,11 @@ class MusicCog(commands.Cog):
 
     @app_commands.command(name="queue", description="View the current queue")
     async def show_queue(self, interaction: discord.Interaction) -> None:
-        ''' Show the current queue '''
-
-        # Get the audio queue for the current guild
-        queue = data.guild_data(interaction.guild_id).player.queue
-
-        # Create a string to store the output of our queue
-        output = ""
-
-        # Add currently playing song to output if available
-        if data.guild_data(interaction.guild_id).player.current_song is not None:
-            song = data.guild_data(interaction.guild_id).player.current_song
-            output += f"**Now Playing:**\n{song.title} - *{song.artist}*\n{song.album} ({song.duration_printable})\n\n"
+        ''' Show the current queue, a page at a time '''
 
-        # Loop over our queue, adding each song into our output string
-        for i, song in enumerate(queue):
-            strtoadd = f"{i+1}. **{song.title}** - *{song.artist}*\n{song.album} ({song.duration_printable})\n\n"
-            if len(output+strtoadd) < 4083:
-                output += strtoadd
-            else:
-                remaining = len(queue) - i
-                output += f"**And {remaining} more...**"
-                break
-
-        # Check if our output string is empty & update it accordingly
-        if output == "":
-            output = "Queue is empty!"
-
-        # Show the user their queue
-        await ui.SysMsg.msg(interaction, "Queue", output)
+        guild_id = interaction.guild_id
+        view = ui.QueueView(lambda: data.guild_data(guild_id).player)
+        await view.send(interaction)
 
     @show_queue.error
     async def show_queue_error(self, ctx, error):
@@ -193,8 +180,11 @@ class MusicCog(commands.Cog):
     @app_commands.command(name="clear", description="Clear the current queue")
     async def clear_queue(self, interaction: discord.Interaction) -> None:
         '''Clear the queue'''
-        queue = data.guild_data(interaction.guild_id).player.queue
-        queue.clear()
+        player = data.guild_data(interaction.guild_id).player
+
+        # Stop adding songs that are still loading, so they don't refill the queue
+        player.cancel_loading()
+        player.queue.clear()
 
         # Let the user know that the queue has been cleared
         await ui.SysMsg.queue_cleared(interaction)
@@ -249,6 +239,11 @@ class MusicCog(commands.Cog):
             case "similar":
                 data.guild_properties(interaction.guild_id).autoplay_mode = data.AutoplayMode.SIMILAR
 
+        # Start buffering songs for the new mode straight away
+        player = data.guild_data(interaction.guild_id).player
+        seed_id = player.current_song.song_id if player.current_song is not None else None
+        player.autoplay_buffer.prefill(data.guild_properties(interaction.guild_id).autoplay_mode, seed_id)
+
         # Display message indicating new status of autoplay
         if mode.value == "none":
             await ui.SysMsg.msg(interaction, f"Autoplay disabled by {interaction.user.display_name}")
@@ -262,7 +257,6 @@ class MusicCog(commands.Cog):
         if voice_client:
             logger.debug(f"Is playing: {voice_client.is_playing()}")
         if voice_client is not None and not voice_client.is_playing():        
-            player = data.guild_data(interaction.guild_id).player
 
             logger.debug(f"Queue: {player.queue}")
             try:
@@ -282,16 +276,41 @@ class MusicCog(commands.Cog):
             logging.error(f"An error occurred while toggling autoplay: {error}")
             await ui.ErrMsg.msg(ctx, f"An unknown error has occurred and has been logged to console. Please contact an administrator. {error}")
 
+    @app_commands.command(name="replaygain", description="Sets how track volume is normalized")
+    @app_commands.describe(mode="Determines which ReplayGain values to normalize volume with")
+    @app_commands.choices(mode=[
+        app_commands.Choice(name="Off", value="none"),
+        app_commands.Choice(name="Track", value="track"),
+        app_commands.Choice(name="Album", value="album"),
+    ])
+    async def replaygain(self, interaction: discord.Interaction, mode: app_commands.Choice[str]) -> None:
+        ''' Sets the ReplayGain mode '''
+
+        match mode.value:
+            case "none":
+                data.guild_properties(interaction.guild_id).replaygain_mode = data.ReplayGainMode.NONE
+            case "track":
+                data.guild_properties(interaction.guild_id).replaygain_mode = data.ReplayGainMode.TRACK
+            case "album":
+                data.guild_properties(interaction.guild_id).replaygain_mode = data.ReplayGainMode.ALBUM
+
+        # The next track may already have been prepared with the previous gain
+        data.guild_data(interaction.guild_id).player.cancel_prefetch()
+
+        await ui.SysMsg.msg(interaction, f"Volume normalization set by {interaction.user.display_name}", f"ReplayGain mode: **{mode.name}**")
+
+    @replaygain.error
+    async def replaygain_error(self, ctx, error):
+        logging.error(f"An error occurred while setting the ReplayGain mode: {error}")
+        await ui.ErrMsg.msg(ctx, f"An unknown error has occurred and has been logged to console. Please contact an administrator. {error}")
+
     @app_commands.command(name="shuffle", description="Shuffles the current queue")
     async def shuffle(self, interaction: discord.Interaction):
         ''' Randomize current queue using Fisher-Yates algorithm '''
-        temporaryqueue = copy.deepcopy(data.guild_data(interaction.guild_id).player.queue)
-        shuffledqueue = []
-        while len(temporaryqueue) > 0:
-            randomindex = randint(0, len(temporaryqueue) - 1)
-            shuffledqueue.append(temporaryqueue.pop(randomindex))
-        
-        data.guild_data(interaction.guild_id).player.queue = shuffledqueue
+        queue = data.guild_data(interaction.guild_id).player.queue
+
+        # Huge queues are shuffled lazily, only putting songs in order as they are played or shown
+        queue.shuffle(lazy=0 < env.LAZY_SHUFFLE_MIN_SONGS <= len(queue))
         await ui.SysMsg.msg(interaction, "Queue shuffled!")
 
     @shuffle.error
@@ -310,24 +329,52 @@ class MusicCog(commands.Cog):
         # Get the guild's player
         player = data.guild_data(interaction.guild_id).player
 
-        # Send our query to the subsonic API and retrieve list of albums in artist's discography
-        albums = await subsonic.get_artist_discography(artist)
-        if albums == None:
+        # Loading a discography can take longer than Discord waits for a response
+        await interaction.response.defer()
+
+        # Send our query to the subsonic API and retrieve the list of albums in the artist's discography
+        albums = await subsonic.get_artist_albums(artist)
+        if not albums:
             await ui.ErrMsg.msg(interaction, f"No discography found for **{artist}**.")
             return
-        
-        # Add all songs from the artist's discography to the queue
-        for album in albums:
-            for song in album.songs:
-                player.queue.append(song)
-        
-        # Display a message that discography was added to the queue
-        await ui.SysMsg.added_discography_to_queue(interaction, artist, albums)
 
-        # Begin playback of queue
-        await player.play_audio_queue(interaction, voice_client)
+        # Albums are queued in the background as they load, until they run out or /clear or /stop cancel loading
+        load = player.start_loading(self.load_discography(interaction, voice_client, artist, albums))
+        try:
+            await load
+        except asyncio.CancelledError:
+            # Only a cancelled load is expected, rather than this command itself being cancelled
+            if asyncio.current_task().cancelling():
+                raise
 
-        
+    async def load_discography(self, interaction: discord.Interaction, voice_client: discord.VoiceClient, artist: str, albums: list[dict]) -> None:
+        ''' Adds a discography to the queue an album at a time, in release order, starting playback as soon as the first album is in '''
+
+        player = data.guild_data(interaction.guild_id).player
+        progress = ui.DiscographyProgress(interaction, artist, len(albums))
+
+        try:
+            async with aclosing(subsonic.stream_albums(albums)) as loaded_albums:
+                async for album in loaded_albums:
+                    player.queue.extend(album.songs)
+                    await progress.add(album)
+
+                    # Begin playback of the queue; shielded so that cancelling the load doesn't interrupt a song starting
+                    if len(progress.albums) == 1:
+                        await asyncio.shield(player.play_audio_queue(interaction, voice_client))
+        except asyncio.CancelledError:
+            await progress.finish(cancelled=True)
+            raise
+
+        if not progress.albums:
+            await ui.ErrMsg.msg(interaction, f"No discography found for **{artist}**.")
+            return
+        await progress.finish()
+
+    @disco.autocomplete("artist")
+    async def disco_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest artists as their name is typed '''
+        return await autocomplete.suggest("artist", current, interaction.user.id)
 
     @disco.error
     async def disco_error(self, ctx, error):
@@ -360,6 +407,8 @@ class MusicCog(commands.Cog):
                 # Disconnect the bot and clear the queue
                 await voice_client.disconnect()
                 player = data.guild_data(member.guild.id).player
+                player.cancel_loading()
+                player.cancel_prefetch()
                 player.queue.clear()
                 player.current_song = None
                 logger.info("The bot has disconnected and cleared the queue as there are no users in the voice channel.")
@@ -0,0 +1,421 @@
+''' An optional local full-text index of the Subsonic library, so searches are answered without asking the server '''
+
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from subsonic import SUBSONIC_REQUEST_PARAMS, Album, Song, check_subsonic_error, get_json, set_local_index
+from util import env
+
+logger = logging.getLogger(__name__)
+
+# Albums requested per page while crawling the library
+CRAWL_PAGE_SIZE = 500
+
+# The whole library is crawled again this often, to notice albums removed from the server
+FULL_CRAWL_INTERVAL = 7 * 24 * 60 * 60
+
+# Matches ranked per search. FTS5's own ranking counts every row holding each word of the query, which takes milliseconds
+# for common words, so the first matches found are ranked here instead
+SEARCH_CANDIDATES = 64
+
+# Version 2 stopped songs that were replaced from being left behind in the search table, which is rebuilt once to clear them
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS artists (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS albums (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        cover_id TEXT NOT NULL,
+        song_count INTEGER NOT NULL,
+        duration INTEGER NOT NULL,
+        year INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS songs (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT UNIQUE NOT NULL,
+        album_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        album TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        cover_id TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        suffix TEXT NOT NULL,
+        track_gain REAL,
+        album_gain REAL,
+        track_peak REAL,
+        album_peak REAL
+    );
+    CREATE INDEX IF NOT EXISTS songs_album ON songs (album_id, position);
+
+    CREATE VIRTUAL TABLE IF NOT EXISTS artists_fts USING fts5(name, content='artists', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+    CREATE VIRTUAL TABLE IF NOT EXISTS albums_fts USING fts5(name, artist, content='albums', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+    CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(title, album, artist, content='songs', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='1 2 3');
+
+    CREATE TRIGGER IF NOT EXISTS artists_insert AFTER INSERT ON artists BEGIN
+        INSERT INTO artists_fts (rowid, name) VALUES (new.rowid, new.name);
+    END;
+    CREATE TRIGGER IF NOT EXISTS artists_delete AFTER DELETE ON artists BEGIN
+        INSERT INTO artists_fts (artists_fts, rowid, name) VALUES ('delete', old.rowid, old.name);
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_insert AFTER INSERT ON albums BEGIN
+        INSERT INTO albums_fts (rowid, name, artist) VALUES (new.rowid, new.name, new.artist);
+    END;
+    CREATE TRIGGER IF NOT EXISTS albums_delete AFTER DELETE ON albums BEGIN
+        INSERT INTO albums_fts (albums_fts, rowid, name, artist) VALUES ('delete', old.rowid, old.name, old.artist);
+    END;
+    CREATE TRIGGER IF NOT EXISTS songs_insert AFTER INSERT ON songs BEGIN
+        INSERT INTO songs_fts (rowid, title, album, artist) VALUES (new.rowid, new.title, new.album, new.artist);
+    END;
+    CREATE TRIGGER IF NOT EXISTS songs_delete AFTER DELETE ON songs BEGIN
+        INSERT INTO songs_fts (songs_fts, rowid, title, album, artist) VALUES ('delete', old.rowid, old.title, old.album, old.artist);
+    END;
+"""
+
+_SONG_COLUMNS = "id, title, album, artist, cover_id, duration, suffix, track_gain, album_gain, track_peak, album_peak"
+
+
+def match_expression(query: str, *, prefix: bool=True) -> str:
+    ''' Turns a user's query into an FTS5 query matching every word, the last of which may be incomplete if `prefix` is set.
+    Returns `None` if the query has no words '''
+
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + ("*" if prefix else "")
+
+def _words(text: str) -> list[str]:
+    return re.findall(r"\w+", text.casefold())
+
+def rank_matches(query: str, rows: list[tuple], name_column: int) -> list[tuple]:
+    ''' Orders matches by how closely their name matches a query: the same name first, then names starting with the query,
+    then names containing it, then the rest; shorter names first within each '''
+
+    phrase = " ".join(_words(query))
+
+    def score(row: tuple) -> tuple[int, int]:
+        name = " ".join(_words(row[name_column]))
+        if name == phrase:
+            return 0, len(name)
+        if name.startswith(phrase):
+            return 1, len(name)
+        return (2 if phrase in name else 3), len(name)
+
+    return sorted(rows, key=score)
+
+def _song_json(row: tuple) -> dict:
+    ''' Rebuilds the json object of a song, as the Subsonic API would return it, from a row of the index '''
+
+    song_id, title, album, artist, cover_id, duration, suffix, track_gain, album_gain, track_peak, album_peak = row
+    song = {"id": song_id, "title": title, "album": album, "artist": artist, "coverArt": cover_id, "duration": duration, "suffix": suffix}
+    replay_gain = {name: value for name, value in (("trackGain", track_gain), ("albumGain", album_gain), ("trackPeak", track_peak), ("albumPeak", album_peak))
+                   if value is not None}
+    if replay_gain:
+        song["replayGain"] = replay_gain
+    return song
+
+
+class LibraryIndex():
+    ''' An SQLite FTS5 index of every artist, album and song in the library.
+
+    Searches are run on the event loop through their own connection, as they take well under a millisecond; crawls write
+    through another connection from worker threads. '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._reader: sqlite3.Connection = None
+        self._writer: sqlite3.Connection = None
+        self._write_lock = threading.Lock()
+        self._ready = False
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def is_open(self) -> bool:
+        ''' Whether the index is open '''
+        return self._reader is not None
+
+    @property
+    def ready(self) -> bool:
+        ''' Whether the whole library has been crawled at least once, so a search that finds nothing really means there's nothing to find '''
+        return self._ready and self.is_open
+
+    @property
+    def last_full_crawl(self) -> float:
+        ''' When the library was last crawled in full, as a unix timestamp, or `None` if it never was '''
+
+        row = self._reader.execute("SELECT value FROM meta WHERE key = 'last_full_crawl'").fetchone()
+        return row[0] if row is not None else None
+
+    def open(self) -> None:
+        ''' Opens the index, creating it if needed '''
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._writer = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.executescript(_SCHEMA)
+        if self._writer.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._writer.execute("INSERT INTO songs_fts (songs_fts) VALUES ('rebuild')")
+            self._writer.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self._reader = sqlite3.connect(self.path, isolation_level=None)
+        self._ready = self.last_full_crawl is not None
+        logger.debug("Opened library index '%s'.", self.path)
+
+    def close(self) -> None:
+        ''' Closes the index '''
+
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' The number of indexed songs, albums and artists, and how many searches found something locally '''
+
+        counts = {table: self._reader.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("songs", "albums", "artists")}
+        return counts | {"hits": self.hits, "misses": self.misses}
+
+    def search_songs(self, query: str, limit: int=1, *, incomplete: bool=False) -> list[Song]:
+        ''' The songs best matching a query. If `incomplete`, the last word of the query is matched as the start of a word '''
+
+        rows = self._match(f"""
+            SELECT {', '.join('songs.' + column for column in _SONG_COLUMNS.split(', '))} FROM songs_fts
+            JOIN songs ON songs.rowid = songs_fts.rowid
+            WHERE songs_fts MATCH ? LIMIT ?
+        """, query, incomplete=incomplete)
+        return [Song.from_json(_song_json(row)) for row in rank_matches(query, rows, 1)[:limit]]
+
+    def search_album(self, query: str) -> Album:
+        ''' The album best matching a query, with all its songs, or `None` if nothing matches '''
+
+        rows = self._match("""
+            SELECT albums.id, albums.name, albums.artist, albums.cover_id, albums.song_count, albums.duration, albums.year FROM albums_fts
+            JOIN albums ON albums.rowid = albums_fts.rowid
+            WHERE albums_fts MATCH ? LIMIT ?
+        """, query)
+        if not rows:
+            return None
+
+        album_id, name, artist, cover_id, song_count, duration, year = rank_matches(query, rows, 1)[0]
+        songs = self._reader.execute(f"SELECT {_SONG_COLUMNS} FROM songs WHERE album_id = ? ORDER BY position", (album_id,)).fetchall()
+        return Album({"id": album_id, "name": name, "artist": artist, "coverArt": cover_id, "songCount": song_count,
+                      "duration": duration, "year": year, "song": [_song_json(song) for song in songs]})
+
+    def search_albums(self, query: str, limit: int=1, *, incomplete: bool=False) -> list[tuple[str, str, str]]:
+        ''' The (id, name, artist) of the albums best matching a query, without their songs. If `incomplete`, the last word of the
+        query is matched as the start of a word '''
+
+        rows = self._match("""
+            SELECT albums.id, albums.name, albums.artist FROM albums_fts
+            JOIN albums ON albums.rowid = albums_fts.rowid
+            WHERE albums_fts MATCH ? LIMIT ?
+        """, query, incomplete=incomplete)
+        return rank_matches(query, rows, 1)[:limit]
+
+    def search_artists(self, query: str, limit: int=1, *, incomplete: bool=False) -> list[tuple[str, str]]:
+        ''' The (id, name) of the artists best matching a query. If `incomplete`, the last word of the query is matched as the start of a word '''
+
+        rows = self._match("""
+            SELECT artists.id, artists.name FROM artists_fts
+            JOIN artists ON artists.rowid = artists_fts.rowid
+            WHERE artists_fts MATCH ? LIMIT ?
+        """, query, incomplete=incomplete)
+        return rank_matches(query, rows, 1)[:limit]
+
+    def album_ids(self) -> set[str]:
+        ''' The ids of every indexed album. Runs in a worker thread '''
+
+        with self._write_lock:
+            return {row[0] for row in self._writer.execute("SELECT id FROM albums")}
+
+    def write_albums(self, albums: list[dict]) -> None:
+        ''' Adds or replaces albums, as returned by `getAlbum`, along with their songs and artists. Runs in a worker thread '''
+
+        with self._write_lock:
+            connection = self._writer
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for album in albums:
+                    self._delete_album(album["id"])
+                    songs = album.get("song", [])
+                    connection.execute(
+                        "INSERT INTO albums (id, name, artist, cover_id, song_count, duration, year) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (album["id"], album.get("name", "Unknown Album"), album.get("artist", "Unknown Artist"), album.get("coverArt", ""),
+                         album.get("songCount", len(songs)), album.get("duration", 0), album.get("year", 0)),
+                    )
+                    if album.get("artistId"):
+                        connection.execute("INSERT OR IGNORE INTO artists (id, name) VALUES (?, ?)", (album["artistId"], album.get("artist", "Unknown Artist")))
+
+                    rows = []
+                    for position, song in enumerate(songs):
+                        replay_gain = song.get("replayGain") or {}
+                        rows.append((song["id"], album["id"], position, song.get("title", "Unknown Track"), song.get("album", "Unknown Album"),
+                                     song.get("artist", "Unknown Artist"), song.get("coverArt", ""), song.get("duration", 0), song.get("suffix", ""),
+                                     replay_gain.get("trackGain"), replay_gain.get("albumGain"), replay_gain.get("trackPeak"), replay_gain.get("albumPeak")))
+                    # A song listed on two albums is kept on the one written last. It is deleted outright rather than replaced,
+                    # as a REPLACE doesn't fire the delete trigger that takes it out of the search table
+                    connection.executemany("DELETE FROM songs WHERE id = ?", [(row[0],) for row in rows])
+                    connection.executemany(f"""
+                        INSERT INTO songs (id, album_id, position, {_SONG_COLUMNS.removeprefix('id, ')})
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def remove_albums(self, album_ids: set[str]) -> None:
+        ''' Removes albums and their songs, along with artists left without albums. Runs in a worker thread '''
+
+        with self._write_lock:
+            connection = self._writer
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                for album_id in album_ids:
+                    self._delete_album(album_id)
+                connection.execute("DELETE FROM artists WHERE name NOT IN (SELECT artist FROM albums)")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def set_last_full_crawl(self, timestamp: float) -> None:
+        ''' Records when the library was last crawled in full. Runs in a worker thread '''
+
+        with self._write_lock:
+            self._writer.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_full_crawl', ?)", (timestamp,))
+        self._ready = True
+
+    def _match(self, sql: str, query: str, *, incomplete: bool=False) -> list[tuple]:
+        ''' Runs a search matching every word of a query whole, then, if nothing matched, with the last word as a prefix.
+        An `incomplete` query is only matched with the last word as a prefix '''
+
+        rows = []
+        if match_expression(query) is not None:
+            for prefix in ((True,) if incomplete else (False, True)):
+                rows = self._reader.execute(sql, (match_expression(query, prefix=prefix), SEARCH_CANDIDATES)).fetchall()
+                if rows:
+                    break
+
+        if rows:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return rows
+
+    def _delete_album(self, album_id: str) -> None:
+        ''' Deletes an album and its songs. Called with the write lock held, within a transaction '''
+        self._writer.execute("DELETE FROM songs WHERE album_id = ?", (album_id,))
+        self._writer.execute("DELETE FROM albums WHERE id = ?", (album_id,))
+
+
+index = LibraryIndex(env.LIBRARY_INDEX_PATH)
+
+# Crawls are never run concurrently
+_crawl_lock = asyncio.Lock()
+
+
+def enabled() -> bool:
+    ''' Whether the library is indexed at all '''
+    return env.LIBRARY_INDEX
+
+def open_index() -> None:
+    ''' Opens the library index, so searches are answered from it once it has been filled '''
+
+    index.open()
+    set_local_index(index)
+
+def close_index() -> None:
+    ''' Closes the library index, sending every search to the server again '''
+
+    set_local_index(None)
+    index.close()
+
+async def _get_album_json(album_id: str) -> dict:
+    ''' Requests an album and its songs, bypassing the metadata cache so a crawl doesn't flush it '''
+
+    album_data = await get_json("getAlbum", SUBSONIC_REQUEST_PARAMS | {"id": album_id}, cache=False)
+    if await check_subsonic_error(album_data):
+        return None
+    return album_data["subsonic-response"]["album"]
+
+async def refresh() -> None:
+    ''' Brings the index up to date with the server.
+
+    The whole library is crawled when the index is new or hasn't been crawled in full for `FULL_CRAWL_INTERVAL`. Otherwise only albums
+    added since the last refresh are fetched, by paging through the newest albums until a page holds nothing new. '''
+
+    async with _crawl_lock:
+        last_full_crawl = index.last_full_crawl
+        full = last_full_crawl is None or time.time() - last_full_crawl > FULL_CRAWL_INTERVAL
+        known = await asyncio.to_thread(index.album_ids)
+        seen: set[str] = set()
+        semaphore = asyncio.Semaphore(max(1, env.SUBSONIC_MAX_CONCURRENCY))
+        start = time.perf_counter()
+        written = 0
+
+        async def fetch_album(album_id: str) -> dict:
+            async with semaphore:
+                return await _get_album_json(album_id)
+
+        offset = 0
+        while True:
+            params = SUBSONIC_REQUEST_PARAMS | {"type": "alphabeticalByName" if full else "newest", "size": CRAWL_PAGE_SIZE, "offset": offset}
+            page_data = await get_json("getAlbumList2", params, cache=False)
+            if await check_subsonic_error(page_data):
+                return
+            page = page_data["subsonic-response"].get("albumList2", {}).get("album", [])
+            if not page:
+                break
+
+            album_ids = [album["id"] for album in page]
+            seen.update(album_ids)
+            # A full crawl fetches every album again, as their songs may have changed
+            to_fetch = album_ids if full else [album_id for album_id in album_ids if album_id not in known]
+            if not full and not to_fetch:
+                break
+
+            results = await asyncio.gather(*(fetch_album(album_id) for album_id in to_fetch), return_exceptions=True)
+            albums = []
+            for album_id, result in zip(to_fetch, results):
+                if isinstance(result, BaseException):
+                    logger.warning("Skipping album '%s' while indexing the library: %s", album_id, result)
+                elif result is not None:
+                    albums.append(result)
+            await asyncio.to_thread(index.write_albums, albums)
+            written += len(albums)
+
+            if len(page) < CRAWL_PAGE_SIZE:
+                break
+            offset += CRAWL_PAGE_SIZE
+
+        if full:
+            removed = known - seen
+            if removed:
+                await asyncio.to_thread(index.remove_albums, removed)
+            await asyncio.to_thread(index.set_last_full_crawl, time.time())
+
+        logger.info("%s the library index in %.1fs, writing %d albums.", "Rebuilt" if full else "Refreshed", time.perf_counter() - start, written)
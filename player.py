@@ -2,55 +2,190 @@
 
 import asyncio
 import discord
+import time
 
+from typing import Callable, Coroutine, Iterable
+
+import audiocache
 import data
 import ui
 import logging
 
-from subsonic import Song, APIError, get_random_songs, get_similar_songs, stream
+from autoplay import AutoplayBuffer
+from songqueue import SongQueue
+from subsonic import Song, APIError, get_album_art, probe_stream, probed_content_type, stream_url
+from transcoder import Priority, create_source
+from util import env
 
 logger = logging.getLogger(__name__)
 
-# Default player data
-_default_data: dict[str, any] = {
-    "current-song": None,
-    "current-position": 0,
-    "queue": [],
+# Silence between one track ending and the next one starting, across every guild
+inter_track_gaps: dict[str, float] = {
+    "count": 0,
+    "total": 0.0,
+    "max": 0.0,
+    "last": 0.0,
 }
 
+def record_inter_track_gap(seconds: float) -> None:
+    ''' Records the silence between two consecutive tracks '''
+
+    inter_track_gaps["count"] += 1
+    inter_track_gaps["total"] += seconds
+    inter_track_gaps["max"] = max(inter_track_gaps["max"], seconds)
+    inter_track_gaps["last"] = seconds
+    logger.debug("Inter-track gap: %.3fs", seconds)
+
+def inter_track_gap_stats() -> dict[str, float]:
+    ''' The number of track transitions, and the average, longest and latest gap between tracks in seconds '''
+
+    count = inter_track_gaps["count"]
+    return {
+        "count": count,
+        "average": inter_track_gaps["total"] / count if count else 0.0,
+        "max": inter_track_gaps["max"],
+        "last": inter_track_gaps["last"],
+    }
+
+# Bitrate used when a voice channel doesn't report one, in kbps
+DEFAULT_BITRATE = 128
+
+# Number of songs at the front of the queue loaded ahead of playing them, when the queue was restored from disk
+HYDRATE_AHEAD = 10
+
+# Content types of streams that contain Opus packets ffmpeg can copy as is
+OPUS_CONTENT_TYPES = frozenset(("audio/ogg", "audio/opus"))
+
+def channel_bitrate(voice_client: discord.VoiceClient) -> int:
+    ''' The bitrate of a voice client's channel, in kbps '''
+
+    channel = getattr(voice_client, "channel", None)
+    bitrate = getattr(channel, "bitrate", None)
+    if not bitrate:
+        return DEFAULT_BITRATE
+    return max(8, min(bitrate // 1000, 512))
+
+def stream_params(bitrate: int) -> dict[str, any]:
+    ''' The stream parameters used to request a song from the server '''
+
+    if not env.OPUS_PASSTHROUGH:
+        return {}
+    # Have the server transcode to what Discord expects, at no more than the voice channel can carry
+    return {"format": "opus", "maxBitRate": bitrate}
+
+def is_opus(song: Song, content_type: str) -> bool:
+    ''' Whether a song streamed with the given content type holds Opus '''
+
+    # An Ogg file served untouched may hold Vorbis rather than Opus
+    return content_type in OPUS_CONTENT_TYPES and song.suffix != "ogg"
+
+# Whether the server honours requests for Opus, as last seen when probing a stream. Until a probe shows that it does, streams are
+# re-encoded, since copying anything other than Opus into the stream sent to Discord would fail outright
+server_sends_opus = False
+
+def expects_opus(song: Song, params: dict[str, any]) -> bool:
+    ''' Whether the server will stream a song as Opus, without making a request: judged from an earlier probe of its stream if
+    there was one, otherwise from the format requested once the server has been seen to honour it, or the song's own file type.
+    When in doubt, the answer is no, so the song is re-encoded rather than copied '''
+
+    content_type = probed_content_type(song.song_id, **params)
+    if content_type is not None:
+        return is_opus(song, content_type)
+    if params.get("format") == "opus" and server_sends_opus:
+        return True
+    return song.suffix == "opus"
+
+def record_probe(params: dict[str, any], content_type: str) -> None:
+    ''' Learns from a probed stream whether the server transcodes to Opus when asked to '''
+
+    global server_sends_opus
+
+    if params.get("format") == "opus" and content_type is not None:
+        server_sends_opus = content_type in OPUS_CONTENT_TYPES
+
+# Volume scales closer to unity than this (about 0.01dB) aren't worth decoding a stream for
+UNITY_GAIN_TOLERANCE = 0.001
+
+def replaygain_scalar(song: Song, mode: "data.ReplayGainMode") -> float:
+    ''' The linear volume scale that normalizes a song, limited so that its peak doesn't clip. `1.0` when no adjustment is needed '''
+
+    if mode is data.ReplayGainMode.NONE:
+        return 1.0
+
+    # Fall back to whichever gain the song does have
+    if (mode is data.ReplayGainMode.ALBUM and song.album_gain is not None) or song.track_gain is None:
+        gain, peak = song.album_gain, song.album_peak
+    else:
+        gain, peak = song.track_gain, song.track_peak
+    if gain is None:
+        return 1.0
+
+    scalar = 10 ** (gain / 20)
+    if peak:
+        scalar = min(scalar, 1 / peak)
+    return 1.0 if abs(scalar - 1) < UNITY_GAIN_TOLERANCE else scalar
+
+def source_options(gain: float, opus: bool) -> tuple[str, str]:
+    ''' The ffmpeg codec and output options for a stream, given its volume scale and whether the server sends it as Opus '''
+
+    if gain != 1.0:
+        return None, f"-filter:a volume={gain:.6f}"
+    # Opus packets are copied into the stream sent to Discord, skipping the decode and encode entirely
+    return ("copy" if opus else None), None
+
 class Player():
     ''' Class that represents an audio player '''
-    def __init__(self) -> None:
-        self._data = _default_data  
+
+    __slots__ = ("_current_song", "_current_position", "_queue", "_player_loop", "_autoplay_buffer",
+                 "_started_at", "_finished_at", "_prefetch_task", "_prefetched_song", "_prefetched_source", "_on_queue_change", "_loading")
+
+    def __init__(self, on_queue_change: Callable[[], None]=None) -> None:
+        self._current_song: Song = None
+        self._current_position: int = 0
+        self._on_queue_change = on_queue_change
+        self._queue: SongQueue = SongQueue()
+        self._queue.on_change = on_queue_change
         self._player_loop = None
+        self._autoplay_buffer = AutoplayBuffer()
+
+        self._started_at: float = None
+        self._finished_at: float = None
+        self._prefetch_task: asyncio.Task = None
+        self._prefetched_song: Song = None
+        self._prefetched_source: discord.AudioSource = None
+
+        # Tasks adding songs to the queue in the background, such as a discography being loaded
+        self._loading: set[asyncio.Task] = set()
 
     @property
     def current_song(self) -> Song:
         '''The current song'''
-        return self._data["current-song"]
+        return self._current_song
 
     @current_song.setter
     def current_song(self, song: Song) -> None:
-        self._data["current-song"] = song
+        self._current_song = song
 
     @property
     def current_position(self) -> int:
         ''' The current position for the current song, in seconds. '''
-        return self._data["current-position"]
+        return self._current_position
 
     @current_position.setter
     def current_position(self, position: int) -> None:
         ''' Set the current position for the current song, in seconds. '''
-        self._data["current-position"] = position
+        self._current_position = position
 
     @property
-    def queue(self) -> list[Song]:
+    def queue(self) -> SongQueue:
         ''' The current audio queue. '''
-        return self._data["queue"]
+        return self._queue
 
     @queue.setter
-    def queue(self, value: list) -> None:
-        self._data["queue"] = value
+    def queue(self, value: Iterable[Song]) -> None:
+        # Queues saved before SongQueue existed are plain lists
+        self._queue = value if isinstance(value, SongQueue) else SongQueue(value)
+        self._queue.on_change = self._on_queue_change
 
     @property
     def player_loop(self) -> asyncio.AbstractEventLoop:
@@ -61,12 +196,73 @@ class Player():
     def player_loop(self, loop: asyncio.AbstractEventLoop) -> None:
         self._player_loop = loop
 
+    @property
+    def autoplay_buffer(self) -> AutoplayBuffer:
+        ''' Songs fetched ahead of time for autoplay '''
+        return self._autoplay_buffer
+
+    @property
+    def loading(self) -> bool:
+        ''' Whether songs are still being added to the queue in the background '''
+        return bool(self._loading)
+
+    def start_loading(self, coro: Coroutine[any, any, None]) -> asyncio.Task:
+        ''' Runs a coroutine that adds songs to the queue in the background, until it finishes or `cancel_loading` is called '''
+
+        task = asyncio.create_task(coro)
+        self._loading.add(task)
+        task.add_done_callback(self._loading.discard)
+        return task
+
+    def cancel_loading(self) -> None:
+        ''' Stops adding songs to the queue in the background, keeping those already added '''
 
+        for task in self._loading:
+            task.cancel()
+        self._loading.clear()
 
 
 
-    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient) -> None:
-        ''' Streams a track from the Subsonic server to a connected voice channel, and updates guild data accordingly '''
+
+
+    async def create_audio_source(self, song: Song, bitrate: int=DEFAULT_BITRATE, replaygain_mode: "data.ReplayGainMode"=None, priority: Priority=Priority.PLAYBACK) -> discord.AudioSource:
+        ''' Starts the ffmpeg process that will stream a song, re-encoding it only when it can't be sent to Discord as is.
+
+        `bitrate` is the voice channel's bitrate, in kbps, and `replaygain_mode` selects the gain used to normalize the song's volume.
+        The process waits its turn behind those of other guilds according to its `priority`. '''
+
+        # The stream url is built locally; if the server can't stream the song, ffmpeg's first read fails and is reported on playback
+        read_timeout = int(env.SUBSONIC_STREAM_TIMEOUT * 1_000_000)
+        before_options = f"-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -rw_timeout {read_timeout}"
+
+        # The gain is worked out from the song's metadata up front, so ffmpeg only filters songs that actually need adjusting
+        gain = replaygain_scalar(song, replaygain_mode or data.ReplayGainMode.NONE)
+        params = stream_params(bitrate)
+        cache_key = audiocache.cache_key(song.song_id, params)
+
+        # Songs that have been played before are read from disk, without any network I/O
+        path, content_type = await audiocache.get_path(cache_key)
+        if path is not None:
+            codec, options = source_options(gain, gain == 1.0 and is_opus(song, content_type))
+            logger.debug("Playing %s from the audio cache (codec: %s, gain: %.3f)", song.title, codec or "libopus", gain)
+            return await create_source(str(path), priority, bitrate=bitrate, codec=codec, options=options)
+
+        # Deciding on the codec never waits on the server, so it adds nothing to the time until the song is heard
+        codec, options = source_options(gain, gain == 1.0 and expects_opus(song, params))
+        url = stream_url(song.song_id, **params)
+        logger.debug("Streaming %s (codec: %s, gain: %.3f, bitrate: %dkbps)", song.title, codec or "libopus", gain, bitrate)
+
+        # The stream is read through a tee that caches it as it plays, feeding ffmpeg through its stdin
+        reader = audiocache.tee(cache_key, url)
+        if reader is not None:
+            return await create_source(reader, priority, pipe=True, bitrate=bitrate, codec=codec, options=options)
+
+        return await create_source(url, priority, bitrate=bitrate, codec=codec, before_options=before_options, options=options)
+
+    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient, audio_src: discord.AudioSource=None) -> None:
+        ''' Streams a track from the Subsonic server to a connected voice channel, and updates guild data accordingly.
+
+        An `audio_src` that was prepared ahead of time can be provided to skip resolving the stream. '''
 
         # Make sure the voice client is available
         if voice_client is None:
@@ -78,16 +274,9 @@ class Player():
             await ui.ErrMsg.already_playing(interaction)
             return
 
-        # Get the stream from the Subsonic server, using the provided song's ID
-        ffmpeg_options = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                           "options": "-filter:a volume=replaygain=track"}
-        try:
-            audio_src = discord.FFmpegOpusAudio(await stream(song.song_id), **ffmpeg_options)
-        except APIError as err:
-            logging.error(f"API Error streaming song, Code {err.errorcode}: {err.message}")
-        # audio_src.read()
-
-        # TODO: Start a duration timer
+        bitrate = channel_bitrate(voice_client)
+        if audio_src is None:
+            audio_src = await self.create_audio_source(song, bitrate, data.guild_properties(interaction.guild_id).replaygain_mode)
 
         # Begin playing the song
         loop = asyncio.get_event_loop()
@@ -96,18 +285,105 @@ class Player():
         # Handle playback finished
         async def playback_finished(error):
             if error:
+                # Includes the server failing to stream or transcode the song, which is only discovered when ffmpeg reads it
                 logging.error(f"An error occurred while playing the audio: {error}")
-                return
-            logger.debug("Playback finished.")
-            asyncio.run_coroutine_threadsafe(self.play_audio_queue(interaction, voice_client), loop)
+                await ui.ErrMsg.msg(interaction, f"Failed to play **{song.title}**.")
+            else:
+                logger.debug("Playback finished.")
+            await self.play_audio_queue(interaction, voice_client)
 
+        def after(error: Exception) -> None:
+            # Called from the audio thread once the source is exhausted
+            self._finished_at = time.perf_counter()
+            asyncio.run_coroutine_threadsafe(playback_finished(error), loop)
 
         try:
-            voice_client.play(audio_src, after=lambda e: loop.create_task(playback_finished(e)))
+            voice_client.play(audio_src, after=after)
         except Exception as err:
             logging.error(f"An error occurred while playing the audio: {err}")
+            audio_src.cleanup()
             return
 
+        # Measure the silence between the previous track ending and this one starting
+        self._started_at = time.perf_counter()
+        if self._finished_at is not None:
+            record_inter_track_gap(self._started_at - self._finished_at)
+            self._finished_at = None
+
+        # Prepare the next track while this one plays
+        self.schedule_prefetch(song, interaction.guild_id, bitrate)
+
+    def schedule_prefetch(self, song: Song, guild_id: int, bitrate: int=DEFAULT_BITRATE) -> None:
+        ''' Starts preparing the track that will follow the given song '''
+
+        self.cancel_prefetch()
+        self._prefetch_task = asyncio.create_task(self._prefetch(song, guild_id, bitrate))
+
+    def cancel_prefetch(self) -> None:
+        ''' Stops preparing the next track and discards anything already prepared '''
+
+        if self._prefetch_task is not None:
+            self._prefetch_task.cancel()
+            self._prefetch_task = None
+        if self._prefetched_source is not None:
+            self._prefetched_source.cleanup()
+        self._prefetched_song = None
+        self._prefetched_source = None
+
+    def _next_song(self, guild_id: int) -> Song:
+        ''' The song expected to play after the current one '''
+
+        if self.queue:
+            return self.queue.peek()
+        if data.guild_properties(guild_id).autoplay_mode is not data.AutoplayMode.NONE:
+            return self.autoplay_buffer.peek()
+        return None
+
+    async def _prefetch(self, current: Song, guild_id: int, bitrate: int) -> None:
+        ''' Warms the next song's cover art and stream straight away, then starts its ffmpeg process shortly before the current song ends '''
+
+        try:
+            next_song = self._next_song(guild_id)
+            if next_song is not None:
+                await get_album_art(next_song.cover_id)
+
+            # Wait until the current song is nearly over
+            remaining = current.duration - (time.perf_counter() - self._started_at) - env.PREFETCH_LEAD_SECONDS
+            await asyncio.sleep(max(0, remaining))
+
+            # The queue may have changed since, so check again which song is next
+            next_song = self._next_song(guild_id)
+            if next_song is None:
+                return
+
+            # Check the song can actually be streamed before committing an ffmpeg process to it, unless it's already on disk.
+            # Done here, off the critical path, this also tells the next source what the server will send
+            params = stream_params(bitrate)
+            if not await audiocache.contains(audiocache.cache_key(next_song.song_id, params)):
+                content_type = await probe_stream(next_song.song_id, **params)
+                if content_type is None:
+                    return
+                record_probe(params, content_type)
+
+            audio_src = await self.create_audio_source(next_song, bitrate, data.guild_properties(guild_id).replaygain_mode, Priority.PREFETCH)
+            self._prefetched_song = next_song
+            self._prefetched_source = audio_src
+            logger.debug("Prefetched next track: %s", next_song.title)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            logger.warning("Failed to prefetch the next track: %s", err)
+
+    def take_prefetched_source(self, song: Song) -> discord.AudioSource:
+        ''' Returns the source prepared for the given song, if there is one, discarding any source prepared for another song '''
+
+        audio_src = None
+        if self._prefetched_song is not None and self._prefetched_song.song_id == song.song_id:
+            audio_src = self._prefetched_source
+            self._prefetched_source = None
+        self.cancel_prefetch()
+        return audio_src
+
 
     async def handle_autoplay(self, interaction: discord.Interaction, prev_song_id: str=None) -> bool:
         ''' Handles populating the queue when autoplay is enabled '''
@@ -118,7 +394,7 @@ class Player():
         logger.debug(f"Autoplay mode: {autoplay_mode}")
         logger.debug(f"Queue: {queue}")
         # If queue is notempty or autoplay is disabled, don't handle autoplay
-        if queue != [] or autoplay_mode is data.AutoplayMode.NONE:
+        if queue or autoplay_mode is data.AutoplayMode.NONE:
             return False
 
         # If there was no previous song provided, we default back to selecting a random song
@@ -126,27 +402,23 @@ class Player():
             autoplay_mode = data.AutoplayMode.RANDOM
             logging.info("No previous song ID provided. Defaulting to random.")
 
-        songs = []
+        song = None
 
+        # Songs are normally already buffered, so this only waits on the server when the buffer has run dry
         try:
-            match autoplay_mode:
-                case data.AutoplayMode.RANDOM:
-                    songs = await get_random_songs(size=1)
-                case data.AutoplayMode.SIMILAR:
-                    logger.debug(f"Prev song ID: {prev_song_id}")
-                    songs = await get_similar_songs(song_id=prev_song_id, count=1)
-
+            logger.debug(f"Prev song ID: {prev_song_id}")
+            song = await self.autoplay_buffer.take(autoplay_mode, prev_song_id)
         except APIError as err:
             logging.error(f"API Error fetching song for autoplay, Code {err.errorcode}: {err.message}")
         
-        logger.debug(f"Autoplay song: {songs}")
+        logger.debug(f"Autoplay song: {song}")
 
         # If there's no match, throw an error
-        if len(songs) == 0:
+        if song is None:
             await ui.ErrMsg.msg(interaction, "Failed to obtain a song for autoplay.")
             return False
         
-        self.queue.append(songs[0])
+        self.queue.append(song)
         return True
 
 
@@ -163,13 +435,22 @@ class Player():
             return
 
 
+        # Songs restored from disk are only loaded as they come up, a few at a time
+        await self.queue.hydrate(0, HYDRATE_AHEAD)
+
         # Check if the queue contains songs
-        if self.queue != []:
+        if self.queue:
             # Pop the first item from the queue and stream the track
-            song = self.queue.pop(0)
+            song = self.queue.popleft()
             self.current_song = song
+
+            # Start buffering autoplay songs while the last queued song plays
+            if not self.queue:
+                self.autoplay_buffer.prefill(data.guild_properties(interaction.guild_id).autoplay_mode, song.song_id)
+
+            # Start the audio before announcing it, so the announcement doesn't add to the gap between tracks
+            await self.stream_track(interaction, song, voice_client, self.take_prefetched_source(song))
             await ui.SysMsg.now_playing(interaction, song)
-            await self.stream_track(interaction, song, voice_client)
         else:
             logger.debug("Queue is empty.")
             logger.debug("Current song: %s", self.current_song)
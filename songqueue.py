@@ -0,0 +1,392 @@
+''' The queue of songs waiting to be played by a guild's player '''
+
+import itertools
+import random
+import struct
+import sys
+
+from array import array
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterable, Iterator
+
+from subsonic import Song, get_songs, loaded_song
+
+# Settling more of a lazy shuffle than this at once is cheaper done by shuffling everything left outright
+_LAZY_SHUFFLE_STEP_LIMIT = 64
+
+# Every queue gets its own serial, which unlike id() is never reused once the queue is gone
+_serials = itertools.count()
+
+# Serialized queues start with a magic number, the format version and the number of songs
+_HEADER = struct.Struct("<4sBI")
+_MAGIC = b"DSQ\x00"
+FORMAT_VERSION = 2
+
+# From version 2, the header is followed by the range of positions still waiting on a lazy shuffle
+_SHUFFLE_RANGE = struct.Struct("<II")
+
+
+def pack_song_ids(song_ids: list[str], shuffled: tuple[int, int]=(0, 0)) -> bytes:
+    ''' Serializes a queue as the ids of its songs: a header, the range still to be lazily shuffled, a column of id lengths,
+    then the ids back to back '''
+
+    encoded = [song_id.encode() for song_id in song_ids]
+    lengths = array("H", map(len, encoded))
+    if sys.byteorder == "big":
+        lengths.byteswap()
+    return (_HEADER.pack(_MAGIC, FORMAT_VERSION, len(encoded)) + _SHUFFLE_RANGE.pack(*shuffled)
+            + lengths.tobytes() + b"".join(encoded))
+
+def is_packed(blob: bytes) -> bool:
+    ''' Whether the data was written by `pack_song_ids` '''
+    return blob[:len(_MAGIC)] == _MAGIC
+
+def unpack_song_ids(blob: bytes) -> list[str]:
+    ''' Reads the song ids serialized by `pack_song_ids` '''
+    return unpack_queue(blob)[0]
+
+def unpack_queue(blob: bytes) -> tuple[list[str], tuple[int, int]]:
+    ''' Reads the song ids serialized by `pack_song_ids`, and the range of them still to be lazily shuffled '''
+
+    magic, version, count = _HEADER.unpack_from(blob)
+    if magic != _MAGIC:
+        raise ValueError("Not a serialized queue")
+    if version not in (1, FORMAT_VERSION):
+        raise ValueError(f"Unsupported queue format version {version}")
+
+    start = _HEADER.size
+    shuffled = (0, 0)
+    if version >= 2:
+        shuffled = _SHUFFLE_RANGE.unpack_from(blob, start)
+        start += _SHUFFLE_RANGE.size
+
+    offset = start + 2 * count
+    lengths = array("H", blob[start:offset])
+    if sys.byteorder == "big":
+        lengths.byteswap()
+
+    song_ids = []
+    data = memoryview(blob)
+    for length in lengths:
+        song_ids.append(str(data[offset:offset + length], "utf-8"))
+        offset += length
+    return song_ids, shuffled
+
+
+
+class SongQueue():
+    ''' A double-ended queue of songs, with O(1) pushes and pops at both ends.
+
+    Every change bumps `version`, so anything derived from the queue (such as a rendered page of it, or a saved copy) can
+    tell whether it is out of date without comparing songs. `on_change` is also called, so changes can be reacted to as they happen.
+
+    A lazy shuffle only marks a range of the queue as shuffled; each position is then settled with one Fisher-Yates step the
+    first time something looks at it. Settled positions never change, so the result is the same as an eager shuffle.
+
+    A queue restored from disk holds bare song ids until `hydrate` loads the songs about to be played or shown. Songs read
+    before then are looked up among those already loaded; any that aren't are given as a stand-in knowing only their id, while
+    the queue keeps the id for `hydrate` to load later. '''
+
+    __slots__ = ("_songs", "_serial", "_version", "_settled", "_shuffle_end", "_pending", "on_change")
+
+    def __init__(self, songs: Iterable[Song]=()) -> None:
+        self._songs: deque[Song | str] = deque(songs)
+        self._serial: int = next(_serials)
+        self._version: int = 0
+
+        # The number of songs still held as a bare id
+        self._pending: int = 0
+
+        # Songs in [_settled, _shuffle_end) are waiting on a lazy shuffle
+        self._settled: int = 0
+        self._shuffle_end: int = 0
+
+        # Called with no arguments after every change
+        self.on_change: Callable[[], None] = None
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def __bool__(self) -> bool:
+        return bool(self._songs)
+
+    def __iter__(self) -> Iterator[Song]:
+        self._settle(len(self._songs))
+        if self._pending:
+            return iter([self._resolve(i) for i in range(len(self._songs))])
+        return iter(self._songs)
+
+    def __getitem__(self, index: int | slice) -> Song | list[Song]:
+        if isinstance(index, slice):
+            return self.slice(index.start, index.stop, index.step)
+        self._settle((index if index >= 0 else len(self._songs) + index) + 1)
+        return self._resolve(index)
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + self._songs.__sizeof__()
+
+    def __repr__(self) -> str:
+        return f"SongQueue({len(self._songs)} songs, version {self._version})"
+
+    def __getstate__(self) -> dict[str, any]:
+        self._settle(len(self._songs))
+        return {"songs": list(self._songs)}
+
+    def __setstate__(self, state: dict[str, any]) -> None:
+        self._songs = deque(state["songs"])
+        self._serial = next(_serials)
+        self._version = 0
+        self._pending = sum(1 for song in self._songs if isinstance(song, str))
+        self._settled = 0
+        self._shuffle_end = 0
+        self.on_change = None
+
+    @classmethod
+    def from_song_ids(cls, song_ids: Iterable[str], shuffled: tuple[int, int]=(0, 0)) -> "SongQueue":
+        ''' Restores a queue from the ids of its songs, without loading any of them yet. `shuffled` is the range of positions
+        that was still waiting on a lazy shuffle, as given by `snapshot` '''
+
+        queue = cls(song_ids)
+        queue._pending = len(queue._songs)
+        start, end = shuffled
+        if start < min(end, len(queue._songs)):
+            queue._settled, queue._shuffle_end = start, min(end, len(queue._songs))
+        return queue
+
+    @property
+    def serial(self) -> int:
+        ''' A number identifying this queue, unique among every queue created while the bot runs '''
+        return self._serial
+
+    @property
+    def version(self) -> int:
+        ''' A counter that increases whenever the queue changes '''
+        return self._version
+
+    @property
+    def lazily_shuffled(self) -> bool:
+        ''' Whether part of the queue is still waiting on a lazy shuffle '''
+        return self._settled < self._shuffle_end
+
+    @property
+    def pending(self) -> int:
+        ''' The number of songs not loaded yet since the queue was restored '''
+        return self._pending
+
+    def unordered(self) -> Iterator[Song | str]:
+        ''' Iterates over the songs without settling a lazy shuffle, so not necessarily in the order they'll be played.
+        Songs not loaded yet are given as their id '''
+        return iter(self._songs)
+
+    def song_ids(self) -> list[str]:
+        ''' The ids of every song in the queue, in order, without loading any of them '''
+
+        self._settle(len(self._songs))
+        return [song if isinstance(song, str) else song.song_id for song in self._songs]
+
+    def snapshot(self) -> tuple[list[str], tuple[int, int]]:
+        ''' The ids of every song as they're currently held, and the range of positions still waiting on a lazy shuffle.
+        Unlike `song_ids`, this leaves a lazy shuffle as it is, so it stays cheap to take however large the queue '''
+        return [song if isinstance(song, str) else song.song_id for song in self._songs], (self._settled, self._shuffle_end)
+
+    async def hydrate(self, start: int, stop: int) -> None:
+        ''' Loads every song between two positions that is still held as an id, in a single batch '''
+
+        if not self._pending:
+            return
+
+        self._settle(stop)
+        song_ids = {song for song in self._window(start, stop) if isinstance(song, str)}
+        if not song_ids:
+            return
+        songs = await get_songs(song_ids)
+
+        # The queue may have changed while waiting, so the songs are put back by id rather than position
+        for i in range(*slice(start, stop).indices(len(self._songs))):
+            entry = self._songs[i]
+            if isinstance(entry, str) and entry in songs:
+                self._songs[i] = songs[entry]
+                self._pending -= 1
+
+    def peek(self) -> Song:
+        ''' The song at the front of the queue, without removing it, or `None` if the queue is empty '''
+
+        if not self._songs:
+            return None
+        self._settle(1)
+        return self._resolve(0)
+
+    def slice(self, start: int=None, stop: int=None, step: int=None) -> list[Song]:
+        ''' The songs between two positions, only walking the queue as far as `stop` '''
+
+        if step is not None and step < 0:
+            return list(self)[start:stop:step]
+        start, stop, step = slice(start, stop, step).indices(len(self._songs))
+        self._settle(stop)
+        if self._pending:
+            return [self._resolve(i) for i in range(start, stop, step)]
+        return self._window(start, stop, step)
+
+    def append(self, song: Song) -> None:
+        ''' Adds a song to the end of the queue '''
+        self._songs.append(song)
+        self._changed()
+
+    def appendleft(self, song: Song) -> None:
+        ''' Adds a song to the front of the queue, to be played next '''
+
+        self._songs.appendleft(song)
+        if self.lazily_shuffled:
+            self._settled += 1
+            self._shuffle_end += 1
+        self._changed()
+
+    def extend(self, songs: Iterable[Song]) -> None:
+        ''' Adds songs to the end of the queue '''
+        self._songs.extend(songs)
+        self._changed()
+
+    def insert(self, index: int, song: Song) -> None:
+        ''' Inserts a song before the given position '''
+
+        self._settle(index if index >= 0 else len(self._songs) + index)
+        self._songs.insert(index, song)
+        if self.lazily_shuffled:
+            self._settled += 1
+            self._shuffle_end += 1
+        self._changed()
+
+    def popleft(self) -> Song:
+        ''' Removes and returns the song at the front of the queue '''
+
+        self._settle(1)
+        song = self._resolve(0)
+        self._discard_entry(self._songs.popleft())
+        if self.lazily_shuffled:
+            self._settled -= 1
+            self._shuffle_end -= 1
+        self._changed()
+        return song
+
+    def pop(self) -> Song:
+        ''' Removes and returns the song at the end of the queue '''
+
+        self._settle(len(self._songs))
+        song = self._resolve(-1)
+        self._discard_entry(self._songs.pop())
+        self._changed()
+        return song
+
+    def remove(self, index: int) -> Song:
+        ''' Removes and returns the song at the given position, in time proportional to its distance from the nearest end '''
+
+        self._settle((index if index >= 0 else len(self._songs) + index) + 1)
+        song = self._resolve(index)
+        self._discard_entry(self._songs[index])
+        del self._songs[index]
+        if self.lazily_shuffled:
+            self._settled -= 1
+            self._shuffle_end -= 1
+        self._changed()
+        return song
+
+    def move(self, source: int, destination: int) -> None:
+        ''' Moves the song at one position to another, shifting the songs in between '''
+
+        length = len(self._songs)
+        self._settle(max(source if source >= 0 else length + source, destination if destination >= 0 else length + destination) + 1)
+        song = self._songs[source]
+        del self._songs[source]
+        self._songs.insert(destination, song)
+        self._changed()
+
+    def clear(self) -> None:
+        ''' Removes every song from the queue '''
+
+        self._songs.clear()
+        self._pending = 0
+        self._settled = 0
+        self._shuffle_end = 0
+        self._changed()
+
+    def shuffle(self, *, lazy: bool=False) -> None:
+        ''' Shuffles the queue in place, in linear time and without copying any songs.
+
+        A `lazy` shuffle returns immediately, and instead does the work a little at a time as songs are played or shown. '''
+
+        if lazy:
+            self._settled = 0
+            self._shuffle_end = len(self._songs)
+        else:
+            songs = list(self._songs)
+            random.shuffle(songs)
+            self._songs = deque(songs)
+            self._settled = 0
+            self._shuffle_end = 0
+        self._changed()
+
+    def _changed(self) -> None:
+        self._version += 1
+        if self.on_change is not None:
+            self.on_change()
+
+    def _window(self, start: int, stop: int, step: int=1) -> list[Song | str]:
+        ''' The entries between two positions. Positions deep in the queue are indexed directly rather than walked to, which
+        skips a block of songs at a time, so a window costs about the same wherever it is in the queue '''
+
+        start, stop, step = slice(start, stop, step).indices(len(self._songs))
+        if start == 0:
+            return list(islice(self._songs, 0, max(0, stop), step))
+        songs = self._songs
+        return [songs[i] for i in range(start, stop, step)]
+
+    def _resolve(self, index: int) -> Song:
+        ''' Returns the song at a position. A bare id is replaced with the song if it has been loaded elsewhere; otherwise the id is
+        kept, for `hydrate` to load, and a song knowing only its id is returned in its place '''
+
+        song = self._songs[index]
+        if isinstance(song, str):
+            loaded = loaded_song(song)
+            if loaded is None:
+                return Song({"id": song})
+            self._songs[index] = loaded
+            self._pending -= 1
+            return loaded
+        return song
+
+    def _discard_entry(self, entry: Song | str) -> None:
+        ''' Accounts for an entry removed from the queue '''
+        if isinstance(entry, str):
+            self._pending -= 1
+
+    def _settle(self, stop: int) -> None:
+        ''' Finishes a lazy shuffle for every position before `stop` '''
+
+        start, end = self._settled, self._shuffle_end
+        stop = min(stop, end)
+        if stop <= start:
+            return
+
+        songs = self._songs
+        if stop - start > _LAZY_SHUFFLE_STEP_LIMIT:
+            # Reaching far into the queue, which is cheaper to finish all at once than one position at a time
+            ordered = list(songs)
+            remaining = ordered[start:end]
+            random.shuffle(remaining)
+            ordered[start:end] = remaining
+            self._songs = deque(ordered)
+            stop = end
+        else:
+            # One Fisher-Yates step per position: swap in a song picked from those not yet settled
+            randrange = random.randrange
+            for i in range(start, stop):
+                j = randrange(i, end)
+                if j != i:
+                    songs[i], songs[j] = songs[j], songs[i]
+
+        if stop >= end:
+            self._settled = 0
+            self._shuffle_end = 0
+        else:
+            self._settled = stop
@@ -1,12 +1,21 @@
 ''' For interfacing with the Subsonic API '''
 
+import asyncio
+import json
 import logging
-import os
+import sys
+import time
+import weakref
 import aiohttp
 
 from pathlib import Path
+from typing import AsyncIterator, Callable, Iterable
+from urllib.parse import urlencode
 
 from util import env
+from util.cache import SingleFlight, TTLCache
+from util.diskcache import DiskCache
+from util.pool import HTTPPool
 
 logger = logging.getLogger(__name__)
 
@@ -20,21 +29,146 @@ SUBSONIC_REQUEST_PARAMS = {
         "f": "json"
     }
 
-globalsession = None
+# Decoder used for every response; orjson is used when it is installed as it is several times faster
+try:
+    import orjson
+    decode_json: Callable[[bytes], any] = orjson.loads
+except ImportError:
+    decode_json: Callable[[bytes], any] = json.loads
+
+def set_json_decoder(decoder: Callable[[bytes], any]) -> None:
+    ''' Replace the function used to decode responses from the subsonic API '''
+    global decode_json
+    decode_json = decoder
+
+# Local index of the library searched before the server, when one is enabled (see library.py)
+local_index: "library.LibraryIndex" = None
+
+def set_local_index(index: "library.LibraryIndex") -> None:
+    ''' Set the index searched before sending a search to the subsonic API, or `None` to always ask the server '''
+    global local_index
+    local_index = index
+
+# Connection pool shared by every request to the Subsonic server
+pool = HTTPPool(
+    limit=env.SUBSONIC_POOL_LIMIT,
+    limit_per_host=env.SUBSONIC_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=env.SUBSONIC_KEEPALIVE_TIMEOUT,
+    dns_ttl=env.SUBSONIC_DNS_TTL,
+    timeout=env.SUBSONIC_TIMEOUT,
+)
+
+# Request timeouts in seconds, for endpoints that differ from the pool's default
+ENDPOINT_TIMEOUTS: dict[str, float] = {
+    "search3": env.SUBSONIC_SEARCH_TIMEOUT,
+    "getCoverArt": env.SUBSONIC_COVER_ART_TIMEOUT,
+    "probe": env.SUBSONIC_STREAM_PROBE_TIMEOUT,
+}
 
 async def get_session() -> aiohttp.ClientSession:
-    ''' Get an aiohttp session '''
-    global globalsession
-    if globalsession is None:
-        globalsession = aiohttp.ClientSession()
-    return globalsession
+    ''' Get the aiohttp session backed by the connection pool '''
+    return await pool.session()
 
 async def close_session() -> None:
-    ''' Close the aiohttp session '''
-    global globalsession
-    if globalsession is not None:
-        globalsession.close()
-        globalsession = None
+    ''' Close the aiohttp session and its connection pool '''
+    await pool.close()
+
+def pool_stats() -> dict[str, int]:
+    ''' Open, idle and in-use connections, and requests waiting for a connection '''
+    return pool.stats
+
+def get_timeout(endpoint: str) -> aiohttp.ClientTimeout:
+    ''' The request timeout to use for an endpoint '''
+    return aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(endpoint, env.SUBSONIC_TIMEOUT))
+
+# Shared cache of metadata responses, used by every guild
+metadata_cache = TTLCache(max_entries=env.METADATA_CACHE_MAX_ENTRIES, max_bytes=env.METADATA_CACHE_MAX_BYTES)
+
+# Cache lifetimes per endpoint, as (ttl, stale_ttl) in seconds; endpoints not listed here are never cached
+METADATA_CACHE_TTLS: dict[str, tuple[int, int]] = {
+    "search3": (300, 600),
+    "getAlbum": (3600, 86400),
+    "getArtist": (1800, 86400),
+    "getSong": (3600, 86400),
+}
+
+# Cover art is kept on disk, with the most recent images also kept in memory
+cover_art_cache = DiskCache("cache/cover_art", env.COVER_ART_CACHE_MAX_BYTES, suffix=".jpg")
+cover_art_memory = TTLCache(max_entries=64, max_bytes=env.COVER_ART_MEMORY_MAX_BYTES)
+COVER_ART_MEMORY_TTL = 600
+
+# Results of checking whether songs can be streamed, keyed by stream url
+stream_probes = TTLCache(max_entries=4096)
+STREAM_PROBE_TTL = 3600
+
+# Identical requests that are already in flight are shared rather than sent again
+inflight_requests = SingleFlight()
+
+# Endpoints that answer each request with a new random pick, so concurrent requests (such as autoplay in several guilds) can't share a response
+RANDOMIZED_ENDPOINTS = frozenset(("getRandomSongs", "getSimilarSongs"))
+
+def _request_key(endpoint: str, params: dict[str, any]) -> tuple:
+    ''' A hashable key identifying a request, ignoring the authentication parameters shared by every request '''
+    return (endpoint, tuple(sorted((k, str(v)) for k, v in params.items() if k not in SUBSONIC_REQUEST_PARAMS)))
+
+async def _fetch_json(endpoint: str, params: dict[str, any]) -> tuple[dict, int]:
+    ''' Request an endpoint of the subsonic API, returning the decoded response and its size in bytes (`None` if it shouldn't be cached) '''
+
+    session = await get_session()
+    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/{endpoint}.view", params=params, timeout=get_timeout(endpoint)) as response:
+        response.raise_for_status()
+        body = await response.read()
+
+    data = decode_json(body)
+    logger.debug("Received %d bytes from %s.", len(body), endpoint)
+    if data["subsonic-response"]["status"] != "ok":
+        return data, None
+    return data, len(body)
+
+async def get_json(endpoint: str, params: dict[str, any], *, cache: bool=True) -> dict:
+    ''' Request an endpoint of the subsonic API, serving metadata endpoints from the shared cache when possible.
+    Bulk requests can skip the cache with `cache=False`, so they don't push out entries in everyday use '''
+
+    key = _request_key(endpoint, params)
+
+    async def fetch() -> tuple[dict, int]:
+        if endpoint in RANDOMIZED_ENDPOINTS:
+            return await _fetch_json(endpoint, params)
+        return await inflight_requests.do(key, lambda: _fetch_json(endpoint, params))
+
+    if not cache or endpoint not in METADATA_CACHE_TTLS:
+        data, _ = await fetch()
+        return data
+
+    ttl, stale_ttl = METADATA_CACHE_TTLS[endpoint]
+    return await metadata_cache.get_or_fetch(key, fetch, ttl=ttl, stale_ttl=stale_ttl)
+
+def cache_stats() -> dict[str, int]:
+    ''' Hit, miss and eviction counters for the metadata cache '''
+    return metadata_cache.stats
+
+def inflight_stats() -> dict[str, int]:
+    ''' Counters for requests sent and requests coalesced into one already in flight '''
+    return inflight_requests.stats
+
+# Every loaded song, keyed by id, so that guilds queueing the same song share one object.
+# Dead references are pruned in bulk rather than with per-object callbacks, which keeps parsing large responses cheap
+_song_registry: dict[str, weakref.ref] = {}
+_song_registry_prune_at = 4096
+
+def _prune_song_registry() -> None:
+    ''' Removes songs that no longer exist from the registry '''
+    global _song_registry_prune_at
+
+    for key in [key for key, ref in _song_registry.items() if ref() is None]:
+        del _song_registry[key]
+    _song_registry_prune_at = max(4096, len(_song_registry) * 2)
+
+def loaded_song(song_id: str) -> "Song":
+    ''' Returns the song with the given id if it's already loaded, without sending any request '''
+
+    ref = _song_registry.get(song_id)
+    return ref() if ref is not None else None
 
 class APIError(Exception):
     ''' Exception raised for errors in the Subsonic API '''
@@ -43,16 +177,67 @@ class APIError(Exception):
         self.message = message
         super().__init__(self.message)
 
+# Interning makes repeated strings (such as an album's name on each of its tracks) share one object
+def _intern(value: any) -> any:
+    ''' Interns a string; anything else a server might send instead, such as `null` or a number, is kept as is '''
+    return sys.intern(value) if type(value) is str else value
+
+def _parse_replay_gain(replay_gain: dict) -> tuple[float, float, float, float]:
+    ''' Reads the (track gain, album gain, track peak, album peak) from an OpenSubsonic `replayGain` object, or `None` if it holds none of them '''
+
+    if not replay_gain:
+        return None
+    values = tuple(replay_gain.get(name) for name in ("trackGain", "albumGain", "trackPeak", "albumPeak"))
+    return values if any(value is not None for value in values) else None
+
 class Song():
     ''' Object representing a song returned from the Subsonic API '''
+
+    __slots__ = ("_id", "_title", "_album", "_artist", "_cover_id", "_duration", "_suffix", "_replay_gain", "__weakref__")
+
     def __init__(self, json_object: dict) -> None:
         #! Other properties exist in the initial json response but are currently unused by Discodrome and thus aren't supported here
-        self._id: str = json_object["id"] if "id" in json_object else ""
-        self._title: str = json_object["title"] if "title" in json_object else "Unknown Track"
-        self._album: str = json_object["album"] if "album" in json_object else "Unknown Album"
-        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
-        self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
-        self._duration: int = json_object["duration"] if "duration" in json_object else 0
+        get = json_object.get
+        self._id: str = get("id", "")
+        self._title: str = get("title", "Unknown Track")
+        self._album: str = _intern(get("album", "Unknown Album"))
+        self._artist: str = _intern(get("artist", "Unknown Artist"))
+        self._cover_id: str = _intern(get("coverArt", ""))
+        self._duration: int = get("duration", 0)
+        self._suffix: str = _intern(get("suffix", ""))
+        self._replay_gain: tuple[float, float, float, float] = _parse_replay_gain(get("replayGain"))
+
+    @classmethod
+    def from_json(cls, json_object: dict) -> "Song":
+        ''' Returns the song described by a json object, reusing the existing object if that song is already loaded '''
+
+        song_id = json_object.get("id")
+        if song_id:
+            ref = _song_registry.get(song_id)
+            if ref is not None:
+                song = ref()
+                if song is not None:
+                    return song
+
+        song = cls(json_object)
+        if song_id:
+            _song_registry[song_id] = weakref.ref(song)
+            if len(_song_registry) >= _song_registry_prune_at:
+                _prune_song_registry()
+        return song
+
+    def __getstate__(self) -> dict[str, any]:
+        return {name: getattr(self, name) for name in self.__slots__ if name != "__weakref__"}
+
+    def __setstate__(self, state: dict[str, any]) -> None:
+        # Songs pickled before __slots__ was introduced store their state as (dict, None)
+        if isinstance(state, tuple):
+            state = state[0] or state[1]
+        # Songs pickled before a field was added don't have it
+        self._suffix = ""
+        self._replay_gain = None
+        for name, value in state.items():
+            setattr(self, name, _intern(value) if name in ("_album", "_artist", "_cover_id", "_suffix") else value)
 
     @property
     def song_id(self) -> str:
@@ -84,6 +269,31 @@ class Song():
         ''' The total duration of the song '''
         return self._duration
 
+    @property
+    def suffix(self) -> str:
+        ''' The file extension of the song as stored on the server '''
+        return self._suffix
+
+    @property
+    def track_gain(self) -> float:
+        ''' The song's ReplayGain track gain in dB, or `None` if the server doesn't provide it '''
+        return self._replay_gain[0] if self._replay_gain else None
+
+    @property
+    def album_gain(self) -> float:
+        ''' The song's ReplayGain album gain in dB, or `None` if the server doesn't provide it '''
+        return self._replay_gain[1] if self._replay_gain else None
+
+    @property
+    def track_peak(self) -> float:
+        ''' The song's ReplayGain track peak as a linear amplitude, or `None` if the server doesn't provide it '''
+        return self._replay_gain[2] if self._replay_gain else None
+
+    @property
+    def album_peak(self) -> float:
+        ''' The song's ReplayGain album peak as a linear amplitude, or `None` if the server doesn't provide it '''
+        return self._replay_gain[3] if self._replay_gain else None
+
     @property
     def duration_printable(self) -> str:
         ''' The total duration of the song as a human readable string in the format `mm:ss` '''
@@ -91,17 +301,18 @@ class Song():
 
 class Album():
     ''' Object representing an album returned from subsonic API '''
+
+    __slots__ = ("_id", "_name", "_artist", "_cover_id", "_song_count", "_duration", "_year", "_songs")
+
     def __init__(self, json_object: dict) -> None:
         self._id: str = json_object["id"] if "id" in json_object else ""
         self._name: str = json_object["name"] if "name" in json_object else "Unknown Album"
-        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
-        self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
+        self._artist: str = _intern(json_object["artist"]) if "artist" in json_object else "Unknown Artist"
+        self._cover_id: str = _intern(json_object["coverArt"]) if "coverArt" in json_object else ""
         self._song_count: int = json_object["songCount"] if "songCount" in json_object else 0
         self._duration: int = json_object["duration"] if "duration" in json_object else 0
         self._year: int = json_object["year"] if "year" in json_object else 0
-        self._songs: list[Song] = []
-        for song in json_object["song"]:
-            self._songs.append(Song(song))
+        self._songs: list[Song] = [Song.from_json(song) for song in json_object["song"]]
     
     @property
     def album_id(self) -> str:
@@ -152,14 +363,11 @@ class Album():
 async def ping_api() -> bool:
     ''' Send a ping request to the subsonic API '''
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/ping.view", params=SUBSONIC_REQUEST_PARAMS) as response:
-        response.raise_for_status()
-        ping_data = await response.json()
-        if await check_subsonic_error(ping_data):
-            return False
-        logger.debug("Ping Response: %s", ping_data)
-    
+    ping_data = await get_json("ping", SUBSONIC_REQUEST_PARAMS)
+    if await check_subsonic_error(ping_data):
+        return False
+    logger.debug("Ping Response: %s", ping_data)
+
     return True
 
 async def check_subsonic_error(response: dict[str, any]) -> bool:
@@ -212,7 +420,12 @@ async def check_subsonic_error(response: dict[str, any]) -> bool:
     return True
 
 async def search(query: str, *, artist_count: int=00, artist_offset: int=0, album_count: int=0, album_offset: int=0, song_count: int=1, song_offset: int=0) -> list[Song]:
-    ''' Send a search request to the subsonic API '''
+    ''' Send a search request to the subsonic API. Song searches are answered from the local index when it has a match '''
+
+    if local_index is not None and local_index.ready and artist_count == 0 and album_count == 0 and song_offset == 0:
+        songs = local_index.search_songs(query, song_count)
+        if songs:
+            return songs
 
     # Sanitize special characters in the user's query
     #parsed_query = urlParse.quote(query, safe='')
@@ -229,26 +442,46 @@ async def search(query: str, *, artist_count: int=00, artist_offset: int=0, albu
 
     params = SUBSONIC_REQUEST_PARAMS | search_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/search3.view", params=params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return []
-        logger.debug("Search Response: %s", search_data)            
-    
+    search_data = await get_json("search3", params)
+    if await check_subsonic_error(search_data):
+        return []
+
     results: list[Song] = []
 
     try:
         for item in search_data["subsonic-response"]["searchResult3"]["song"]:
-            results.append(Song(item))
+            results.append(Song.from_json(item))
     except KeyError:
         return []
 
     return results
 
+async def search_suggestions(query: str, *, artist_count: int=0, album_count: int=0, song_count: int=0) -> dict[str, list[dict]]:
+    ''' Send a search request for autocompletion, returning the json objects of the artists, albums and songs found, keyed by type.
+
+    Suggestions are cached by autocomplete.py, so they are kept out of the shared metadata cache '''
+
+    search_params = {
+        "query": query,
+        "artistCount": str(artist_count),
+        "albumCount": str(album_count),
+        "songCount": str(song_count),
+    }
+
+    params = SUBSONIC_REQUEST_PARAMS | search_params
+
+    search_data = await get_json("search3", params, cache=False)
+    if await check_subsonic_error(search_data):
+        return {}
+    return search_data["subsonic-response"].get("searchResult3", {})
+
 async def search_album(query: str) -> list[Album]:
-    ''' Send a search request to the subsonic API to return 1 album and all its songs '''
+    ''' Send a search request to the subsonic API to return 1 album and all its songs, or find it in the local index '''
+
+    if local_index is not None and local_index.ready:
+        album = local_index.search_album(query)
+        if album is not None:
+            return album
 
     # Sanitize special characters in the user's query
     #parsed_query = urlParse.quote(query, safe='')
@@ -264,30 +497,24 @@ async def search_album(query: str) -> list[Album]:
 
     params = SUBSONIC_REQUEST_PARAMS | search_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/search3.view", params=params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return None
-        try:
-            albumid = search_data["subsonic-response"]["searchResult3"]["album"][0]["id"]
-        except Exception as e:
-            return None
-        logger.debug("Album ID: %s", albumid)
-    
+    search_data = await get_json("search3", params)
+    if await check_subsonic_error(search_data):
+        return None
+    try:
+        albumid = search_data["subsonic-response"]["searchResult3"]["album"][0]["id"]
+    except Exception as e:
+        return None
+    logger.debug("Album ID: %s", albumid)
+
     album_params = {
         "id": albumid
     }
 
     album_params = SUBSONIC_REQUEST_PARAMS | album_params
 
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getAlbum.view", params=album_params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return None
-        logger.debug("Search Response: %s", search_data)
+    search_data = await get_json("getAlbum", album_params)
+    if await check_subsonic_error(search_data):
+        return None
 
 
     try:
@@ -299,7 +526,12 @@ async def search_album(query: str) -> list[Album]:
     return album
 
 async def get_artist_id(query: str) -> str:
-    ''' Send a search request to the subsonic API to return the id of an artist '''
+    ''' Send a search request to the subsonic API to return the id of an artist, or find it in the local index '''
+
+    if local_index is not None and local_index.ready:
+        artists = local_index.search_artists(query)
+        if artists:
+            return artists[0][0]
 
     search_params = {
         "query": query,
@@ -312,64 +544,175 @@ async def get_artist_id(query: str) -> str:
 
     params = SUBSONIC_REQUEST_PARAMS | search_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/search3.view", params=params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return None
-        artistid = search_data["subsonic-response"]["searchResult3"]["artist"][0]["id"]
-        logger.debug("Artist ID: %s", artistid)
-    
+    search_data = await get_json("search3", params)
+    if await check_subsonic_error(search_data):
+        return None
+    artistid = search_data["subsonic-response"]["searchResult3"]["artist"][0]["id"]
+    logger.debug("Artist ID: %s", artistid)
+
     return artistid
 
-async def get_artist_discography(query: str) -> Album:
-    ''' Send a search request to the subsonic API to return all albums by an artist '''
+async def get_album(album_id: str) -> Album:
+    ''' Request a single album and all its songs from the subsonic API '''
+
+    album_params = {
+        "id": album_id
+    }
+
+    params = SUBSONIC_REQUEST_PARAMS | album_params
+
+    album_data = await get_json("getAlbum", params)
+    if await check_subsonic_error(album_data):
+        return None
+
+    return Album(album_data["subsonic-response"]["album"])
+
+def _release_order(albuminfo: dict) -> tuple[bool, int]:
+    ''' Sorts albums by release year, leaving those without one at the end '''
+    year = albuminfo.get("year")
+    return (year is None, year or 0)
+
+async def get_artist_albums(query: str) -> list[dict]:
+    ''' Send a search request to the subsonic API to return the json objects of every album by an artist, without their songs,
+    in release order. Returns `None` if the artist isn't found '''
 
     artistid = await get_artist_id(query)
-    
+    if artistid is None:
+        return None
+
     artist_params = {
         "id": artistid
     }
 
     artist_params = SUBSONIC_REQUEST_PARAMS | artist_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getArtist.view", params=artist_params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return None
-        logger.debug("Search Response: %s", search_data)
-        albums = search_data["subsonic-response"]["artist"]["album"]
-    
-    album_list : list[Album] = []
-
-    for albuminfo in albums:
-        albumid = albuminfo["id"]
-        album_params = {
-            "id": albumid
-        }
-        album_params = SUBSONIC_REQUEST_PARAMS | album_params
-        async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getAlbum.view", params=album_params) as response:
-            response.raise_for_status()
-            album = await response.json()
-            if await check_subsonic_error(album):
-                return None
-            logger.debug("Search Response: %s", album)
-            album = Album(album["subsonic-response"]["album"])
-            album_list.append(album)
+    search_data = await get_json("getArtist", artist_params)
+    if await check_subsonic_error(search_data):
+        return None
+
+    # sorted() is stable, so albums released the same year keep the order listed by the server
+    return sorted(search_data["subsonic-response"]["artist"].get("album", []), key=_release_order)
+
+async def stream_albums(albums: list[dict], *, max_concurrency: int=None) -> AsyncIterator[Album]:
+    ''' Loads albums from their json objects, yielding each one in order as soon as it and every album before it has loaded.
+
+    Albums are fetched concurrently, at most `max_concurrency` at a time, earliest first. Closing the iterator early cancels
+    the albums still loading. Albums that fail to load are logged and skipped rather than ending the stream. '''
+
+    if max_concurrency is None:
+        max_concurrency = env.SUBSONIC_MAX_CONCURRENCY
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def fetch_album(album_id: str) -> Album:
+        async with semaphore:
+            return await get_album(album_id)
+
+    # The semaphore wakes waiters in order, so the albums are fetched in the order they are yielded
+    tasks = [asyncio.create_task(fetch_album(albuminfo["id"])) for albuminfo in albums]
+    try:
+        for albuminfo, task in zip(albums, tasks):
+            try:
+                album = await task
+            except APIError as err:
+                logger.warning("Skipping album '%s', code %s: %s", albuminfo.get("name", albuminfo["id"]), err.errorcode, err.message)
+                continue
+            except Exception as err:
+                logger.warning("Skipping album '%s': %s", albuminfo.get("name", albuminfo["id"]), err)
+                continue
+            if album is not None:
+                yield album
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def get_artist_discography(query: str, *, max_concurrency: int=None) -> list[Album]:
+    ''' Send a search request to the subsonic API to return all albums by an artist, in release order.
+
+    Albums are fetched concurrently, at most `max_concurrency` at a time. Albums that fail to load are logged and left out
+    rather than aborting the whole discography. '''
+
+    albums = await get_artist_albums(query)
+    if not albums:
+        return None
+
+    album_list = [album async for album in stream_albums(albums, max_concurrency=max_concurrency)]
+    if len(album_list) == 0:
+        return None
 
     return album_list
 
 
-async def get_album_art_file(cover_id: str, size: int=300) -> str:
-    ''' Request album art from the subsonic API '''
-    target_path = f"cache/{cover_id}.jpg"
+async def get_song(song_id: str) -> Song:
+    ''' Request a single song from the subsonic API '''
+
+    params = SUBSONIC_REQUEST_PARAMS | {"id": song_id}
+
+    song_data = await get_json("getSong", params)
+    if await check_subsonic_error(song_data):
+        return None
+
+    return Song.from_json(song_data["subsonic-response"]["song"])
+
+async def get_songs(song_ids: Iterable[str], *, max_concurrency: int=None) -> dict[str, Song]:
+    ''' Looks up many songs by id at once, returning them keyed by id.
+
+    Songs already loaded are reused, and the rest are requested concurrently, at most `max_concurrency` at a time, through the
+    metadata cache. Songs that fail to load are logged and left out. '''
+
+    songs: dict[str, Song] = {}
+    missing = []
+    for song_id in song_ids:
+        song = loaded_song(song_id)
+        if song is not None:
+            songs[song_id] = song
+        else:
+            missing.append(song_id)
+
+    if not missing:
+        return songs
+
+    already_loaded = len(songs)
+    if max_concurrency is None:
+        max_concurrency = env.SUBSONIC_MAX_CONCURRENCY
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def fetch_song(song_id: str) -> Song:
+        async with semaphore:
+            return await get_song(song_id)
+
+    results = await asyncio.gather(*(fetch_song(song_id) for song_id in missing), return_exceptions=True)
+    for song_id, result in zip(missing, results):
+        if isinstance(result, BaseException):
+            logger.warning("Failed to load song '%s': %s", song_id, result)
+        elif result is not None:
+            songs[song_id] = result
+
+    logger.debug("Looked up %d songs, %d of which were already loaded.", len(songs), already_loaded)
+    return songs
+
+
+async def get_album_art(cover_id: str, size: int=300) -> bytes:
+    ''' Request album art from the subsonic API, serving it from the cover art cache when possible '''
+
+    key = f"{cover_id}-{size}"
+
+    # Back-to-back tracks from the same album are served straight from memory
+    cover_art = cover_art_memory.get(key)
+    if cover_art is not None:
+        return cover_art
+
+    cover_art = await inflight_requests.do(("getCoverArt", key), lambda: _load_album_art(cover_id, size, key))
+    return cover_art
+
+async def _load_album_art(cover_id: str, size: int, key: str) -> bytes:
+    ''' Load album art from the disk cache, downloading or revalidating it when needed '''
 
-    # Check if the cover art is already cached (TODO: Check for last-modified date?)
-    if os.path.exists(target_path):
-        return target_path
+    cover_art = await cover_art_cache.get(key)
+    metadata = cover_art_cache.metadata(key) if cover_art is not None else None
+
+    if metadata is not None and time.time() - metadata.get("validated", 0) < env.COVER_ART_REVALIDATE_AFTER:
+        cover_art_memory.set(key, cover_art, ttl=COVER_ART_MEMORY_TTL, size=len(cover_art))
+        return cover_art
 
     cover_params = {
         "id": cover_id,
@@ -378,17 +721,46 @@ async def get_album_art_file(cover_id: str, size: int=300) -> str:
 
     params = SUBSONIC_REQUEST_PARAMS | cover_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=params) as response:
-        logging.debug("Response: %s", response.content)
-        if await check_subsonic_error(response) or response.status != 200:
-            return "resources/cover_not_found.jpg"
+    # Ask the server to only send the image if it changed since it was cached
+    headers = {}
+    if metadata is not None:
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
 
-        file = Path(target_path)
-        file.parent.mkdir(exist_ok=True, parents=True)
-        file.write_bytes(await response.read())
-        
-    return target_path
+    try:
+        session = await get_session()
+        async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=params, headers=headers, timeout=get_timeout("getCoverArt")) as response:
+            if response.status == 304 and cover_art is not None:
+                await cover_art_cache.update_metadata(key, validated=time.time())
+            elif response.status != 200 or not response.content_type.startswith("image/"):
+                logger.debug("Cover art '%s' unavailable, status %s (%s).", cover_id, response.status, response.content_type)
+                if cover_art is None:
+                    return await _cover_not_found()
+            else:
+                cover_art = await response.read()
+                await cover_art_cache.put(key, cover_art, validated=time.time(), etag=response.headers.get("ETag"), last_modified=response.headers.get("Last-Modified"))
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        logger.warning("Failed to request cover art '%s': %s", cover_id, err)
+        if cover_art is None:
+            return await _cover_not_found()
+
+    cover_art_memory.set(key, cover_art, ttl=COVER_ART_MEMORY_TTL, size=len(cover_art))
+    return cover_art
+
+_cover_not_found_bytes: bytes = None
+
+async def _cover_not_found() -> bytes:
+    ''' The placeholder image used when an album has no cover art '''
+    global _cover_not_found_bytes
+    if _cover_not_found_bytes is None:
+        _cover_not_found_bytes = await asyncio.to_thread(Path("resources/cover_not_found.jpg").read_bytes)
+    return _cover_not_found_bytes
+
+def cover_art_stats() -> dict[str, dict[str, int]]:
+    ''' Counters for the in-memory and on-disk cover art caches '''
+    return {"memory": cover_art_memory.stats, "disk": cover_art_cache.stats}
 
 async def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_year: int=None, music_folder_id: str=None) -> list[Song]:
     ''' Request random songs from the subsonic API '''
@@ -414,17 +786,13 @@ async def get_random_songs(size: int=None, genre: str=None, from_year: int=None,
 
     params = SUBSONIC_REQUEST_PARAMS | search_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getRandomSongs.view", params=params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        if await check_subsonic_error(search_data):
-            return []
-        logger.debug("Search Response: %s", search_data)
+    search_data = await get_json("getRandomSongs", params)
+    if await check_subsonic_error(search_data):
+        return []
 
     results: list[Song] = []
     for item in search_data["subsonic-response"]["randomSongs"]["song"]:
-        results.append(Song(item))
+        results.append(Song.from_json(item))
 
     return results
 
@@ -444,16 +812,12 @@ async def get_similar_songs(song_id: str, count: int=1) -> list[Song]:
 
     params = SUBSONIC_REQUEST_PARAMS | search_params
 
-    session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/getSimilarSongs.view", params=params) as response:
-        response.raise_for_status()
-        search_data = await response.json()
-        logging.debug("Json Response: %s", search_data)
-        subsonic_error = await check_subsonic_error(search_data)
-        logger.debug("Subsonic error: %s", subsonic_error)
-        if subsonic_error:
-            logger.debug("Subsonic error. Returning empty list.")
-            return []
+    search_data = await get_json("getSimilarSongs", params)
+    subsonic_error = await check_subsonic_error(search_data)
+    logger.debug("Subsonic error: %s", subsonic_error)
+    if subsonic_error:
+        logger.debug("Subsonic error. Returning empty list.")
+        return []
 
     results: list[Song] = []
     
@@ -461,27 +825,48 @@ async def get_similar_songs(song_id: str, count: int=1) -> list[Song]:
         logging.debug("No similar songs found. Returning empty list.")
         return []
     
-    logger.debug("Similar songs: %s", search_data["subsonic-response"]["similarSongs"]["song"])
     for item in search_data["subsonic-response"]["similarSongs"]["song"]:
-        results.append(Song(item))
+        results.append(Song.from_json(item))
 
     logger.debug("Similar songs: %s", results)
     return results
 
-async def stream(stream_id: str):
-    ''' Send a stream request to the subsonic API '''
+def stream_url(stream_id: str, **stream_params: any) -> str:
+    ''' Build the url of a song's audio stream. No request is sent; errors surface when the stream is first read '''
 
-    stream_params = {
-        "id": stream_id
-        # TODO: handle other params
-    }
+    params = SUBSONIC_REQUEST_PARAMS | {"id": stream_id}
+    params |= {key: str(value) for key, value in stream_params.items() if value is not None}
+
+    return f"{env.SUBSONIC_SERVER}/rest/stream.view?{urlencode(params)}"
+
+async def probe_stream(stream_id: str, **stream_params: any) -> str:
+    ''' Cheaply checks that a song can be streamed by requesting only its first byte.
+    Returns the stream's content type, or `None` if the server responded with an error. Results are cached per song '''
+
+    url = stream_url(stream_id, **stream_params)
+    key = ("stream", url)
+
+    if key in stream_probes:
+        return stream_probes.get(key)
 
-    params = SUBSONIC_REQUEST_PARAMS | stream_params
+    return await inflight_requests.do(key, lambda: _probe_stream(url, key))
+
+def probed_content_type(stream_id: str, **stream_params: any) -> str:
+    ''' The content type found by an earlier `probe_stream` of a song, without making a request, or `None` if it hasn't been probed '''
+    return stream_probes.get(("stream", stream_url(stream_id, **stream_params)))
+
+async def _probe_stream(url: str, key: tuple) -> str:
+    ''' Send a ranged stream request to the subsonic API and cache the result '''
 
     session = await get_session()
-    async with await session.get(f"{env.SUBSONIC_SERVER}/rest/stream.view", params=params, timeout=20) as response:
+    async with await session.get(url, headers={"Range": "bytes=0-0"}, timeout=get_timeout("probe")) as response:
         response.raise_for_status()
-        if response.content_type == "text/xml":
+        content_type = response.content_type
+
+        # Errors are sent as a regular subsonic response instead of audio
+        if content_type in ("text/xml", "application/json"):
             logger.error("Failed to stream song: %s", await response.text())
-            return None
-        return str(response.url)
+            content_type = None
+
+    stream_probes.set(key, content_type, ttl=STREAM_PROBE_TTL)
+    return content_type
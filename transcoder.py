@@ -0,0 +1,240 @@
+''' A process-wide scheduler that limits how many ffmpeg processes run at once, across every guild '''
+
+import asyncio
+import discord
+import heapq
+import io
+import itertools
+import logging
+import os
+import time
+
+from enum import IntEnum
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_usage(pid: int) -> tuple[float, int]:
+    ''' The CPU time in seconds and resident memory in bytes of a process, read from /proc. `(None, None)` if unavailable '''
+
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as file:
+            stat = file.read()
+        with open(f"/proc/{pid}/statm", "rb") as file:
+            statm = file.read()
+    except OSError:
+        return None, None
+
+    # The process name may contain spaces, so fields are counted from its closing parenthesis (utime and stime are fields 14 and 15)
+    fields = stat[stat.rindex(b")") + 2:].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+    rss_bytes = int(statm.split()[1]) * _PAGE_SIZE
+    return cpu_seconds, rss_bytes
+
+
+class Priority(IntEnum):
+    ''' Enum representing how urgently an ffmpeg process is needed; lower values are started first '''
+    PLAYBACK = 0
+    PREFETCH = 1
+
+
+class TranscodeSlot():
+    ''' Permission to run one ffmpeg process, held until the process is cleaned up '''
+
+    def __init__(self, scheduler: "TranscodeScheduler", priority: Priority, loop: asyncio.AbstractEventLoop) -> None:
+        self.scheduler = scheduler
+        self.priority = priority
+        self.pid: int = None
+        self.started_at = time.monotonic()
+        self._loop = loop
+        self._released = False
+
+    def attach(self, pid: int) -> None:
+        ''' Associates the slot with the ffmpeg process using it '''
+        self.pid = pid
+        self.scheduler._processes[pid] = self
+
+    def release(self) -> None:
+        ''' Frees the slot for the next waiting process. Safe to call more than once, and from any thread '''
+
+        if self._released:
+            return
+        self._released = True
+
+        # Read while the process is still around; once it's reaped, /proc no longer knows about it
+        cpu_seconds, _ = process_usage(self.pid) if self.pid is not None else (None, None)
+
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+
+        if running_loop is self._loop:
+            self.scheduler._release(self, cpu_seconds)
+        elif not self._loop.is_closed():
+            # Audio sources are cleaned up from the voice client's thread
+            self._loop.call_soon_threadsafe(self.scheduler._release, self, cpu_seconds)
+
+
+class TranscodeScheduler():
+    ''' Caps the number of concurrent ffmpeg processes, starting waiting processes in order of priority.
+
+    Tracks how long processes waited to start, and the CPU time and memory used by those running. '''
+
+    def __init__(self, max_processes: int) -> None:
+        self.max_processes = max_processes
+
+        self._active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._processes: dict[int, TranscodeSlot] = {}
+
+        self.started = 0
+        self.finished = 0
+        self.finished_cpu_seconds = 0.0
+        self._delays = {priority: {"count": 0, "total": 0.0, "max": 0.0} for priority in Priority}
+
+    @property
+    def active(self) -> int:
+        ''' The number of slots currently held '''
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        ''' The number of processes waiting for a slot '''
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    async def acquire(self, priority: Priority) -> TranscodeSlot:
+        ''' Waits for a free slot, after every waiting process of a higher priority has been given one '''
+
+        start = time.perf_counter()
+
+        if self._active < self.max_processes:
+            self._active += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._counter), future))
+            try:
+                # The slot is handed over by `_release`, which leaves the active count as is
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # Given a slot just as the wait was cancelled, so pass it on
+                    self._hand_over()
+                raise
+
+        delay = time.perf_counter() - start
+        delays = self._delays[priority]
+        delays["count"] += 1
+        delays["total"] += delay
+        delays["max"] = max(delays["max"], delay)
+        if delay > 1:
+            logger.info("Waited %.2fs for an ffmpeg slot (priority: %s, running: %d)", delay, priority.name, self._active)
+
+        self.started += 1
+        return TranscodeSlot(self, priority, asyncio.get_running_loop())
+
+    def _release(self, slot: TranscodeSlot, cpu_seconds: float) -> None:
+        ''' Records a finished process and frees its slot '''
+
+        if slot.pid is not None:
+            self._processes.pop(slot.pid, None)
+        self.finished += 1
+        self.finished_cpu_seconds += cpu_seconds or 0.0
+        self._hand_over()
+
+    def _hand_over(self) -> None:
+        ''' Gives a freed slot to the most urgent waiting process, or returns it to the pool '''
+
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._active -= 1
+
+    def processes(self) -> list[dict[str, any]]:
+        ''' The CPU time and memory used by each running ffmpeg process '''
+
+        now = time.monotonic()
+        processes = []
+        for pid, slot in list(self._processes.items()):
+            cpu_seconds, rss_bytes = process_usage(pid)
+            processes.append({
+                "pid": pid,
+                "priority": slot.priority.name,
+                "age": now - slot.started_at,
+                "cpu_seconds": cpu_seconds,
+                "rss_bytes": rss_bytes,
+            })
+        return processes
+
+    @property
+    def stats(self) -> dict[str, any]:
+        ''' Counters describing the scheduler's usage, including the time processes waited to start per priority '''
+
+        processes = self.processes()
+        return {
+            "max": self.max_processes,
+            "running": self._active,
+            "waiting": self.waiting,
+            "started": self.started,
+            "finished": self.finished,
+            "cpu_seconds": self.finished_cpu_seconds + sum(process["cpu_seconds"] or 0.0 for process in processes),
+            "rss_bytes": sum(process["rss_bytes"] or 0 for process in processes),
+            "queue_delay": {
+                priority.name: {
+                    "count": delays["count"],
+                    "average": delays["total"] / delays["count"] if delays["count"] else 0.0,
+                    "max": delays["max"],
+                } for priority, delays in self._delays.items()
+            },
+        }
+
+
+class ScheduledOpusAudio(discord.FFmpegOpusAudio):
+    ''' An ffmpeg audio source that holds a transcode slot until it is cleaned up.
+
+    A file-like source piped to ffmpeg is owned by the audio source, and closed along with it. '''
+
+    def __init__(self, source: str | io.IOBase, *, slot: TranscodeSlot, **kwargs: any) -> None:
+        self._slot = slot
+        self._piped_source = source if kwargs.get("pipe") else None
+        try:
+            super().__init__(source, **kwargs)
+        except Exception:
+            slot.release()
+            self._close_piped_source()
+            raise
+        slot.attach(self._process.pid)
+
+    def cleanup(self) -> None:
+        # The slot reads the process's final CPU time, so it must be released before the process is killed and reaped
+        self._slot.release()
+        super().cleanup()
+        self._close_piped_source()
+
+    def _close_piped_source(self) -> None:
+        if self._piped_source is not None:
+            self._piped_source.close()
+            self._piped_source = None
+
+
+# Shared by every guild
+scheduler = TranscodeScheduler(env.FFMPEG_MAX_PROCESSES)
+
+async def create_source(source: str | io.IOBase, priority: Priority, **kwargs: any) -> ScheduledOpusAudio:
+    ''' Waits for a transcode slot, then starts an ffmpeg process streaming the given source '''
+
+    try:
+        slot = await scheduler.acquire(priority)
+    except BaseException:
+        if kwargs.get("pipe"):
+            source.close()
+        raise
+    return ScheduledOpusAudio(source, slot=slot, **kwargs)
@@ -1,19 +1,81 @@
 import discord
+import io
+import time
 
 import logging
 
-from subsonic import Song, Album, get_album_art_file
+from typing import Callable, TYPE_CHECKING
+from urllib.parse import parse_qs, urlparse
+
+from subsonic import Song, Album, get_album_art
+from util.cache import TTLCache
+
+if TYPE_CHECKING:
+    from player import Player
+    from songqueue import SongQueue
 
 logger = logging.getLogger(__name__)
 
+# Discord CDN urls of cover art that has already been uploaded, keyed by cover id
+cover_art_urls = TTLCache(max_entries=2048, max_bytes=1024 * 1024)
+COVER_ART_URL_DEFAULT_TTL = 12 * 60 * 60
+COVER_ART_URL_EXPIRY_MARGIN = 60 * 60
+
+# Rendered pages of queues, keyed by (queue serial, queue version, page); a changed queue has a new version, so stale pages are never served
+queue_pages = TTLCache(max_entries=512, max_bytes=2 * 1024 * 1024)
+QUEUE_PAGE_SIZE = 10
+QUEUE_PAGE_TTL = 10 * 60
+QUEUE_VIEW_TIMEOUT = 5 * 60
+
+
+def cdn_url_ttl(url: str) -> float:
+    ''' The number of seconds a Discord CDN url can still be used for, based on its signed `ex` (expiry) parameter '''
+
+    try:
+        expiry = int(parse_qs(urlparse(url).query)["ex"][0], 16)
+    except (KeyError, IndexError, ValueError):
+        return COVER_ART_URL_DEFAULT_TTL
+    return expiry - time.time() - COVER_ART_URL_EXPIRY_MARGIN
+
+def remember_cover_art_url(cover_id: str, message: discord.Message) -> None:
+    ''' Caches the CDN url Discord assigned to a message's uploaded cover art '''
+
+    url = None
+    if message.embeds and message.embeds[0].thumbnail.url:
+        url = message.embeds[0].thumbnail.url
+    elif message.attachments:
+        url = message.attachments[0].url
+
+    if url is None or url.startswith("attachment://"):
+        return
+
+    ttl = cdn_url_ttl(url)
+    if ttl > 0:
+        cover_art_urls.set(cover_id, url, ttl=ttl, size=len(url))
+
+
+# Progress messages are edited at most this often, in seconds, to stay clear of Discord's rate limits
+PROGRESS_EDIT_INTERVAL = 2.0
+
+
+def discography_description(artist: str, albums: list[Album]) -> str:
+    ''' Lists the albums of a discography added to the queue '''
+
+    desc = f"**{artist}**\n{len(albums)} albums\n\n"
+    for counter in range(len(albums)):
+        album = albums[counter]
+        desc += f"**{str(counter+1)}. {album.name}**\n{album.song_count} songs ({album.duration} seconds)\n\n"
+    return desc
 
 
 class SysMsg:
     ''' A class for sending system messages '''
 
     @staticmethod
-    async def msg(interaction: discord.Interaction, header: str, message: str=None, thumbnail: str=None, *, ephemeral: bool=False) -> None:
-        ''' Generic message function. Creates a message formatted as an embed '''
+    async def msg(interaction: discord.Interaction, header: str, message: str=None, thumbnail: bytes=None, *, cover_id: str=None, ephemeral: bool=False) -> discord.Message:
+        ''' Generic message function. Creates a message formatted as an embed, returning the message sent if Discord gave it back.
+
+        A `cover_id` can be given instead of a thumbnail; its cover art is only uploaded if it hasn't been uploaded before. '''
 
         # Handle message over character limit
         if message is not None and len(message) > 4096:
@@ -24,9 +86,19 @@ class SysMsg:
 
 
 
-        # Attach a thumbnail if one was provided (as a local file)
-        if thumbnail is not None:
-            file = discord.File(thumbnail, filename="image.png")
+        # Reuse the CDN url of previously uploaded cover art instead of uploading it again
+        cover_url = None
+        if cover_id:
+            cover_url = cover_art_urls.get(cover_id)
+            if cover_url is None and thumbnail is None:
+                thumbnail = await get_album_art(cover_id)
+
+        if cover_url is not None:
+            embed.set_thumbnail(url=cover_url)
+
+        # Attach a thumbnail if one was provided (as image bytes)
+        elif thumbnail is not None:
+            file = discord.File(io.BytesIO(thumbnail), filename="image.png")
             embed.set_thumbnail(url="attachment://image.png")
 
         # Attempt to send the error message, up to 3 times
@@ -34,11 +106,16 @@ class SysMsg:
         while attempt < 3:
             try:
                 if interaction.response.is_done():
-                    await interaction.followup.send(file=file, embed=embed, ephemeral=ephemeral)
-                    return
+                    sent = await interaction.followup.send(file=file, embed=embed, ephemeral=ephemeral)
                 else:
-                    await interaction.response.send_message(file=file, embed=embed, ephemeral=ephemeral)
-                    return
+                    callback = await interaction.response.send_message(file=file, embed=embed, ephemeral=ephemeral)
+                    sent = getattr(callback, "resource", None)
+                    if not isinstance(sent, discord.Message) and cover_id and file is not discord.utils.MISSING:
+                        sent = await interaction.original_response()
+
+                if cover_id and file is not discord.utils.MISSING and isinstance(sent, discord.Message):
+                    remember_cover_art_url(cover_id, sent)
+                return sent if isinstance(sent, discord.Message) else None
             except discord.NotFound:
                 logger.warning("Attempt %d at sending a system message failed...", attempt+1)
                 attempt += 1
@@ -47,9 +124,8 @@ class SysMsg:
     @staticmethod
     async def now_playing(interaction: discord.Interaction, song: Song) -> None:
         ''' Sends a message containing the currently playing song '''
-        cover_art = await get_album_art_file(song.cover_id)
         desc = f"**{song.title}** - *{song.artist}*\n{song.album} ({song.duration_printable})"
-        await __class__.msg(interaction, "Now Playing:", desc, cover_art)
+        await __class__.msg(interaction, "Now Playing:", desc, cover_id=song.cover_id)
 
     @staticmethod
     async def playback_ended(interaction: discord.Interaction) -> None:
@@ -75,25 +151,13 @@ class SysMsg:
     async def added_to_queue(interaction: discord.Interaction, song: Song) -> None:
         ''' Sends a message indicating the selected song was added to queue '''
         desc = f"**{song.title}** - *{song.artist}*\n{song.album} ({song.duration_printable})"
-        cover_art = await get_album_art_file(song.cover_id)
-        await __class__.msg(interaction, f"{interaction.user.display_name} added track to queue", desc, cover_art)
+        await __class__.msg(interaction, f"{interaction.user.display_name} added track to queue", desc, cover_id=song.cover_id)
 
     @staticmethod
     async def added_album_to_queue(interaction: discord.Interaction, album: Album) -> None:
         ''' Sends a message indicating the selected album was added to queue '''
         desc = f"**{album.name}** - *{album.artist}*\n{album.song_count} songs ({album.duration} seconds)"
-        cover_art = await get_album_art_file(album.cover_id)
-        await __class__.msg(interaction, f"{interaction.user.display_name} added album to queue", desc, cover_art)
-
-    @staticmethod
-    async def added_discography_to_queue(interaction: discord.Interaction, artist: str, albums: list[Album]) -> None:
-        ''' Sends a message indicating the selected artist's discography was added to queue '''
-        desc = f"**{artist}**\n{len(albums)} albums\n\n"
-        cover_art = await get_album_art_file(albums[0].cover_id)
-        for counter in range(len(albums)):
-            album = albums[counter]
-            desc += f"**{str(counter+1)}. {album.name}**\n{album.song_count} songs ({album.duration} seconds)\n\n" 
-        await __class__.msg(interaction, f"{interaction.user.display_name} added discography to queue", desc, cover_art)
+        await __class__.msg(interaction, f"{interaction.user.display_name} added album to queue", desc, cover_id=album.cover_id)
 
     @staticmethod
     async def queue_cleared(interaction: discord.Interaction) -> None:
@@ -106,6 +170,66 @@ class SysMsg:
         await __class__.msg(interaction, "Skipped track", ephemeral=True)
 
 
+class DiscographyProgress():
+    ''' The message confirming a discography was added to the queue, edited as its albums are loaded.
+    It is sent once the first album is in, then edited at most every `PROGRESS_EDIT_INTERVAL` seconds until loading ends. '''
+
+    def __init__(self, interaction: discord.Interaction, artist: str, album_count: int) -> None:
+        self.interaction = interaction
+        self.artist = artist
+        self.album_count = album_count
+        self.albums: list[Album] = []
+        self.message: discord.Message = None
+        self._edited_at: float = 0.0
+
+    async def add(self, album: Album) -> None:
+        ''' Lists an album that was added to the queue '''
+
+        self.albums.append(album)
+        if self.message is None and len(self.albums) == 1:
+            self.message = await SysMsg.msg(self.interaction, self._header("adding"), self._description(), cover_id=album.cover_id)
+            self._edited_at = time.monotonic()
+        elif time.monotonic() - self._edited_at >= PROGRESS_EDIT_INTERVAL:
+            await self._edit(self._header("adding"), f"Loaded {len(self.albums)} of {self.album_count} albums")
+
+    async def finish(self, *, cancelled: bool=False) -> None:
+        ''' Shows the albums added once loading has ended, or was cancelled part way through '''
+
+        if not self.albums:
+            return
+        if cancelled:
+            await self._edit(self._header("stopped adding"), f"Stopped after {len(self.albums)} of {self.album_count} albums")
+        else:
+            await self._edit(self._header("added"))
+
+    def _header(self, verb: str) -> str:
+        return f"{self.interaction.user.display_name} {verb} discography to queue"
+
+    def _description(self) -> str:
+        desc = discography_description(self.artist, self.albums)
+        return desc if len(desc) <= 4096 else desc[:4093] + "..."
+
+    async def _edit(self, header: str, footer: str=None) -> None:
+        ''' Updates the message with the albums added so far '''
+
+        if self.message is None or not self.message.embeds:
+            return
+
+        embed = self.message.embeds[0].copy()
+        embed.title = header
+        embed.description = self._description()
+        if footer is not None:
+            embed.set_footer(text=footer)
+        else:
+            embed.remove_footer()
+
+        try:
+            self.message = await self.message.edit(embed=embed)
+        except discord.HTTPException as err:
+            logger.warning("Failed to update the discography message: %s", err)
+        self._edited_at = time.monotonic()
+
+
 class ErrMsg:
     ''' A class for sending error messages '''
 
@@ -151,6 +275,108 @@ class ErrMsg:
 
 
 
+class QueueView(discord.ui.View):
+    ''' A guild's queue, shown a page at a time with buttons to move between pages.
+
+    Only the songs on the visible page are read from the queue, so a page costs the same however long the queue is. '''
+
+    def __init__(self, get_player: Callable[[], "Player"]) -> None:
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        # The player is looked up again on each press, as an idle guild's player may have been unloaded since
+        self.get_player = get_player
+        self.page = 0
+        self.page_count = 1
+        self.message: discord.Message = None
+
+    async def send(self, interaction: discord.Interaction) -> None:
+        ''' Sends the first page of the queue in response to an interaction '''
+
+        embed = await self.render()
+        if self.page_count > 1:
+            await interaction.response.send_message(embed=embed, view=self)
+            self.message = await interaction.original_response()
+        else:
+            self.stop()
+            await interaction.response.send_message(embed=embed)
+
+    async def render(self) -> discord.Embed:
+        ''' Builds the embed for the current page, clamping the page to the queue's current length '''
+
+        player = self.get_player()
+        queue = player.queue
+        self.page_count = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+        self.page = min(max(self.page, 0), self.page_count - 1)
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+        sections = []
+        song = player.current_song
+        if song is not None:
+            sections.append(f"**Now Playing:**\n{song.title} - *{song.artist}*\n{song.album} ({song.duration_printable})\n\n")
+        if queue:
+            sections.append(await render_queue_page(queue, self.page))
+        description = "".join(sections) or "Queue is empty!"
+
+        embed = discord.Embed(color=discord.Color(0x50C470), title="Queue", description=description)
+        if queue:
+            embed.set_footer(text=f"Page {self.page + 1} of {self.page_count} • {len(queue)} songs")
+        return embed
+
+    async def show(self, interaction: discord.Interaction, page: int) -> None:
+        ''' Replaces the message's embed with the given page '''
+        self.page = page
+        await interaction.response.edit_message(embed=await self.render(), view=self)
+
+    @discord.ui.button(emoji="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        await self.show(interaction, self.page + 1)
+
+    async def on_timeout(self) -> None:
+        ''' Disables the buttons once they stop working '''
+
+        if self.message is None:
+            return
+        self.previous_page.disabled = True
+        self.next_page.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException as err:
+            logger.debug("Failed to disable the buttons of a queue message: %s", err)
+
+async def render_queue_page(queue: "SongQueue", page: int) -> str:
+    ''' Renders one page of a queue as text, reusing the page rendered last time if the queue hasn't changed since '''
+
+    key = (queue.serial, queue.version, page)
+    text = queue_pages.get(key)
+    if text is not None:
+        return text
+
+    start = page * QUEUE_PAGE_SIZE
+    stop = start + QUEUE_PAGE_SIZE
+    await queue.hydrate(start, stop)
+
+    # Checked again, as the queue may have changed while its songs were loaded
+    key = (queue.serial, queue.version, page)
+    lines = []
+    for position, song in enumerate(queue[start:stop], start + 1):
+        title = _clip(song.title, 100)
+        artist = _clip(song.artist, 60)
+        album = _clip(song.album, 100)
+        lines.append(f"{position}. **{title}** - *{artist}*\n{album} ({song.duration_printable})\n\n")
+    text = "".join(lines)
+
+    queue_pages.set(key, text, ttl=QUEUE_PAGE_TTL, size=len(text))
+    return text
+
+def _clip(text: str, length: int) -> str:
+    ''' Shortens text to at most `length` characters, marking where it was cut '''
+    return text if len(text) <= length else text[:length - 3] + "..."
+
+
 # Methods for parsing data to Discord structures
 def parse_search_as_track_selection_embed(results: list[Song], query: str, page_num: int) -> discord.Embed:
     ''' Takes search results obtained from the Subsonic API and parses them into a Discord embed suitable for track selection '''
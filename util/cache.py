@@ -0,0 +1,196 @@
+''' Collection of in-memory caching utilities '''
+
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class _CacheEntry():
+    ''' A single value stored in a `TTLCache` '''
+
+    __slots__ = ("value", "size", "expires_at", "stale_until")
+
+    def __init__(self, value: any, size: int, expires_at: float, stale_until: float) -> None:
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class TTLCache():
+    ''' An LRU cache bounded by entry count and approximate byte size, whose entries expire after a TTL.
+
+    Expired entries can still be served for a grace period (stale-while-revalidate) while a fresh copy is fetched in the background '''
+
+    def __init__(self, max_entries: int=1024, max_bytes: int=16 * 1024 * 1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, _CacheEntry] = OrderedDict()
+        self._bytes = 0
+        self._refreshing: dict[Hashable, asyncio.Task] = {}
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.stale_until > time.monotonic()
+
+    @property
+    def size_bytes(self) -> int:
+        ''' The approximate number of bytes held by the cache '''
+        return self._bytes
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the cache's usage '''
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get(self, key: Hashable, default: any=None) -> any:
+        ''' Returns a cached value that has not yet expired, or `default` '''
+
+        entry = self._entries.get(key)
+        if entry is None or entry.expires_at <= time.monotonic():
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key: Hashable, value: any, *, ttl: float, stale_ttl: float=0, size: int=1) -> None:
+        ''' Stores a value for `ttl` seconds, servable while stale for a further `stale_ttl` seconds '''
+
+        self.pop(key)
+
+        # Values that would never fit are not worth evicting everything else for
+        if size > self.max_bytes:
+            return
+
+        now = time.monotonic()
+        self._entries[key] = _CacheEntry(value, size, now + ttl, now + ttl + stale_ttl)
+        self._bytes += size
+        self._evict()
+
+    def pop(self, key: Hashable) -> any:
+        ''' Removes a value from the cache, returning it if present '''
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._bytes -= entry.size
+        return entry.value
+
+    def clear(self) -> None:
+        ''' Removes every value from the cache '''
+        self._entries.clear()
+        self._bytes = 0
+
+    def _evict(self) -> None:
+        ''' Evicts the least recently used entries until the cache is within its bounds '''
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.evictions += 1
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[tuple[any, int]]], *, ttl: float, stale_ttl: float=0) -> any:
+        ''' Returns a cached value, calling `fetch` on a miss.
+
+        `fetch` must return a `(value, size)` tuple, or `(value, None)` if the value should not be cached.
+        Stale values are returned immediately while `fetch` refreshes them in the background '''
+
+        entry = self._entries.get(key)
+        now = time.monotonic()
+
+        if entry is not None and entry.expires_at > now:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.value
+
+        if entry is not None and entry.stale_until > now:
+            self._entries.move_to_end(key)
+            self.stale_hits += 1
+            if key not in self._refreshing:
+                task = asyncio.create_task(self._refresh(key, fetch, ttl, stale_ttl))
+                self._refreshing[key] = task
+            return entry.value
+
+        self.misses += 1
+        value, size = await fetch()
+        if size is not None:
+            self.set(key, value, ttl=ttl, stale_ttl=stale_ttl, size=size)
+        return value
+
+    async def _refresh(self, key: Hashable, fetch: Callable[[], Awaitable[tuple[any, int]]], ttl: float, stale_ttl: float) -> None:
+        ''' Replaces a stale value with a freshly fetched one '''
+
+        try:
+            value, size = await fetch()
+            if size is not None:
+                self.set(key, value, ttl=ttl, stale_ttl=stale_ttl, size=size)
+        except Exception as err:
+            logger.warning("Failed to refresh cached value for %s: %s", key, err)
+        finally:
+            self._refreshing.pop(key, None)
+
+
+class SingleFlight():
+    ''' Coalesces concurrent calls sharing the same key into a single in-flight call whose result is shared '''
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, asyncio.Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing how many calls were made and how many were coalesced '''
+        return {
+            "in_flight": len(self._calls),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+        }
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[any]]) -> any:
+        ''' Awaits `call`, or the call already in flight for `key` if there is one '''
+
+        future = self._calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(call())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+
+        # Shielded so that one caller being cancelled doesn't cancel the call for everyone else sharing it
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        ''' Removes a finished call so that later callers start a new one '''
+
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            future.exception()
@@ -0,0 +1,299 @@
+''' A size-capped, persistent on-disk cache with LRU eviction '''
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE_NAME = "index.json"
+TEMP_SUFFIX = ".tmp"
+
+
+class DiskCache():
+    ''' Stores values as files within a directory, bounded by their total size.
+
+    An index of every entry (its file, size, last access and any extra metadata) is persisted alongside the files.
+    Files are written to a temporary file and renamed into place, so an interrupted write never leaves a partial entry behind.
+    All file I/O is run in a worker thread so the event loop is never blocked '''
+
+    def __init__(self, directory: str, max_bytes: int, *, suffix: str="") -> None:
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+        self._index: OrderedDict[str, dict[str, any]] = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+        # Saves are written one at a time, and saves requested while one is being written are folded into the next
+        self._save_lock = asyncio.Lock()
+        self._save_requested = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    @property
+    def size_bytes(self) -> int:
+        ''' The total size of every file in the cache '''
+        return self._bytes
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the cache's usage '''
+        return {
+            "entries": len(self._index),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def path(self, key: str) -> Path:
+        ''' The path of the file holding an entry '''
+        return self.directory / (hashlib.sha1(key.encode()).hexdigest() + self.suffix)
+
+    def temp_path(self) -> Path:
+        ''' A new, unique path to write an entry to before it is committed '''
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        handle, path = tempfile.mkstemp(dir=self.directory, suffix=TEMP_SUFFIX)
+        os.close(handle)
+        return Path(path)
+
+    def metadata(self, key: str) -> dict[str, any]:
+        ''' The metadata stored alongside an entry, or `None` if there is no such entry '''
+
+        entry = self._index.get(key)
+        return None if entry is None else entry["metadata"]
+
+    async def load(self) -> None:
+        ''' Loads the index from disk, discarding entries whose file is missing or incomplete '''
+
+        async with self._load_lock:
+            if self._loaded:
+                return
+            await asyncio.to_thread(self.load_sync)
+
+    def load_sync(self) -> None:
+        ''' Blocking version of `load()` '''
+
+        if self._loaded:
+            return
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        index_path = self.directory / INDEX_FILE_NAME
+
+        entries: dict[str, dict[str, any]] = {}
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as err:
+            logger.warning("Cache index '%s' is unreadable and will be rebuilt: %s", index_path, err)
+
+        # Keep only entries whose file is present and complete, least recently used first
+        known_files = {INDEX_FILE_NAME}
+        for key, entry in sorted(entries.items(), key=lambda item: item[1].get("accessed", 0)):
+            path = self.path(key)
+            try:
+                if path.stat().st_size != entry["size"]:
+                    path.unlink()
+                    continue
+            except (OSError, KeyError):
+                continue
+            entry.setdefault("metadata", {})
+            self._index[key] = entry
+            self._bytes += entry["size"]
+            known_files.add(path.name)
+
+        # Remove interrupted writes and files the index no longer knows about
+        for path in self.directory.iterdir():
+            if path.is_file() and path.name not in known_files:
+                path.unlink(missing_ok=True)
+
+        self._loaded = True
+        self._evict_sync()
+        self._write_index(json.dumps(self._index))
+        logger.debug("Loaded cache index '%s' with %d entries (%d bytes).", index_path, len(self._index), self._bytes)
+
+    async def get(self, key: str) -> bytes:
+        ''' Returns the contents of an entry, or `None` if there is no such entry '''
+
+        await self.load()
+
+        entry = self._index.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        try:
+            data = await asyncio.to_thread(self.path(key).read_bytes)
+        except OSError:
+            self._drop(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if key in self._index:
+            self._touch(key)
+        return data
+
+    def get_path(self, key: str) -> Path:
+        ''' Returns the path of an entry's file and marks it as recently used, or `None` if there is no such entry '''
+
+        if key not in self._index:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touch(key)
+        return self.path(key)
+
+    async def put(self, key: str, data: bytes, **metadata: any) -> None:
+        ''' Stores an entry, replacing any existing entry with the same key '''
+
+        await self.load()
+        temp_path = await asyncio.to_thread(self._write_temp, data)
+        await self.commit(key, temp_path, **metadata)
+
+    def _write_temp(self, data: bytes) -> Path:
+        ''' Writes data to a new temporary file '''
+
+        temp_path = self.temp_path()
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+        except OSError:
+            temp_path.unlink(missing_ok=True)
+            raise
+        return temp_path
+
+    async def commit(self, key: str, temp_path: Path, **metadata: any) -> None:
+        ''' Atomically moves a fully written temporary file into place as an entry '''
+
+        await self.load()
+        size = await asyncio.to_thread(self._replace, temp_path, self.path(key))
+        if size is None:
+            return
+
+        previous = self._index.pop(key, None)
+        if previous is not None:
+            self._bytes -= previous["size"]
+
+        self._index[key] = {"size": size, "accessed": time.time(), "metadata": metadata}
+        self._bytes += size
+        await self._evict()
+        await self.save()
+
+    def _replace(self, temp_path: Path, path: Path) -> int:
+        ''' Renames a temporary file over an entry's file, returning its size (`None` if it is too large to keep) '''
+
+        size = temp_path.stat().st_size
+        if size > self.max_bytes:
+            temp_path.unlink(missing_ok=True)
+            return None
+        os.replace(temp_path, path)
+        return size
+
+    async def update_metadata(self, key: str, **metadata: any) -> None:
+        ''' Updates the metadata of an existing entry '''
+
+        entry = self._index.get(key)
+        if entry is None:
+            return
+        entry["metadata"].update(metadata)
+        self._touch(key)
+        await self.save()
+
+    async def remove(self, key: str) -> None:
+        ''' Removes an entry from the cache '''
+
+        if key not in self._index:
+            return
+        path = self._forget(key)
+        await asyncio.to_thread(path.unlink, missing_ok=True)
+        await self.save()
+
+    async def save(self) -> None:
+        ''' Persists the index, including the latest access order '''
+
+        if not self._loaded:
+            return
+
+        self._save_requested = True
+        async with self._save_lock:
+            # A save that started after this one was requested has already written the latest index
+            if not self._save_requested:
+                return
+            self._save_requested = False
+            # Serialized on the event loop so the index can't change underneath the worker thread
+            await asyncio.to_thread(self._write_index, json.dumps(self._index))
+
+    def _touch(self, key: str) -> None:
+        ''' Marks an entry as the most recently used '''
+        self._index[key]["accessed"] = time.time()
+        self._index.move_to_end(key)
+
+    def _forget(self, key: str) -> Path:
+        ''' Removes an entry from the index, returning the path of its file '''
+
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+        return self.path(key)
+
+    def _drop(self, key: str) -> None:
+        ''' Forgets an entry and deletes its file '''
+        self._forget(key).unlink(missing_ok=True)
+
+    def _evict_sync(self) -> None:
+        ''' Removes the least recently used entries until the cache is within its size cap '''
+
+        while self._index and self._bytes > self.max_bytes:
+            self._drop(next(iter(self._index)))
+            self.evictions += 1
+
+    async def _evict(self) -> None:
+        ''' Removes the least recently used entries until the cache is within its size cap, deleting their files in a worker thread '''
+
+        paths: list[Path] = []
+        while self._index and self._bytes > self.max_bytes:
+            paths.append(self._forget(next(iter(self._index))))
+            self.evictions += 1
+
+        if paths:
+            await asyncio.to_thread(lambda: [path.unlink(missing_ok=True) for path in paths])
+
+    def _write_index(self, serialized_index: str) -> None:
+        ''' Atomically writes a serialized index to disk '''
+
+        index_path = self.directory / INDEX_FILE_NAME
+        temp_path = None
+        try:
+            temp_path = self.temp_path()
+            with open(temp_path, "w", encoding="utf-8") as file:
+                file.write(serialized_index)
+            os.replace(temp_path, index_path)
+        except OSError as err:
+            logger.error("Failed to save cache index '%s'.", index_path, exc_info=err)
+            if temp_path is not None:
+                temp_path.unlink(missing_ok=True)
@@ -12,6 +12,50 @@ DISCORD_OWNER_ID: Final[int] = int(os.getenv("DISCORD_OWNER_ID"))
 SUBSONIC_SERVER: Final[str] = os.getenv("SUBSONIC_SERVER")
 SUBSONIC_USER: Final[str] = os.getenv("SUBSONIC_USER")
 SUBSONIC_PASSWORD: Final[str] = os.getenv("SUBSONIC_PASSWORD")
+SUBSONIC_MAX_CONCURRENCY: Final[int] = int(os.getenv("SUBSONIC_MAX_CONCURRENCY", "8"))
+
+SUBSONIC_POOL_LIMIT: Final[int] = int(os.getenv("SUBSONIC_POOL_LIMIT", "32"))
+SUBSONIC_POOL_LIMIT_PER_HOST: Final[int] = int(os.getenv("SUBSONIC_POOL_LIMIT_PER_HOST", "16"))
+SUBSONIC_KEEPALIVE_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_KEEPALIVE_TIMEOUT", "30"))
+SUBSONIC_DNS_TTL: Final[int] = int(os.getenv("SUBSONIC_DNS_TTL", "300"))
+SUBSONIC_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_TIMEOUT", "10"))
+SUBSONIC_SEARCH_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_SEARCH_TIMEOUT", "10"))
+SUBSONIC_COVER_ART_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_COVER_ART_TIMEOUT", "5"))
+SUBSONIC_STREAM_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_STREAM_TIMEOUT", "20"))
+SUBSONIC_STREAM_PROBE_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_STREAM_PROBE_TIMEOUT", "5"))
+
+COVER_ART_CACHE_MAX_BYTES: Final[int] = int(os.getenv("COVER_ART_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+COVER_ART_MEMORY_MAX_BYTES: Final[int] = int(os.getenv("COVER_ART_MEMORY_MAX_BYTES", str(8 * 1024 * 1024)))
+COVER_ART_REVALIDATE_AFTER: Final[int] = int(os.getenv("COVER_ART_REVALIDATE_AFTER", "86400"))
+
+AUDIO_CACHE_MAX_BYTES: Final[int] = int(os.getenv("AUDIO_CACHE_MAX_BYTES", "0"))
+
+AUTOPLAY_BATCH_SIZE: Final[int] = int(os.getenv("AUTOPLAY_BATCH_SIZE", "20"))
+AUTOPLAY_LOW_WATER_MARK: Final[int] = int(os.getenv("AUTOPLAY_LOW_WATER_MARK", "5"))
+
+FFMPEG_MAX_PROCESSES: Final[int] = int(os.getenv("FFMPEG_MAX_PROCESSES", "32"))
+OPUS_PASSTHROUGH: Final[bool] = os.getenv("OPUS_PASSTHROUGH", "true").lower() in ("1", "true", "yes")
+REPLAYGAIN: Final[bool] = os.getenv("REPLAYGAIN", "true").lower() in ("1", "true", "yes")
+
+LAZY_SHUFFLE_MIN_SONGS: Final[int] = int(os.getenv("LAZY_SHUFFLE_MIN_SONGS", "50000"))
+
+GUILD_IDLE_TIMEOUT: Final[float] = float(os.getenv("GUILD_IDLE_TIMEOUT", "1800"))
+
+STORAGE_PATH: Final[str] = os.getenv("STORAGE_PATH", "guild_data.sqlite3")
+STORAGE_WRITE_DELAY: Final[float] = float(os.getenv("STORAGE_WRITE_DELAY", "2"))
+STORAGE_SHUTDOWN_TIMEOUT: Final[float] = float(os.getenv("STORAGE_SHUTDOWN_TIMEOUT", "5"))
+STORAGE_COMPACT_INTERVAL: Final[float] = float(os.getenv("STORAGE_COMPACT_INTERVAL", "3600"))
+
+LIBRARY_INDEX: Final[bool] = os.getenv("LIBRARY_INDEX", "false").lower() in ("1", "true", "yes")
+LIBRARY_INDEX_PATH: Final[str] = os.getenv("LIBRARY_INDEX_PATH", "cache/library.sqlite3")
+LIBRARY_REFRESH_INTERVAL: Final[float] = float(os.getenv("LIBRARY_REFRESH_INTERVAL", "3600"))
+
+PREFETCH_LEAD_SECONDS: Final[float] = float(os.getenv("PREFETCH_LEAD_SECONDS", "5"))
+
+METADATA_CACHE_MAX_ENTRIES: Final[int] = int(os.getenv("METADATA_CACHE_MAX_ENTRIES", "2048"))
+METADATA_CACHE_MAX_BYTES: Final[int] = int(os.getenv("METADATA_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+STATS_LOG_INTERVAL: Final[float] = float(os.getenv("STATS_LOG_INTERVAL", "300"))
 
 BOT_STATUS: Final[str] = os.getenv("BOT_STATUS")
 
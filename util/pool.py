@@ -0,0 +1,105 @@
+''' A managed HTTP connection pool built on top of aiohttp '''
+
+import logging
+import aiohttp
+
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPPool():
+    ''' Owns a single `aiohttp.ClientSession` with a tuned connector, and tracks how its connections are used '''
+
+    def __init__(self, *, limit: int=100, limit_per_host: int=0, keepalive_timeout: float=15, dns_ttl: int=10, timeout: float=None) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_ttl = dns_ttl
+        self.timeout = timeout
+
+        self._session: aiohttp.ClientSession = None
+        self._connector: aiohttp.TCPConnector = None
+
+        self.waiting = 0
+        self.created = 0
+        self.reused = 0
+
+    @property
+    def is_open(self) -> bool:
+        ''' Whether the pool currently holds an open session '''
+        return self._session is not None and not self._session.closed
+
+    async def session(self) -> aiohttp.ClientSession:
+        ''' Returns the pool's session, creating it if needed. Must be called from within a running event loop '''
+
+        if not self.is_open:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_ttl,
+                use_dns_cache=self.dns_ttl > 0,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=self._connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[self._trace_config()],
+            )
+            logger.debug("Opened HTTP connection pool (limit: %s, per host: %s).", self.limit, self.limit_per_host)
+        return self._session
+
+    async def close(self) -> None:
+        ''' Closes the session and every connection in the pool '''
+
+        if self._session is None:
+            return
+
+        session = self._session
+        self._session = None
+        self._connector = None
+        if not session.closed:
+            await session.close()
+            logger.debug("Closed HTTP connection pool.")
+
+    @property
+    def stats(self) -> dict[str, int]:
+        ''' Counters describing the connections held by the pool '''
+
+        idle = 0
+        in_use = 0
+        if self._connector is not None and not self._connector.closed:
+            # aiohttp doesn't expose these publicly, so fall back to zero if its internals change
+            idle = sum(len(conns) for conns in getattr(self._connector, "_conns", {}).values())
+            in_use = len(getattr(self._connector, "_acquired", ()))
+
+        return {
+            "open": idle + in_use,
+            "idle": idle,
+            "in_use": in_use,
+            "waiting": self.waiting,
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        ''' Creates a trace config that keeps the pool's counters up to date '''
+
+        async def on_queued_start(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionQueuedStartParams) -> None:
+            self.waiting += 1
+
+        async def on_queued_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionQueuedEndParams) -> None:
+            self.waiting -= 1
+
+        async def on_create_end(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionCreateEndParams) -> None:
+            self.created += 1
+
+        async def on_reuse(session: aiohttp.ClientSession, context: SimpleNamespace, params: aiohttp.TraceConnectionReuseconnParams) -> None:
+            self.reused += 1
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_queued_start.append(on_queued_start)
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_create_end)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        return trace_config
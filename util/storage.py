@@ -0,0 +1,172 @@
+''' An embedded SQLite store holding one record per guild '''
+
+import logging
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from typing import Iterable, Iterator, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+
+class GuildRecord(NamedTuple):
+    ''' The persisted state of a guild. A `queue` of `None` leaves the stored queue as it is when written '''
+    guild_id: int
+    autoplay_mode: int
+    replaygain_mode: int
+    queue: bytes
+
+
+class GuildStore():
+    ''' Stores guild records in an SQLite database in WAL mode, so each write only touches the guilds that changed.
+
+    Writes are atomic, and survive a crash once they have returned. The blocking methods are safe to call from worker threads,
+    as the connection is only ever used by one thread at a time '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._connection: sqlite3.Connection = None
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.records_written = 0
+        self.write_seconds = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        ''' Whether the database is open '''
+        return self._connection is not None
+
+    def open(self) -> None:
+        ''' Opens the database, creating it if needed '''
+
+        with self._lock:
+            if self._connection is not None:
+                return
+
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL only risks losing the latest writes on power loss, never corrupting the database
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS guilds (
+                    guild_id INTEGER PRIMARY KEY,
+                    autoplay_mode INTEGER NOT NULL,
+                    replaygain_mode INTEGER NOT NULL,
+                    queue BLOB NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            connection.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._connection = connection
+            logger.debug("Opened guild store '%s'.", self.path)
+
+    def close(self) -> None:
+        ''' Checkpoints and closes the database '''
+
+        with self._lock:
+            if self._connection is None:
+                return
+            try:
+                self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as err:
+                logger.warning("Failed to checkpoint guild store '%s': %s", self.path, err)
+            self._connection.close()
+            self._connection = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM guilds").fetchone()[0]
+
+    def guild_ids(self) -> set[int]:
+        ''' The ids of every stored guild, read from the primary key alone '''
+
+        with self._lock:
+            return {row[0] for row in self._connection.execute("SELECT guild_id FROM guilds")}
+
+    def load(self, guild_id: int) -> GuildRecord:
+        ''' Reads a single guild record, or returns `None` if the guild isn't stored '''
+
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT guild_id, autoplay_mode, replaygain_mode, queue FROM guilds WHERE guild_id = ?", (guild_id,)
+            ).fetchone()
+        return GuildRecord(*row) if row is not None else None
+
+    def load_all(self) -> list[GuildRecord]:
+        ''' Reads every guild record '''
+
+        with self._lock:
+            rows = self._connection.execute("SELECT guild_id, autoplay_mode, replaygain_mode, queue FROM guilds").fetchall()
+        return [GuildRecord(*row) for row in rows]
+
+    def write(self, records: Iterable[GuildRecord]) -> int:
+        ''' Inserts or updates guild records in a single transaction, returning how many were written '''
+
+        now = time.time()
+        rows = [(record.guild_id, record.autoplay_mode, record.replaygain_mode, record.queue, now) for record in records]
+        if not rows:
+            return 0
+
+        start = time.perf_counter()
+        with self._lock:
+            with self._transaction():
+                self._connection.executemany("""
+                    INSERT INTO guilds (guild_id, autoplay_mode, replaygain_mode, queue, updated)
+                    VALUES (?1, ?2, ?3, COALESCE(?4, x''), ?5)
+                    ON CONFLICT (guild_id) DO UPDATE SET
+                        autoplay_mode = excluded.autoplay_mode,
+                        replaygain_mode = excluded.replaygain_mode,
+                        queue = COALESCE(?4, guilds.queue),
+                        updated = excluded.updated
+                """, rows)
+
+        self.writes += 1
+        self.records_written += len(rows)
+        self.write_seconds += time.perf_counter() - start
+        return len(rows)
+
+    def compact(self, *, default_autoplay_mode: int, default_replaygain_mode: int) -> int:
+        ''' Deletes records that hold nothing but defaults, then folds the write-ahead log back into the database.
+        The file is vacuumed once a quarter of it is free space. Returns the number of records deleted '''
+
+        with self._lock:
+            with self._transaction():
+                deleted = self._connection.execute(
+                    "DELETE FROM guilds WHERE length(queue) = 0 AND autoplay_mode = ? AND replaygain_mode = ?",
+                    (default_autoplay_mode, default_replaygain_mode),
+                ).rowcount
+
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            page_count = self._connection.execute("PRAGMA page_count").fetchone()[0]
+            free_pages = self._connection.execute("PRAGMA freelist_count").fetchone()[0]
+            if page_count and free_pages * 4 >= page_count:
+                self._connection.execute("VACUUM")
+                logger.debug("Vacuumed guild store '%s' (%d of %d pages were free).", self.path, free_pages, page_count)
+
+        return deleted
+
+    @property
+    def stats(self) -> dict[str, float]:
+        ''' Counters describing the writes made to the store '''
+        return {
+            "writes": self.writes,
+            "records_written": self.records_written,
+            "write_seconds": self.write_seconds,
+        }
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        ''' Runs the statements within it as one immediate transaction, rolling back on error '''
+
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")